@@ -0,0 +1,95 @@
+######################################
+
+# Benchmark: fused vs indexed vs per-variable evaluation of the cohort's codelist flags
+
+#python analysis/benchmarks/fused_codelists.py --events 10000000
+
+# Builds a synthetic clinical_events table, sets a random index date per patient in
+# place of first_cohort_abx_rx, and times every fusable Exists node in the cohort
+# definition (has_* comorbidities, harmful_alcohol, allergy, prior outcome) evaluated
+# three ways: one by one as written (each a filter over the table - Evaluator(plain=True)),
+# through the per-codelist windows index (--no-fused) and fused (the default). The three
+# sets of flags must be identical.
+
+######################################
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine.evaluate import Evaluator  # noqa: E402
+from engine.fused import find_groups  # noqa: E402
+from engine.query import walk  # noqa: E402
+from engine.study import cohort_dataset  # noqa: E402
+from engine.tables import Database, Table  # noqa: E402
+
+
+def synthetic_events(n_events, n_patients, groups, hit_rate, rng):
+    #Codes from the flags' codelists make up `hit_rate` of events, the rest are noise
+    columns = {"patient_id": rng.integers(0, n_patients, n_events).astype(np.int64)}
+    start, end = np.datetime64("2000-01-01"), np.datetime64("2024-08-01")
+    columns["date"] = start + rng.integers(0, (end - start).astype(int), n_events).astype("timedelta64[D]")
+    for code_column in ("ctv3_code", "snomedct_code"):
+        listed = sorted({
+            code
+            for members in groups.values()
+            for _, column, codes, _ in members if column == code_column
+            for code in codes.resolve()
+        })
+        vocabulary = np.array(listed + [f"noise{i}" for i in range(20000)], dtype=object)
+        picks = np.where(
+            rng.random(n_events) < hit_rate,
+            rng.integers(0, max(len(listed), 1), n_events),
+            rng.integers(len(listed), len(vocabulary), n_events),
+        )
+        columns[code_column] = vocabulary[picks]
+    return Table("clinical_events", columns)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=10_000_000)
+    parser.add_argument("--events-per-patient", type=int, default=20)
+    parser.add_argument("--hit-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n_patients = max(args.events // args.events_per_patient, 1)
+    dataset = cohort_dataset()
+    nodes = walk([dataset.population, *dataset.variables.values()])
+    groups = find_groups(nodes)
+    flags = [node for members in groups.values() for node, *_ in members]
+    index_nodes = {key[2] for key in groups}
+
+    print(f"{len(flags)} flags in {len(groups)} group(s), {args.events:,} events, {n_patients:,} patients")
+    started = time.perf_counter()
+    events = synthetic_events(args.events, n_patients, groups, args.hit_rate, rng)
+    db = Database({
+        "clinical_events": events,
+        "patients": Table("patients", {"patient_id": np.arange(n_patients, dtype=np.int64)}),
+    })
+    index_dates = np.datetime64("2011-01-01") + rng.integers(0, 4900, db.n_patients).astype("timedelta64[D]")
+    print(f"generated in {time.perf_counter() - started:.1f}s")
+
+    results = {}
+    for label, options in (("per-variable", {"plain": True}), ("windows", {"fused": False}), ("fused", {})):
+        evaluator = Evaluator(db, **options)
+        for node in index_nodes:
+            evaluator.cache[node] = index_dates
+        started = time.perf_counter()
+        results[label] = evaluator.evaluate_all(flags)
+        print(f"{label:>12}: {time.perf_counter() - started:.2f}s")
+
+    for label in ("windows", "fused"):
+        assert all(np.array_equal(a, b) for a, b in zip(results["per-variable"], results[label])), label
+    print("flags identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+######################################
+
+# Benchmark: in-process matching (engine/matching.py) at scale
+
+#python analysis/benchmarks/matching.py --cases 100000 --controls 2000000
+
+# 3 controls per case on sex (exact) and age (+/-5), as in match_tendinitis. Also checks
+# that no control is used twice and every match is within the rules.
+
+######################################
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine.matching import match  # noqa: E402
+
+
+def synthetic(n, rng, first_id):
+    return {
+        "patient_id": np.arange(first_id, first_id + n, dtype=np.int64),
+        "sex": rng.choice(np.array(["female", "male", "intersex", "unknown"], dtype=object), n, p=[0.5, 0.49, 0.005, 0.005]),
+        "age": rng.integers(0, 100, n).astype(float),
+        "index_date": np.datetime64("2010-12-01") + rng.integers(0, 4991, n).astype("timedelta64[D]"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=100_000)
+    parser.add_argument("--controls", type=int, default=2_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cases = synthetic(args.cases, rng, 0)
+    controls = synthetic(args.controls, rng, args.cases)
+
+    started = time.perf_counter()
+    case_rows, control_rows = match(cases, controls, {"sex": "category", "age": 5}, 3, "index_date", seed=args.seed)
+    elapsed = time.perf_counter() - started
+
+    assert len(np.unique(control_rows)) == len(control_rows)
+    assert (cases["sex"][case_rows] == controls["sex"][control_rows]).all()
+    assert (np.abs(cases["age"][case_rows] - controls["age"][control_rows]) <= 5).all()
+    counts = np.bincount(np.bincount(case_rows, minlength=args.cases), minlength=4)
+    print(f"{args.cases:,} cases, {args.controls:,} controls: matched in {elapsed:.2f}s")
+    print("cases with 0/1/2/3 matches:", " / ".join(f"{c:,}" for c in counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+######################################
+
+# Benchmark: measures in one sweep vs one evaluation per interval
+
+#python analysis/benchmarks/measures.py --patients 200000
+
+# Builds synthetic medications (the six antibiotic codelists plus noise),
+# clinical_events (tendinitis/neuropathy plus noise) and practice_registrations, then
+# runs the 20 mirrored measures over all 120 months with the sweep. The per-interval
+# evaluation - what generate-measures does - is timed on a few intervals and scaled up,
+# and its numerators/denominators must match the sweep's for those intervals.
+
+######################################
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine.evaluate import Evaluator  # noqa: E402
+from engine.measures import run_measures  # noqa: E402
+from engine.study import abx_outcome_measures  # noqa: E402
+from engine.tables import Database, Table  # noqa: E402
+
+
+def random_dates(n, rng, start="2009-01-01", end="2024-08-01"):
+    start, end = np.datetime64(start), np.datetime64(end)
+    return start + rng.integers(0, (end - start).astype(int), n).astype("timedelta64[D]")
+
+
+def coded_table(name, code_column, codes, n_events, n_patients, hit_rate, rng):
+    codes = sorted(set(codes))
+    vocabulary = np.array(codes + [f"noise{i}" for i in range(5000)], dtype=object)
+    picks = np.where(
+        rng.random(n_events) < hit_rate,
+        rng.integers(0, len(codes), n_events),
+        rng.integers(len(codes), len(vocabulary), n_events),
+    )
+    return Table(name, {
+        "patient_id": rng.integers(0, n_patients, n_events).astype(np.int64),
+        "date": random_dates(n_events, rng),
+        code_column: vocabulary[picks],
+    })
+
+
+def registrations(n_patients, rng):
+    #One spell each, a third with a second (sometimes overlapping) spell; some still open
+    patient_id = np.r_[np.arange(n_patients), rng.integers(0, n_patients, n_patients // 3)].astype(np.int64)
+    start = random_dates(len(patient_id), rng, "2000-01-01", "2020-01-01")
+    end = start + rng.integers(30, 6000, len(patient_id)).astype("timedelta64[D]")
+    end[rng.random(len(patient_id)) < 0.5] = np.datetime64("NaT")
+    return Table("practice_registrations", {"patient_id": patient_id, "start_date": start, "end_date": end})
+
+
+def per_interval(db, measures, starts, ends, check):
+    #What generate-measures does: every measure, evaluated afresh for each interval
+    rows = {}
+    for i in check:
+        start, end = str(starts[i]), str(ends[i])
+        evaluator = Evaluator(db)
+        for measure in measures:
+            numerator = evaluator.evaluate(measure.numerator.query(start, end).node).astype(float)
+            denominator = evaluator.evaluate(measure.denominator.query(start, end).node).astype(float)
+            included = np.nan_to_num(denominator) != 0
+            rows[measure.name, i] = (int(np.nan_to_num(numerator)[included].sum()), int(denominator[included].sum()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=200_000)
+    parser.add_argument("--rx-per-patient", type=float, default=20)
+    parser.add_argument("--dx-per-patient", type=float, default=20)
+    parser.add_argument("--hit-rate", type=float, default=0.1)
+    parser.add_argument("--check-intervals", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    measures, (starts, ends) = abx_outcome_measures()
+    abx_codes = [code for m in measures if hasattr(m.numerator, "codes") and m.numerator.table == "medications" for code in m.numerator.codes.resolve()]
+    dx_codes = [code for m in measures if m.name in ("tendinitis_trends", "neuropathy_trends") for code in m.numerator.codes.resolve()]
+
+    started = time.perf_counter()
+    n = args.patients
+    db = Database({
+        "patients": Table("patients", {"patient_id": np.arange(n, dtype=np.int64)}),
+        "medications": coded_table("medications", "dmd_code", abx_codes, int(n * args.rx_per_patient), n, args.hit_rate, rng),
+        "clinical_events": coded_table("clinical_events", "snomedct_code", dx_codes, int(n * args.dx_per_patient), n, args.hit_rate, rng),
+        "practice_registrations": registrations(n, rng),
+    })
+    print(f"{len(measures)} measures x {len(starts)} intervals, {n:,} patients, generated in {time.perf_counter() - started:.1f}s")
+
+    started = time.perf_counter()
+    rows = run_measures(db, measures, starts, ends)
+    print(f"       sweep: {time.perf_counter() - started:.2f}s")
+
+    check = sorted(rng.choice(len(starts), args.check_intervals, replace=False).tolist())
+    started = time.perf_counter()
+    expected = per_interval(db, measures, starts, ends, check)
+    elapsed = time.perf_counter() - started
+    print(f"per-interval: {elapsed:.2f}s for {len(check)} intervals, ~{elapsed * len(starts) / len(check):.0f}s for all {len(starts)}")
+
+    by_key = {(name, i % len(starts)): (num, den) for i, (name, _, _, _, num, den) in enumerate(rows)}
+    assert all(by_key[key] == value for key, value in expected.items())
+    print("numerators and denominators identical")
+
+
+if __name__ == "__main__":
+    main()
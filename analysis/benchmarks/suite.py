@@ -0,0 +1,253 @@
+######################################
+
+# Benchmark suite: the study's definitions at 100k / 1M / 10M patients
+
+#python analysis/benchmarks/suite.py --sizes 100000,1000000
+
+# For each size, builds TPP-shaped tables with engine/dummy.py (cached, so only the first
+# run pays for them) and runs each definition through the local engine:
+
+# - cohort           analysis/dataset_definition.py
+# - abx_outcomes     analysis/measure_definition.py
+# - ctc_tendinitis   analysis/ctc_definition_tendinitis_combined.py, then the cases are
+#                    matched to controls as match_tendinitis does (the combined
+#                    definition replaced the separate cases/controls definitions)
+
+# Each case is run --repeats times, each in a fresh process so its peak RSS is its own,
+# and the fastest run is kept: the minimum is the least noisy estimate of what the code
+# costs. Stage timings (load, evaluate, write, match), throughput (patients per second)
+# and peak RSS are appended to a history file, one JSON line per definition and size.
+# Once there are at least MIN_BASELINE_RUNS passing runs of the same definition and
+# size on this machine, a run is compared with the median of the last few, and the
+# suite exits 1 if its time or peak RSS is more than --threshold above that plus an
+# absolute --tolerance (so sub-second cases don't flap on scheduler noise).
+
+# 10M patients needs roughly 20GB of memory for the tables; pass --sizes to leave it out.
+
+######################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from engine.dummy import generate_tables  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[2]
+HISTORY = ROOT / ".benchmarks" / "history.jsonl"
+SIZES = [100_000, 1_000_000, 10_000_000]
+DEFINITIONS = ["cohort", "abx_outcomes", "ctc_tendinitis"]
+THRESHOLD = 0.2
+#Allowed on top of the threshold: seconds, and bytes of peak RSS
+TOLERANCE = 0.05
+RSS_TOLERANCE = 32 * 2 ** 20
+#Passing runs the baseline is the median of, and the fewest worth comparing with
+BASELINE_RUNS = 5
+MIN_BASELINE_RUNS = 3
+REPEATS = 3
+
+#match_tendinitis in project.yaml
+CTC_CASE = "tendinitis_case"
+CTC_MATCHING = {"match_variables": {"sex": "category", "age": 5}, "matches_per_case": 3, "index_date_variable": "tendinitis_case_date"}
+
+
+def run_definition(definition, tables, output, fused):
+    #In a fresh process -> {"stages": {stage: seconds}, "rows", "patients", "peak_rss_bytes"}
+    from engine.evaluate import run_dataset
+    from engine.matching import match
+    from engine.measures import run_measures, write_measures
+    from engine.output import write_dataset
+    from engine.query import kind_of
+    from engine.study import DATASETS, MEASURES
+    from engine.tables import load_tables
+
+    stages = {}
+    started = time.perf_counter()
+
+    def stage(name):
+        nonlocal started
+        now = time.perf_counter()
+        stages[name] = round(now - started, 6)
+        started = now
+
+    db = load_tables(tables)
+    stage("load")
+    if definition in MEASURES:
+        measures, (starts, ends) = MEASURES[definition]()
+        rows = run_measures(db, measures, starts, ends)
+        stage("evaluate")
+        write_measures(output / f"{definition}.csv", rows)
+        stage("write")
+        n_rows = len(rows)
+    else:
+        dataset = DATASETS[definition]()
+        patient_ids, columns = run_dataset(db, dataset, fused=fused)
+        stage("evaluate")
+        kinds = {name: kind_of(node) for name, node in dataset.variables.items()}
+        write_dataset(output / f"{definition}.arrow", patient_ids, columns, kinds)
+        stage("write")
+        n_rows = len(patient_ids)
+        if CTC_CASE in columns:
+            is_case = columns[CTC_CASE]
+            cases = {"patient_id": patient_ids[is_case], **{name: values[is_case] for name, values in columns.items()}}
+            controls = {"patient_id": patient_ids[~is_case], **{name: values[~is_case] for name, values in columns.items()}}
+            case_rows, _ = match(cases, controls, **CTC_MATCHING)
+            stage("match")
+            n_rows += len(case_rows)
+    return {
+        "stages": stages,
+        "rows": n_rows,
+        "patients": int(db.n_patients),
+        #ru_maxrss is KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def run_isolated(*args):
+    #spawn rather than fork, so the child's peak RSS doesn't start from ours
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_definition, *args).result()
+
+
+def run_repeated(repeats, *args):
+    #The fastest of `repeats` isolated runs (and the least peak RSS of any), with every
+    #run's total seconds
+    runs = [run_isolated(*args) for _ in range(repeats)]
+    best = dict(min(runs, key=lambda run: sum(run["stages"].values())))
+    best["peak_rss_bytes"] = min(run["peak_rss_bytes"] for run in runs)
+    best["repeat_seconds"] = [round(sum(run["stages"].values()), 6) for run in runs]
+    return best
+
+
+def machine():
+    return {"host": platform.node(), "cpus": os.cpu_count(), "python": platform.python_version()}
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not path.exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baseline(history, result):
+    #Median seconds and peak RSS of recent passing runs like `result`, or None
+    same = [
+        entry for entry in history
+        if entry["definition"] == result["definition"] and entry["size"] == result["size"]
+        and entry["machine"]["host"] == result["machine"]["host"] and entry["fused"] == result["fused"]
+        and not entry["regressions"]
+    ][-BASELINE_RUNS:]
+    if len(same) < MIN_BASELINE_RUNS:
+        return None
+    return {
+        "seconds": statistics.median(entry["seconds"] for entry in same),
+        "peak_rss_bytes": statistics.median(entry["peak_rss_bytes"] for entry in same),
+        "runs": len(same),
+    }
+
+
+def regressions(result, base, threshold, tolerance=TOLERANCE):
+    found = []
+    for metric, allowed in (("seconds", tolerance), ("peak_rss_bytes", RSS_TOLERANCE)):
+        if base and result[metric] > base[metric] * (1 + threshold) + allowed:
+            found.append(f"{metric} {result[metric]:.6g} vs {base[metric]:.6g} (median of {base['runs']})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma-separated population sizes")
+    parser.add_argument("--definitions", default=",".join(DEFINITIONS))
+    parser.add_argument("--no-fused", dest="fused", action="store_false", help="run datasets with --no-fused")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--history", type=Path, default=HISTORY)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="allowed slowdown / memory growth, as a fraction")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="seconds allowed on top of --threshold (default 0.05)")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="runs per case, the fastest kept (default 3)")
+    parser.add_argument("--no-record", action="store_true", help="compare with the history but don't add to it")
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    definitions = args.definitions.split(",")
+    history = read_history(args.history)
+    results = []
+
+    with tempfile.TemporaryDirectory() as work:
+        work = Path(work)
+        for size in sizes:
+            for definition in definitions:
+                tables = work / f"{definition}-{size}"
+                started = time.perf_counter()
+                _, cached = generate_tables(definition, tables, size, seed=args.seed, file_format="arrow")
+                generated = time.perf_counter() - started
+
+                run = run_repeated(args.repeats, definition, tables, work, args.fused)
+                seconds = sum(run["stages"].values())
+                result = {
+                    "created": datetime.now().isoformat(timespec="seconds"),
+                    "commit": commit(),
+                    "machine": machine(),
+                    "definition": definition,
+                    "size": size,
+                    "fused": args.fused,
+                    "generate_seconds": round(generated, 6),
+                    "generate_cached": cached,
+                    "repeats": args.repeats,
+                    **run,
+                    "seconds": round(seconds, 6),
+                    "patients_per_second": round(run["patients"] / seconds, 1),
+                }
+                base = baseline(history, result)
+                result["regressions"] = regressions(result, base, args.threshold, args.tolerance)
+                results.append(result)
+
+                stages = ", ".join(f"{name} {value:.2f}s" for name, value in run["stages"].items())
+                print(
+                    f"{definition} @ {size:,}: {seconds:.2f}s ({stages}), {result['patients_per_second']:,.0f} patients/s, "
+                    f"peak RSS {run['peak_rss_bytes'] / 2 ** 30:.2f} GiB"
+                    + (f" - vs baseline {base['seconds']:.2f}s" if base else f" - no baseline yet (needs {MIN_BASELINE_RUNS} passing runs)")
+                )
+                for regression in result["regressions"]:
+                    print(f"  REGRESSION {regression}")
+                #Drop this size's tables before the next, so only one set is on disk
+                for path in tables.iterdir():
+                    path.unlink()
+
+    if not args.no_record:
+        args.history.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.history, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    failed = [result for result in results if result["regressions"]]
+    if failed:
+        print(f"{len(failed)} of {len(results)} runs regressed by more than {args.threshold:.0%} + {args.tolerance:g}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+######################################
+
+# Shared codelist loader for all the definitions in analysis/
+
+# Every codelist is registered once below by name. Nothing is read until a definition
+# touches the name (eg. `from codelists import tendinitis_codes`), and each CSV is compiled
+# once into a pickle keyed by the sha recorded in codelists/codelists.json - so a rerun
+# only unpickles, and `opensafely codelists update` (which rewrites the sha) invalidates it.
+
+# Values are the same plain list / dict that ehrql's codelist_from_csv returns, so they
+# can be passed straight to is_in() / to_category() or combined with +
+
+######################################
+
+import csv
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+
+CODELIST_DIR = Path(__file__).resolve().parent.parent / "codelists"
+CACHE_DIR = Path(os.environ.get("CODELIST_CACHE_DIR", CODELIST_DIR.parent / ".codelist_cache"))
+
+#name: (file, code column, category column)
+CODELISTS = {
+    #Exposure codes - dmd
+    "amoxicillin_codes": ("opensafely-amoxicillin-oral.csv", "code", None),
+    "amox_clavulanicacid_codes": ("opensafely-co-amoxiclav-oral.csv", "code", None),
+    "cefalexin_codes": ("opensafely-cefalexin-oral.csv", "code", None),
+    "trimethoprim_codes": ("opensafely-trimethoprim.csv", "code", None),
+    "trim_sulfa_codes": ("user-jacklsbrist-trimethoprimsulfamethoxazole-dmd.csv", "code", None),
+    "fluoroquinolone_codes": ("user-jacklsbrist-fluoroquinolones-dmd.csv", "code", None),
+
+    #Outcome codes - snomed
+    "tendinitis_codes": ("user-jacklsbrist-tendinitis.csv", "code", None),
+    "neuropathy_newdx_codes": ("user-jacklsbrist-peripheral-neuropathy.csv", "code", None),
+
+    #Covariate/demographic codes
+    "ethnicity_codelist": ("opensafely-ethnicity-snomed-0removed.csv", "snomedcode", "Grouping_16"),
+    "smoking_clear_codelist": ("opensafely-smoking-clear.csv", "CTV3Code", "Category"),
+    "bmi_codelist": ("primis-covid19-vacc-uptake-bmi.csv", "code", None),
+    "harmful_alcohol_codelist": ("opensafely-hazardous-alcohol-drinking.csv", "code", None),
+
+    #Comorbidity codes - ctv3
+    "diabetes_codelist": ("opensafely-diabetes.csv", "CTV3ID", None),
+    "dementia_codelist": ("opensafely-dementia-complete.csv", "code", None),
+    "hiv_codelist": ("opensafely-hiv.csv", "CTV3ID", None),
+    "heart_failure_codelist": ("opensafely-heart-failure.csv", "CTV3ID", None),
+    "chronic_liver_disease_codelist": ("opensafely-chronic-liver-disease.csv", "CTV3ID", None),
+    "multiple_sclerosis_codelist": ("opensafely-multiple-sclerosis.csv", "CTV3ID", None),
+    "rheumatoid_arthritis_codelist": ("opensafely-rheumatoid-arthritis.csv", "CTV3ID", None),
+    "solid_organ_transplant_codelist": ("opensafely-solid-organ-transplantation.csv", "CTV3ID", None),
+    "lung_cancer_codelist": ("opensafely-lung-cancer.csv", "CTV3ID", None),
+    "notlung_nothaem_cancer_codelist": ("opensafely-cancer-excluding-lung-and-haematological.csv", "CTV3ID", None),
+    "haem_cancer_codelist": ("opensafely-haematological-cancer.csv", "CTV3ID", None),
+    "stroke_codelist": ("opensafely-incident-non-traumatic-stroke.csv", "CTV3ID", None),
+    "tia_codelist": ("opensafely-transient-ischaemic-attack.csv", "code", None),
+    "chronic_resp_exc_asthma_codelist": ("opensafely-chronic-respiratory-disease.csv", "CTV3ID", None),
+    "asthma_codelist": ("opensafely-asthma-diagnosis.csv", "CTV3ID", None),
+    "hemiplegia_codelist": ("user-jacklsbrist-hemiplegia.csv", "code", None),
+
+    #Comorbidity codes - snomed
+    "coronary_hd_codelist": ("nhsd-primary-care-domain-refsets-chd_cod.csv", "code", None),
+    "hypertension_codelist": ("nhsd-primary-care-domain-refsets-hyp_cod.csv", "code", None),
+    "ckd_codelist": ("primis-covid19-vacc-uptake-old-ckd15_cod.csv", "code", None),
+    "pvd_codelist": ("qcovid-has_peripheral_vascular_disease.csv", "code", None),
+    "aaa_codelist": ("nhsd-primary-care-domain-refsets-aaa_cod.csv", "code", None),
+    "peptic_ulcer_codelist": ("nhsd-primary-care-domain-refsets-peptic-ulceration-codes.csv", "code", None),
+
+    #Non-abx prescription codes - dmd
+    "corticosteroid_codes": ("qcovid-is_prescribed_oral_steroids.csv", "code", None),
+    "phenytoin_codes": ("user-jacklsbrist-phenytoin-dmd.csv", "code", None),
+    "amiodarone_codes": ("pincer-amio.csv", "code", None),
+    "metronidazole_codes": ("ukhsa-metronidazole-tinidazole-and-ornidazole-antibacterials.csv", "code", None),
+    "nitrofurantoin_codes": ("user-jacklsbrist-nitrofurantoin-dmd.csv", "code", None),
+
+    #Allergy codes - snomed
+    "fluoroquinolone_allergy_codes": ("user-jacklsbrist-allergy-to-fluoroquinolones.csv", "code", None),
+    "co_amox_allergy_codes": ("user-jacklsbrist-allergy-to-co-amoxiclav.csv", "code", None),
+}
+
+__all__ = list(CODELISTS)
+
+_recorded_shas = None
+
+
+def recorded_sha(filename):
+    #sha written by `opensafely codelists update`; hash the file ourselves if it isn't listed
+    global _recorded_shas
+    if _recorded_shas is None:
+        with (CODELIST_DIR / "codelists.json").open() as f:
+            _recorded_shas = {name: entry["sha"] for name, entry in json.load(f)["files"].items()}
+    if filename in _recorded_shas:
+        return _recorded_shas[filename]
+    return hashlib.sha1((CODELIST_DIR / filename).read_bytes()).hexdigest()
+
+
+def parse_codelist_csv(path, column, category_column=None):
+    #Same rules as ehrql's codelist_from_csv: strip codes, drop blanks, keep first category seen
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for col in (column, category_column):
+            if col is not None and col not in reader.fieldnames:
+                raise ValueError(f"No column '{col}' in {path}")
+        codes = {}
+        for row in reader:
+            code = row[column].strip()
+            if code and code not in codes:
+                codes[code] = row[category_column].strip() if category_column else None
+    if category_column is None:
+        return list(codes)
+    return codes
+
+
+def cache_path(filename, column, category_column=None):
+    key = f"{recorded_sha(filename)}-{column}-{category_column or ''}"
+    return CACHE_DIR / f"{Path(filename).stem}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.pickle"
+
+
+def load_codelist(filename, column, category_column=None):
+    path = CODELIST_DIR / filename
+    stat = path.stat()
+    cached = cache_path(filename, column, category_column)
+    try:
+        with cached.open("rb") as f:
+            size, mtime, codes = pickle.load(f)
+        #sha is the key, size/mtime just catch a hand-edited file whose sha wasn't updated
+        if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+            return codes
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+
+    codes = parse_codelist_csv(path, column, category_column)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump((stat.st_size, stat.st_mtime_ns, codes), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cached)
+    except OSError:
+        pass #read-only checkout (eg. inside the job runner) - just use the parsed codes
+    return codes
+
+
+def __getattr__(name):
+    #Only called for names not loaded yet, so each codelist is read at most once per run
+    if name not in CODELISTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    codes = load_codelist(*CODELISTS[name])
+    globals()[name] = codes
+    return codes
+
+
+def __dir__():
+    return sorted(set(globals()) | set(CODELISTS))
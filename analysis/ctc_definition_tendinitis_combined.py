@@ -1,59 +1,52 @@
 ######################################
 
 # This script provides the formal specification of the data that will be extracted from
-# the OpenSAFELY database for the case-time-control analysis.
+# the OpenSAFELY database for the case-time-control analysis - cases and potential
+# controls in one extraction.
 
 #Jack Stanley
 
-#opensafely exec ehrql:v1 generate-dataset analysis/dataset_definition.py
+#opensafely exec ehrql:v1 generate-dataset analysis/ctc_definition_tendinitis_combined.py --output output/ctc_data_tendinitis.csv.gz
+
+#The case date, registration/prior tendinitis criteria and the antibiotic x period exposure windows
+#are defined once here for both groups, so medications and clinical_events are only scanned once.
+#analysis/split_ctc.py then writes the cases and potential controls files that matching expects.
 
 #nb check https://docs.opensafely.org/case-control-studies/#background
 
 ######################################
 
-from ehrql import create_dataset, codelist_from_csv, years, months, weeks, days, show, case
-from ehrql.tables.tpp import patients, medications, practice_registrations, addresses, clinical_events, apcs, ons_deaths
-from codelists import *
-from datetime import date, timedelta, datetime
-
-
-
-#show(dataset) - how do I get show to work?
+from ehrql import create_dataset, years, months, weeks, days, show, case, when
+from ehrql.tables.tpp import patients, medications, practice_registrations, clinical_events
+from codelists import (
+    amoxicillin_codes, amox_clavulanicacid_codes, cefalexin_codes, trimethoprim_codes, trim_sulfa_codes, fluoroquinolone_codes,
+    tendinitis_codes,
+)
+from datetime import datetime
 
 dataset = create_dataset()
 
 start_date = "2010-12-01" ##TBC
 end_date = "2024-08-01"  ##TBC
 
-#Exposure codes
-
-amoxicillin_codes = codelist_from_csv("codelists/opensafely-amoxicillin-oral.csv", column = "code")
-amox_clavulanicacid_codes = codelist_from_csv("codelists/opensafely-co-amoxiclav-oral.csv", column = "code")
-cefalexin_codes = codelist_from_csv("codelists/opensafely-cefalexin-oral.csv", column = "code")
-trimethoprim_codes = codelist_from_csv("codelists/opensafely-trimethoprim.csv", column = "code")
-trim_sulfa_codes = codelist_from_csv("codelists/user-jacklsbrist-trimethoprimsulfamethoxazole-dmd.csv", column = "code")
-
-fluoroquinolone_codes = codelist_from_csv("codelists/user-jacklsbrist-fluoroquinolones-dmd.csv", column = "code")
-
-all_abx_codes = amoxicillin_codes + amox_clavulanicacid_codes + cefalexin_codes + trimethoprim_codes + trim_sulfa_codes + fluoroquinolone_codes
-
-#Outcome codes
-
-tendinitis_codes = codelist_from_csv("codelists/user-jacklsbrist-tendinitis.csv", column = "code")
-neuropathy_newdx_codes = codelist_from_csv("codelists/user-jacklsbrist-peripheral-neuropathy.csv", column = "code")
-
-combo_outcome_codes = tendinitis_codes + neuropathy_newdx_codes
-
         #Include just cases after the start date
 
-tendinitis_case_date = clinical_events.where(clinical_events.snomedct_code.is_in(tendinitis_codes )
+tendinitis_case_date = clinical_events.where(clinical_events.snomedct_code.is_in(tendinitis_codes)
 ).where(
     clinical_events.date.is_after(start_date)
 ).sort_by(
         clinical_events.date
 ).first_for_patient().date
 
-    #Registration 1y before case status
+is_case = tendinitis_case_date.is_not_null()
+
+    #Registration 1y before case status (cases) or the study start (potential controls)
+
+has_registration_1y_before_tendinitis =  (
+    practice_registrations.where(practice_registrations.start_date <= (tendinitis_case_date + years(1)))
+    .except_where(practice_registrations.end_date < end_date)
+    .exists_for_patient()
+)
 
 has_registration_1y_before_start_date =  (
     practice_registrations.where(practice_registrations.start_date <= (start_date + years(1)))
@@ -61,7 +54,7 @@ has_registration_1y_before_start_date =  (
     .exists_for_patient()
 )
 
-#Exclusion criteria - those with prior tendinitis/neuropathy
+#Exclusion criteria - those with prior tendinitis
 
 prior_tendinitis = clinical_events.where(
         clinical_events.snomedct_code.is_in(tendinitis_codes) #Exclude those with pre-existing diagnoses
@@ -69,46 +62,48 @@ prior_tendinitis = clinical_events.where(
         clinical_events.date.is_on_or_before(start_date)
 ).exists_for_patient()
 
-#Exclusion criteria - drug allergy to those ?Is this necessary for the ctc?
-
-#Dataset definition
+#Dataset definition - union of the old cases and potential controls populations
 
 dataset.define_population(
      (patients.exists_for_patient()) &
-     tendinitis_case_date.is_null() & #Exclude those with incidence of either outcome of interest
-     has_registration_1y_before_start_date &
-    ~(prior_tendinitis) 
+     ~(prior_tendinitis) &
+     (
+        (is_case & has_registration_1y_before_tendinitis) |
+        (~is_case & has_registration_1y_before_start_date)
+     )
     )
 
-dataset.sex = patients.sex
 dataset.configure_dummy_data(population_size=100000)
 
+#Index date for potential controls - stable pseudo-random date from date of birth (as before)
 
-# Locally convert strings to date objects for arithmetic
 start_date_obj = datetime.strptime(start_date, "%Y-%m-%d").date()
 end_date_obj = datetime.strptime(end_date, "%Y-%m-%d").date()
-
-# Now compute number of days
 N_days = (end_date_obj - start_date_obj).days
 
-# Create a stable patient sequence number
-# We'll combine year, month, and day to get some variation
 patient_sequence = (
     patients.date_of_birth.year * 10000 +
     patients.date_of_birth.month * 100 +
     patients.date_of_birth.day
 )
 
-# Compute offset: mod N_days ensures cycling
 quotient = patient_sequence // N_days
 offset_days = patient_sequence - (quotient * N_days)
 
-# Add offset to start date
-# This is allowed in ehrql using `start_date + offset_days`
 random_date = start_date + days(offset_days)
 
-dataset.tendinitis_case_date = random_date
-dataset.age = patients.age_on(random_date)
+index_date = case(
+    when(is_case).then(tendinitis_case_date),
+    otherwise=random_date,
+)
+
+#Case status
+
+dataset.tendinitis_case = is_case
+
+dataset.sex = patients.sex
+dataset.age = patients.age_on(index_date)
+dataset.tendinitis_case_date = index_date #kept under this name as matching uses it as the index date
 
 #Look for exposure in risk window
 
@@ -121,7 +116,7 @@ antibiotic_codelists_dmd = {
         "trim_sulfamethoxazole":trim_sulfa_codes,
 
         "fluoroquinolones": fluoroquinolone_codes
-    
+
 }
 
 # Define time windows for each period label
@@ -131,7 +126,7 @@ tendinitis_periods = {
 }
 
 
-# Loop over antibiotics and periods
+# Loop over antibiotics and periods - evaluated once for cases and controls together
 for antibiotic, codelist in antibiotic_codelists_dmd.items():
     for period_label, (start_offset, end_offset) in tendinitis_periods.items():
                 setattr(
@@ -140,9 +135,9 @@ for antibiotic, codelist in antibiotic_codelists_dmd.items():
                          medications.where(medications.dmd_code.is_in(codelist))
                          .where(
                           medications.date.is_on_or_between(
-                                        tendinitis_case_date - start_offset,
-                                        tendinitis_case_date - end_offset
+                                        index_date - start_offset,
+                                        index_date - end_offset
                 )
             )
             .exists_for_patient()
-        )
\ No newline at end of file
+        )
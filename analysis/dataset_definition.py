@@ -14,13 +14,25 @@
 
 #COuld this be one dataset and then another one for CTC?
 
-from ehrql import create_dataset, codelist_from_csv, years, months, weeks, days, show
+from ehrql import create_dataset, years, months, weeks, days, show
 from ehrql.tables.tpp import patients, medications, practice_registrations, addresses, clinical_events, apcs, ons_deaths
-from codelists import *
+from codelists import (
+    amoxicillin_codes, amox_clavulanicacid_codes, cefalexin_codes, trimethoprim_codes, trim_sulfa_codes, fluoroquinolone_codes,
+    tendinitis_codes, neuropathy_newdx_codes,
+    ethnicity_codelist, bmi_codelist, harmful_alcohol_codelist,
+    diabetes_codelist, dementia_codelist, hiv_codelist, heart_failure_codelist, chronic_liver_disease_codelist,
+    multiple_sclerosis_codelist, rheumatoid_arthritis_codelist, solid_organ_transplant_codelist,
+    lung_cancer_codelist, notlung_nothaem_cancer_codelist, haem_cancer_codelist, stroke_codelist, tia_codelist,
+    chronic_resp_exc_asthma_codelist, asthma_codelist, hemiplegia_codelist,
+    coronary_hd_codelist, hypertension_codelist, ckd_codelist, pvd_codelist, aaa_codelist, peptic_ulcer_codelist,
+    corticosteroid_codes, phenytoin_codes, amiodarone_codes, metronidazole_codes, nitrofurantoin_codes,
+    fluoroquinolone_allergy_codes, co_amox_allergy_codes,
+) #all codelists are loaded (and cached) in analysis/codelists.py
 
 # show(dataset)
 
 #how do I get show to work?
+#Locally, for a random sample of patients: python analysis/run_engine.py show cohort fluoroquinolone_exp --tables dummy_tables (engine/preview.py)
 
 dataset = create_dataset()
 
@@ -29,54 +41,17 @@ end_date = "2024-08-01"  ##TBC
 
 #Exposure codes
 
-amoxicillin_codes = codelist_from_csv("codelists/opensafely-amoxicillin-oral.csv", column = "code")
-amox_clavulanicacid_codes = codelist_from_csv("codelists/opensafely-co-amoxiclav-oral.csv", column = "code")
-cefalexin_codes = codelist_from_csv("codelists/opensafely-cefalexin-oral.csv", column = "code")
-trimethoprim_codes = codelist_from_csv("codelists/opensafely-trimethoprim.csv", column = "code")
-trim_sulfa_codes = codelist_from_csv("codelists/user-jacklsbrist-trimethoprimsulfamethoxazole-dmd.csv", column = "code")
-
-fluoroquinolone_codes = codelist_from_csv("codelists/user-jacklsbrist-fluoroquinolones-dmd.csv", column = "code")
-
 all_abx_codes = amoxicillin_codes + amox_clavulanicacid_codes + cefalexin_codes + trimethoprim_codes + trim_sulfa_codes +fluoroquinolone_codes
 
 cohort_abx_codes = amox_clavulanicacid_codes + fluoroquinolone_codes
 
 #Outcome codes
 
-tendinitis_codes = codelist_from_csv("codelists/user-jacklsbrist-tendinitis.csv", column = "code")
-neuropathy_newdx_codes = codelist_from_csv("codelists/user-jacklsbrist-peripheral-neuropathy.csv", column = "code")
-
 combo_outcome_codes = tendinitis_codes + neuropathy_newdx_codes
 
-#Covariate/demographic codes
-
-ethnicity_codelist = codelist_from_csv("codelists/opensafely-ethnicity-snomed-0removed.csv", column="snomedcode", category_column = "Grouping_16")
-smoking_clear_codelist = codelist_from_csv("codelists/opensafely-smoking-clear.csv", column = "CTV3Code", category_column = "Category")
-bmi_codelist = codelist_from_csv("codelists/primis-covid19-vacc-uptake-bmi.csv", column = "code")
-harmful_alcohol_codelist = codelist_from_csv("codelists/opensafely-hazardous-alcohol-drinking.csv", column = "code")
-
-
-
-
 #Comorbidity codes
 
         #ctv3
-diabetes_codelist = codelist_from_csv("codelists/opensafely-diabetes.csv", column = "CTV3ID")
-dementia_codelist = codelist_from_csv("codelists/opensafely-dementia-complete.csv", column = "code")
-hiv_codelist = codelist_from_csv("codelists/opensafely-heart-failure.csv", column = "CTV3ID")
-heart_failure_codelist = codelist_from_csv("codelists/opensafely-hiv.csv", column = "CTV3ID")
-chronic_liver_disease_codelist = codelist_from_csv("codelists/opensafely-chronic-liver-disease.csv", column = "CTV3ID")
-multiple_sclerosis_codelist = codelist_from_csv("codelists/opensafely-multiple-sclerosis.csv", column = "CTV3ID")
-rheumatoid_arthritis_codelist = codelist_from_csv("codelists/opensafely-rheumatoid-arthritis.csv", column = "CTV3ID")
-solid_organ_transplant_codelist = codelist_from_csv("codelists/opensafely-solid-organ-transplantation.csv", column = "CTV3ID")
-lung_cancer_codelist = codelist_from_csv("codelists/opensafely-lung-cancer.csv", column = "CTV3ID")
-notlung_nothaem_cancer_codelist = codelist_from_csv("codelists/opensafely-cancer-excluding-lung-and-haematological.csv", column = "CTV3ID")
-haem_cancer_codelist = codelist_from_csv("codelists/opensafely-haematological-cancer.csv", column = "CTV3ID")
-stroke_codelist = codelist_from_csv("codelists/opensafely-incident-non-traumatic-stroke.csv", column = "CTV3ID")
-tia_codelist = codelist_from_csv("codelists/opensafely-transient-ischaemic-attack.csv", column = "code")
-chronic_resp_exc_asthma_codelist = codelist_from_csv("codelists/opensafely-chronic-respiratory-disease.csv", column = "CTV3ID")
-asthma_codelist = codelist_from_csv("codelists/opensafely-asthma-diagnosis.csv", column = "CTV3ID")
-hemiplegia_codelist = codelist_from_csv("codelists/user-jacklsbrist-hemiplegia.csv", column = "code")
 
 all_cancer_codelist = lung_cancer_codelist + notlung_nothaem_cancer_codelist + haem_cancer_codelist
 stroke_tia_codelist = stroke_codelist + tia_codelist
@@ -98,14 +73,6 @@ comorbidity_codelists_ctv3 = {
     "stroke_tia":stroke_tia_codelist
 }
 
-        #snomed
-coronary_hd_codelist = codelist_from_csv("codelists/nhsd-primary-care-domain-refsets-chd_cod.csv", column = "code")
-hypertension_codelist = codelist_from_csv("codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv", column = "code")
-ckd_codelist =codelist_from_csv("codelists/primis-covid19-vacc-uptake-old-ckd15_cod.csv", column = "code")
-pvd_codelist = codelist_from_csv("codelists/qcovid-has_peripheral_vascular_disease.csv", column = "code")
-aaa_codelist = codelist_from_csv("codelists/nhsd-primary-care-domain-refsets-aaa_cod.csv", column = "code")
-peptic_ulcer_codelist = codelist_from_csv("codelists/nhsd-primary-care-domain-refsets-peptic-ulceration-codes.csv", column = "code")
-
         #snomed dictionary
 comorbidity_codelists_snomedct = {
     "aaa":aaa_codelist,
@@ -119,20 +86,10 @@ comorbidity_codelists_snomedct = {
 #Non-abx prescription codes
         #Need more when available
 
-corticosteroid_codes = codelist_from_csv("codelists/qcovid-is_prescribed_oral_steroids.csv", column = "code")
-
-phenytoin_codes = codelist_from_csv("codelists/user-jacklsbrist-phenytoin-dmd.csv", column = "code")
-amiodarone_codes = codelist_from_csv("codelists/pincer-amio.csv", column = "code")
-metronidazole_codes = codelist_from_csv("codelists/ukhsa-metronidazole-tinidazole-and-ornidazole-antibacterials.csv", column = "code")
-nitrofurantoin_codes = codelist_from_csv("codelists/user-jacklsbrist-nitrofurantoin-dmd.csv", column = "code")
-
 drug_causes_of_neuropathy_codes = phenytoin_codes  + amiodarone_codes + metronidazole_codes + nitrofurantoin_codes
 
 #Allergy codes
 
-fluoroquinolone_allergy_codes = codelist_from_csv("codelists/user-jacklsbrist-allergy-to-fluoroquinolones.csv", column = "code")
-co_amox_allergy_codes = codelist_from_csv("codelists/user-jacklsbrist-allergy-to-co-amoxiclav.csv", column = "code")
-
 cohort_abx_allergy_codes = fluoroquinolone_allergy_codes + co_amox_allergy_codes
 
 #This is date of first prescription of study abx for cohort
@@ -0,0 +1,12 @@
+######################################
+
+# Local numpy engine for the study definitions
+
+# ehrql does the real extraction inside OpenSAFELY and we can't change how it runs there.
+# This package evaluates the same definitions (mirrored in engine/study.py) over
+# TPP-shaped tables on our own machines - dummy_tables/, synthetic tables for
+# benchmarking - and holds the python:v2 steps that run on extracted outputs.
+
+# Needs numpy and pyarrow (both in the python:v2 image).
+
+######################################
@@ -0,0 +1,90 @@
+######################################
+
+# Measures evaluated in blocks of intervals, in worker processes
+
+#python analysis/run_engine.py generate-measures abx_outcomes --tables dummy_tables_1m --output output/engine/measures.csv --blocks 4
+
+# Every measure value is per interval, so the intervals can be split into contiguous
+# blocks and each block swept on its own. The parent loads the database and filters each
+# event set (table + codelist) once - they don't depend on the intervals - and forked
+# workers read both without a copy. Each worker runs the ordinary sweep over its block;
+# rows are put back in the serial order - by measure, then interval - so the output is
+# identical to a serial run.
+
+######################################
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .measures import RegisteredSpanning, Sweep, measure_rows, run_measures
+from .registrations import RegistrationIndex
+
+#Database, measures and filtered event sets for the workers - set in the parent just
+#before forking, so they are shared rather than pickled
+_DB = None
+_MEASURES = None
+_EVENTS = None
+
+
+def interval_blocks(n_intervals, n_blocks):
+    #-> [(lo, hi), ...] contiguous, near-equal, none empty
+    edges = np.linspace(0, n_intervals, min(n_blocks, n_intervals) + 1).round().astype(int)
+    return [(int(lo), int(hi)) for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def parts_of(measures):
+    #Every numerator/denominator and the parts they're built on (eg. an anchor date)
+    found, pending = [], [part for measure in measures for part in (measure.numerator, measure.denominator)]
+    while pending:
+        part = pending.pop()
+        if part not in found:
+            found.append(part)
+            if hasattr(part, "date"):
+                pending.append(part.date)
+    return found
+
+
+def run_block(starts, ends):
+    sweep = Sweep(_DB, starts, ends)
+    sweep._events = _EVENTS
+    rows = []
+    for measure in _MEASURES:
+        rows.extend(measure_rows(sweep, measure))
+    return rows
+
+
+def merge(measures, parts):
+    #parts: each block's rows, blocks in interval order -> rows in run_measures' order
+    by_measure = {measure.name: [] for measure in measures}
+    for rows in parts:
+        for row in rows:
+            by_measure[row[0]].append(row)
+    return [row for measure in measures for row in by_measure[measure.name]]
+
+
+def run_blocked(db, measures, starts, ends, n_blocks, workers=None):
+    #-> rows, as run_measures(db, measures, starts, ends)
+    global _DB, _MEASURES, _EVENTS
+    blocks = interval_blocks(len(starts), n_blocks)
+    if len(blocks) < 2:
+        return run_measures(db, measures, starts, ends)
+    #Shared state built before forking, so the workers don't each build it
+    shared = Sweep(db, starts, ends)
+    for part in parts_of(measures):
+        if isinstance(part, RegisteredSpanning):
+            RegistrationIndex.for_db(db)
+        elif hasattr(part, "codes"):
+            shared.events(part.table, part.code_column, part.codes)
+    _DB, _MEASURES, _EVENTS = db, measures, shared._events
+    try:
+        #fork, so workers see _DB without a copy (the study runs on Linux)
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(min(workers or os.cpu_count() or 1, len(blocks)), mp_context=context) as pool:
+            futures = [pool.submit(run_block, starts[lo:hi], ends[lo:hi]) for lo, hi in blocks]
+            parts = [future.result() for future in futures]
+    finally:
+        _DB = _MEASURES = _EVENTS = None
+    return merge(measures, parts)
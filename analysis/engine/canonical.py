@@ -0,0 +1,150 @@
+######################################
+
+# Canonical form of a definition's query graph, and a report of what it shares
+
+#python analysis/run_engine.py generate-dataset cohort --tables dummy_tables --output output/dataset.arrow --dedupe-report
+
+# Nodes are frozen dataclasses, so a subtree written out again - patient_address and
+# the imd lookup, the clinical_events.date.is_before(first_cohort_abx_rx) filters of
+# the comorbidities, the CTC's medications.where(...) built in loops - is already equal
+# to the first and evaluated once. Equivalent subtrees spelt differently are not, so
+# before evaluation run_dataset rewrites every node to one spelling:
+
+# - a filter chain is a set of conditions: duplicates dropped, and ordered code tests
+#   first, then the other where()s, then except_where()s (each by repr) - so chains
+#   differing only in order share their frames, and the codelist filter still cuts the
+#   rows first
+# - and/or/eq/ne/add/mul take their arguments row-level first, then by repr
+# - a comparison of a patient-level value with a row-level one is turned round so the
+#   row-level side comes first (x > medications.date -> medications.date < x), the
+#   shape the indexed paths (windows, registrations, fused) look for
+# - a codelist in is_in is its names sorted, without repeats
+
+# and interns the results, so equal subtrees are one object. None of this changes a
+# result. The report (--dedupe-report, <output>.dedupe.json) lists every canonical node
+# used by more than one variable, or reached from more than one spelling, with the
+# variables it is shared by.
+
+######################################
+
+import json
+from datetime import datetime
+from pathlib import Path
+
+from .fused import is_code_test
+from .query import Codes, Column, Count, Events, Exists, Filter, Function, Pick, Value, create_dataset, flatten, row_table, walk
+
+#Same result whatever the order of their arguments
+COMMUTATIVE = {"and", "or", "eq", "ne", "add", "mul"}
+#x op y == y MIRRORED[op] x
+MIRRORED = {"lt": "gt", "le": "ge", "gt": "lt", "ge": "le"}
+
+
+class Canonicaliser:
+    def __init__(self):
+        self.canonical = {} #node as written -> canonical node
+        self.interned = {} #canonical node -> the one instance of it
+
+    def __call__(self, node):
+        if node not in self.canonical:
+            rewritten = self.rewrite(node)
+            self.canonical[node] = self.interned.setdefault(rewritten, rewritten)
+        return self.canonical[node]
+
+    def rewrite(self, node):
+        if isinstance(node, Filter):
+            table, conditions = flatten(node)
+            conditions = dict.fromkeys((self(condition), exclude) for condition, exclude in conditions)
+            frame = self(Events(table))
+            for condition, exclude in sorted(conditions, key=lambda c: filter_order(c, table)):
+                filtered = Filter(frame, condition, exclude)
+                frame = self.interned.setdefault(filtered, filtered)
+            return frame
+        if isinstance(node, Function):
+            args = tuple(self(arg) for arg in node.args)
+            op = node.op
+            if op in COMMUTATIVE:
+                args = tuple(sorted(args, key=lambda arg: (row_table(arg) is None, repr(arg))))
+            elif op in MIRRORED and row_table(args[0]) is None and row_table(args[1]) is not None:
+                op, args = MIRRORED[op], args[::-1]
+            if op == "is_in" and isinstance(args[1], Codes):
+                args = (args[0], Codes(tuple(sorted(set(args[1].names)))))
+            return Function(op, args)
+        if isinstance(node, (Exists, Count)):
+            return type(node)(self(node.source))
+        if isinstance(node, Pick):
+            return Pick(self(node.source), node.sort_column, node.column, node.last)
+        return node
+
+
+def filter_order(condition, table):
+    #Sort key for a (condition, exclude) pair in a filter chain
+    condition, exclude = condition
+    return (exclude, not is_code_test(condition, table), repr(condition))
+
+
+def canonical_dataset(dataset, canonicaliser=None):
+    #-> a Dataset with the same variables, each in canonical form
+    canonicaliser = canonicaliser or Canonicaliser()
+    canonical = create_dataset()
+    if dataset.population is not None:
+        canonical.define_population(canonicaliser(dataset.population))
+    for name, node in dataset.variables.items():
+        setattr(canonical, name, canonicaliser(node))
+    return canonical
+
+
+def dedupe_report(dataset):
+    #-> {"written_nodes": ..., "canonical_nodes": ..., "merged": ..., "shared": [...]} for a
+    #dataset definition - it needs no data
+    from .profile import describe, node_id
+    canonicaliser = Canonicaliser()
+    targets = {"<population>": dataset.population, **dataset.variables} if dataset.population is not None else dict(dataset.variables)
+    written = walk(list(targets.values()))
+    spellings, used_by = {}, {}
+    for node in written:
+        spellings.setdefault(canonicaliser(node), []).append(node)
+    for name, target in targets.items():
+        for node in walk([canonicaliser(target)]):
+            used_by.setdefault(node, []).append(name)
+    shared = []
+    for node, names in used_by.items():
+        #Leaves (tables, columns, literals, codelists) cost nothing to share
+        if isinstance(node, (Events, Column, Value, Codes)) or (len(names) < 2 and len(spellings.get(node, ())) < 2):
+            continue
+        shared.append({
+            "id": node_id(node),
+            "expression": describe(node),
+            "kind": "frame" if isinstance(node, (Events, Filter)) else "series",
+            "used_by": names,
+            #Distinct ways it is written in the definition, if more than one
+            "spellings": [describe(n) for n in spellings.get(node, ())] if len(spellings.get(node, ())) > 1 else [],
+        })
+    shared.sort(key=lambda e: (-len(e["used_by"]), -len(e["spellings"]), e["expression"]))
+    return {
+        "written_nodes": len(written),
+        "canonical_nodes": len(used_by),
+        "merged": sum(1 for e in shared if e["spellings"]),
+        "shared": shared,
+    }
+
+
+def report_path(output):
+    #output/dataset.csv.gz -> output/dataset.dedupe.json
+    output = Path(output)
+    return output.with_name(output.name.split(".")[0] + ".dedupe.json")
+
+
+def write_report(output, report, **header):
+    path = report_path(output)
+    with open(path, "w") as f:
+        json.dump({"created": datetime.now().isoformat(timespec="seconds"), **header, **report}, f, indent=1)
+    return path
+
+
+def summary(report, n=10):
+    #The n most shared nodes, for the console
+    return "\n".join(
+        f"  {len(e['used_by']):4d} variables {len(e['spellings']) or 1:3d} spelling(s)  {e['expression'][:120]}"
+        for e in report["shared"][:n]
+    )
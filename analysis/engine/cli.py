@@ -0,0 +1,229 @@
+######################################
+
+# Command line for the local engine - see analysis/run_engine.py
+
+######################################
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .evaluate import run_dataset
+from .measures import run_measures, write_measures
+from .output import write_dataset
+from .query import kind_of
+from .study import DATASETS, MEASURES, RISK_SETS
+from .tables import load_arrow_tables, load_tables
+
+
+def series_store(args):
+    if not args.series_cache:
+        return None
+    from .materialise import SeriesStore
+    return SeriesStore(max_bytes=args.series_cache_size * 2 ** 20)
+
+
+def generate_dataset(args):
+    started = time.perf_counter()
+    dataset = DATASETS[args.dataset]()
+    store = series_store(args)
+    if args.shards > 1:
+        from .shards import run_sharded
+        arrow_tables = load_arrow_tables(args.tables)
+        n_patients = len(np.unique(np.concatenate([t.column("patient_id").to_numpy() for t in arrow_tables.values()])))
+        loaded = time.perf_counter()
+        patient_ids, columns = run_sharded(arrow_tables, args.dataset, args.shards, workers=args.workers, fused=args.fused)
+    else:
+        db = load_tables(args.tables)
+        n_patients = db.n_patients
+        loaded = time.perf_counter()
+        if args.profile:
+            from .profile import profile_dataset
+            patient_ids, columns, report = profile_dataset(db, dataset, fused=args.fused)
+        elif args.risk_set:
+            from .riskset import run_risk_set
+            patient_ids, columns = run_risk_set(db, dataset, RISK_SETS[args.dataset], seed=args.seed, fused=args.fused)
+        elif args.incremental:
+            from .incremental import run_incremental
+            kinds = {name: kind_of(node) for name, node in dataset.variables.items()}
+            patient_ids, columns, summary = run_incremental(db, dataset, args.dataset, args.incremental, kinds, fused=args.fused)
+            new_rows = sum(summary.get("rows_after_watermark", {}).values())
+            print(f"{summary['mode']}: {summary['changed']} of {summary['patients']} patients changed, {new_rows} rows after the last watermark")
+        else:
+            patient_ids, columns = run_dataset(db, dataset, fused=args.fused, store=store, pushdown=not args.no_pushdown)
+    kinds = {name: kind_of(node) for name, node in dataset.variables.items()}
+    if args.risk_set:
+        kinds = {"set_id": "int", **kinds}
+    evaluated = time.perf_counter()
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_dataset(
+        args.output, patient_ids, columns, kinds,
+        gzip_level=args.gzip_level, gzip_threads=args.gzip_threads, gzip_queue=args.gzip_queue,
+    )
+    finished = time.perf_counter()
+    print(
+        f"{args.dataset}: {len(patient_ids)} of {n_patients} patients, "
+        f"load {loaded - started:.2f}s, evaluate+write {finished - loaded:.2f}s"
+    )
+    if store is not None:
+        print(store.summary())
+    if args.dedupe_report:
+        from .canonical import dedupe_report, summary, write_report
+        dedupe = dedupe_report(dataset)
+        path = write_report(args.output, dedupe, command="generate-dataset", definition=args.dataset)
+        print(
+            f"{dedupe['written_nodes']} distinct nodes as written, {dedupe['canonical_nodes']} canonical "
+            f"({dedupe['merged']} merged); most shared:\n{summary(dedupe)}\ndedupe report written to {path}"
+        )
+    if args.profile:
+        from .profile import summary, write_report
+        path = write_report(
+            args.output, report, command="generate-dataset", definition=args.dataset, tables=str(args.tables),
+            fused=args.fused, load_seconds=round(loaded - started, 6), write_seconds=round(finished - evaluated, 6),
+        )
+        print(f"slowest variables:\n{summary(report, 'variables')}\nprofile written to {path}")
+
+
+def generate_measures(args):
+    started = time.perf_counter()
+    store = series_store(args)
+    db = load_tables(args.tables)
+    loaded = time.perf_counter()
+    measures, (starts, ends) = MEASURES[args.measures]()
+    if args.profile:
+        from .profile import profile_measures
+        rows, report = profile_measures(db, measures, starts, ends)
+    elif args.blocks > 1:
+        from .blocks import run_blocked
+        rows = run_blocked(db, measures, starts, ends, args.blocks, workers=args.workers)
+    else:
+        rows = run_measures(db, measures, starts, ends, store=store)
+    evaluated = time.perf_counter()
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    write_measures(args.output, rows)
+    finished = time.perf_counter()
+    print(
+        f"{args.measures}: {len(measures)} measures x {len(starts)} intervals, "
+        f"load {loaded - started:.2f}s, evaluate+write {finished - loaded:.2f}s"
+    )
+    if store is not None:
+        print(store.summary())
+    if args.profile:
+        from .profile import summary, write_report
+        path = write_report(
+            args.output, report, command="generate-measures", definition=args.measures, tables=str(args.tables),
+            load_seconds=round(loaded - started, 6), write_seconds=round(finished - evaluated, 6),
+        )
+        print(f"slowest measures:\n{summary(report, 'measures')}\nprofile written to {path}")
+
+
+def show(args):
+    from .preview import show
+    dataset = DATASETS[args.dataset]()
+    for name in args.variables:
+        if name not in dataset.variables:
+            raise SystemExit(f"{args.dataset} has no variable {name}")
+    value = {name: dataset.variables[name] for name in args.variables} if args.variables else dataset
+    show(value, tables=args.tables, n=args.sample, seed=args.seed, rows=args.rows)
+
+
+def generate_dummy_tables(args):
+    from .dummy import generate_tables
+    started = time.perf_counter()
+    prevalence = {}
+    for item in args.prevalence:
+        name, _, value = item.partition("=")
+        prevalence[name] = float(value)
+    events = {}
+    for item in args.events_per_patient:
+        name, _, value = item.partition("=")
+        events[name] = float(value)
+    cached, hit = generate_tables(
+        args.definition, args.output, args.population_size, seed=args.seed, prevalence=prevalence,
+        events_per_patient=events, file_format=args.format, use_cache=not args.no_cache,
+    )
+    print(
+        f"{args.definition}: {args.population_size:,} patients to {args.output} "
+        f"({'cached' if hit else 'generated'}) in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="run_engine.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    dataset = commands.add_parser("generate-dataset", help="evaluate a mirrored dataset definition")
+    dataset.add_argument("dataset", choices=sorted(DATASETS))
+    dataset.add_argument("--tables", default="dummy_tables", help="directory of TPP-shaped tables")
+    dataset.add_argument("--output", required=True, help=".csv, .csv.gz, .arrow or .parquet")
+    dataset.add_argument("--gzip-level", type=int, default=6, help="compression level for .csv.gz (default 6)")
+    dataset.add_argument("--gzip-threads", type=positive_int, help="threads compressing .csv.gz blocks (default: one per CPU)")
+    dataset.add_argument("--gzip-queue", type=positive_int, help="most 4MiB blocks in flight for .csv.gz (default: twice the threads)")
+    dataset.add_argument("--no-fused", dest="fused", action="store_false", help="evaluate codelist flags through the per-codelist windows index, not one pass per table")
+    dataset.add_argument("--no-pushdown", action="store_true", help="evaluate every variable for all patients, not just the population")
+    dataset.add_argument("--shards", type=positive_int, default=1, help="hash-partition patients and evaluate the shards in worker processes")
+    dataset.add_argument("--workers", type=positive_int, help="worker processes for --shards (default: one per shard)")
+    dataset.add_argument("--incremental", metavar="STATE_DIR", help="keep results in STATE_DIR and only re-evaluate patients whose rows changed")
+    dataset.add_argument("--risk-set", action="store_true", help="sample matches_per_case controls from each case's risk set and only evaluate those")
+    dataset.add_argument("--seed", type=int, default=1, help="for --risk-set")
+    dataset.add_argument("--profile", action="store_true", help="write per-variable time, rows scanned and peak memory to <output>.profile.json")
+    dataset.add_argument("--dedupe-report", action="store_true", help="write the subexpressions shared across variables to <output>.dedupe.json")
+    dataset.add_argument("--series-cache", action="store_true", help="reuse exists/count/first/last series materialised by earlier runs (SERIES_CACHE_DIR)")
+    dataset.add_argument("--series-cache-size", type=int, default=1024, metavar="MB", help="evict least recently used series above this size (default 1024)")
+    dataset.set_defaults(run=generate_dataset)
+
+    measures = commands.add_parser("generate-measures", help="evaluate mirrored measures over all intervals in one sweep")
+    measures.add_argument("measures", choices=sorted(MEASURES))
+    measures.add_argument("--tables", default="dummy_tables", help="directory of TPP-shaped tables")
+    measures.add_argument("--output", required=True)
+    measures.add_argument("--blocks", type=positive_int, default=1, help="split the intervals into blocks and evaluate them in worker processes")
+    measures.add_argument("--workers", type=positive_int, help="worker processes for --blocks (default: one per CPU)")
+    measures.add_argument("--profile", action="store_true", help="write per-measure time, rows scanned and peak memory to <output>.profile.json")
+    measures.add_argument("--series-cache", action="store_true", help="reuse numerator/denominator series materialised by earlier runs (SERIES_CACHE_DIR)")
+    measures.add_argument("--series-cache-size", type=int, default=1024, metavar="MB", help="evict least recently used series above this size (default 1024)")
+    measures.set_defaults(run=generate_measures)
+
+    preview = commands.add_parser("show", help="evaluate variables (default: the whole dataset) for a random sample of patients and summarise them")
+    preview.add_argument("dataset", choices=sorted(DATASETS))
+    preview.add_argument("variables", nargs="*", help="variables to show, for every sampled patient rather than the population")
+    preview.add_argument("--tables", default="dummy_tables", help="directory of TPP-shaped tables (.arrow reads fastest)")
+    preview.add_argument("--sample", type=positive_int, default=1000, help="patients to sample (default 1000)")
+    preview.add_argument("--seed", type=int, default=1)
+    preview.add_argument("--rows", type=int, default=10, help="rows to print (default 10)")
+    preview.set_defaults(run=show)
+
+    dummy = commands.add_parser("generate-dummy-tables", help="write dummy TPP tables drawing codes from a definition's codelists")
+    dummy.add_argument("definition", choices=sorted({*DATASETS, *MEASURES}))
+    dummy.add_argument("--population-size", type=int, default=10000)
+    dummy.add_argument("--output", required=True, help="directory for <table>.csv (or .arrow)")
+    dummy.add_argument("--seed", type=int, default=1)
+    dummy.add_argument("--prevalence", action="append", default=[], metavar="CODELIST=P", help="share of patients with an event from CODELIST (default 0.05)")
+    dummy.add_argument("--events-per-patient", action="append", default=[], metavar="TABLE=N", help="mean background events per patient")
+    dummy.add_argument("--format", choices=["csv", "csv.gz", "arrow"], default="csv")
+    dummy.add_argument("--no-cache", action="store_true")
+    dummy.set_defaults(run=generate_dummy_tables)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "profile", False) and getattr(args, "shards", 1) > 1:
+        parser.error("--profile runs in one process; drop --shards")
+    if getattr(args, "blocks", 1) > 1 and (args.profile or args.series_cache):
+        parser.error("--blocks can't be combined with --profile or --series-cache")
+    if getattr(args, "incremental", None) and (args.shards > 1 or args.profile):
+        parser.error("--incremental can't be combined with --shards or --profile")
+    if getattr(args, "risk_set", False):
+        if args.dataset not in RISK_SETS:
+            parser.error(f"--risk-set needs a RISK_SETS entry for {args.dataset} in engine/study.py")
+        if args.shards > 1 or args.profile or args.incremental or args.series_cache:
+            parser.error("--risk-set can't be combined with --shards, --profile, --incremental or --series-cache")
+    if getattr(args, "series_cache", False) and (getattr(args, "shards", 1) > 1 or args.profile or getattr(args, "incremental", None)):
+        parser.error("--series-cache can't be combined with --shards, --profile or --incremental")
+    args.run(args)
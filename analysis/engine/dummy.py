@@ -0,0 +1,245 @@
+######################################
+
+# Dummy TPP tables for large populations, built from the definitions' codelists
+
+#python analysis/run_engine.py generate-dummy-tables ctc_tendinitis --population-size 1000000 --output dummy_tables_1m
+
+# ehrql's own dummy data is slow past a few thousand patients and rarely hits our rare
+# outcome codes, so the CTC/measures paths go untested. Here every table is built a
+# column at a time with numpy, and coded events are drawn straight from the codelists
+# the definition uses: each codelist gets a prevalence (share of patients with at least
+# one event from it), the rest of the events are format-valid codes that are in none of
+# the lists. As in real records, events per patient are over-dispersed (most patients
+# have a few, some have many) and a few codes make up most events. The output directory
+# can be used with the local engine (--tables) or with ehrql (--dummy-tables).
+
+# Generated tables are cached in .dummy_cache/ (DUMMY_CACHE_DIR) keyed by the
+# definition's codelists, the population size, seed and prevalences, so re-runs only
+# copy them out.
+
+######################################
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pyarrow.feather as feather
+
+from .materialise import codelist_digest
+from .query import Codes, Column, Function, walk
+from .tables import SCHEMAS, Table, write_arrow, write_table
+
+CACHE_DIR = Path(os.environ.get("DUMMY_CACHE_DIR", Path(__file__).resolve().parents[2] / ".dummy_cache"))
+#Bump when the generator changes, so old cached tables aren't reused
+VERSION = 2
+
+DEFAULT_PREVALENCE = 0.05
+#Background (non-codelist) events per patient
+DEFAULT_EVENTS_PER_PATIENT = {"medications": 10, "clinical_events": 10, "apcs": 0.5}
+#Gamma shape of the gamma-Poisson events per patient - smaller is more spread out
+EVENT_DISPERSION = 0.5
+#Zipf exponent of code frequencies within a codelist or the background codes
+CODE_SKEW = 1.1
+
+START = np.datetime64("2000-01-01")
+END = np.datetime64("2024-08-01")
+
+CODE_COLUMNS = {"medications": ["dmd_code"], "clinical_events": ["snomedct_code", "ctv3_code"]}
+
+
+def referenced_codelists(definition):
+    #-> {(table, code column): sorted codelist names} used by a dataset or measures definition
+    from .study import DATASETS, MEASURES
+    found = {}
+    if definition in DATASETS:
+        dataset = DATASETS[definition]()
+        for node in walk([dataset.population, *dataset.variables.values()]):
+            if isinstance(node, Function) and node.op == "is_in" and isinstance(node.args[0], Column):
+                column = node.args[0]
+                found.setdefault((column.table, column.name), set()).update(node.args[1].names)
+    else:
+        measures, _ = MEASURES[definition]()
+        parts = [part for m in measures for part in (m.numerator, m.denominator)]
+        parts += [part.date for part in parts if hasattr(part, "date")]
+        for part in parts:
+            if isinstance(getattr(part, "codes", None), Codes):
+                found.setdefault((part.table, part.code_column), set()).update(part.codes.names)
+    return {key: sorted(names) for key, names in sorted(found.items())}
+
+
+def cache_key(definition, population_size, seed, prevalence, events_per_patient):
+    import codelists
+    listed = referenced_codelists(definition)
+    #The CSVs' own content, so a codelist edited by hand isn't served from an old cache
+    digests = {name: codelist_digest(codelists, name) for names in listed.values() for name in names}
+    spec = {
+        "version": VERSION,
+        "definition": definition,
+        "codelists": {f"{table}.{column}": names for (table, column), names in listed.items()},
+        "digests": digests,
+        "population_size": population_size,
+        "seed": seed,
+        "prevalence": prevalence,
+        "events_per_patient": events_per_patient,
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def random_dates(rng, low, high):
+    #Uniform date in [low, high] per row; low/high are datetime64[D] arrays
+    span = np.maximum((high - low).astype(np.int64), 0)
+    return low + (rng.random(len(low)) * (span + 1)).astype(np.int64).astype("timedelta64[D]")
+
+
+def event_counts(rng, mean, n):
+    return rng.poisson(rng.gamma(EVENT_DISPERSION, mean / EVENT_DISPERSION, n))
+
+
+def skewed_picks(rng, n_codes, size):
+    #Indices into a list of codes with Zipf-like frequencies; which codes are common is random
+    weights = 1.0 / np.arange(1, n_codes + 1) ** CODE_SKEW
+    return rng.permutation(n_codes)[rng.choice(n_codes, size, p=weights / weights.sum())]
+
+
+def noise_codes(rng, column, n, exclude):
+    #Codes in the right format for the column that are in none of the codelists
+    if column == "ctv3_code":
+        alphabet = np.array(list("ABCDEFGHJKLMNPQRSTUVWXYZabcdefghjkmnpqrstuvwxyz0123456789"))
+        codes = np.array(["".join(row) for row in alphabet[rng.integers(0, len(alphabet), (n, 5))]], dtype=object)
+    else:
+        codes = np.array([str(v) for v in rng.integers(10 ** 14, 10 ** 15, n)], dtype=object)
+    exclude = set(exclude)
+    return np.array(sorted({code for code in codes if code not in exclude}), dtype=object)
+
+
+def generate(definition, population_size, seed=1, prevalence=None, events_per_patient=None):
+    #-> {table name: Table}
+    import codelists
+    rng = np.random.default_rng(seed)
+    prevalence = prevalence or {}
+    events_per_patient = {**DEFAULT_EVENTS_PER_PATIENT, **(events_per_patient or {})}
+    n = population_size
+    patient_id = np.arange(1, n + 1, dtype=np.int64)
+    tables = {}
+
+    #patients - date of birth is the first of the month, as in TPP
+    months = rng.integers(0, (2015 - 1920) * 12, n)
+    date_of_birth = (np.datetime64("1920-01") + months.astype("timedelta64[M]")).astype("datetime64[D]")
+    sex = np.array(["female", "male", "intersex", "unknown"], dtype=object)[
+        rng.choice(4, n, p=[0.5, 0.48, 0.005, 0.015])
+    ]
+    tables["patients"] = Table("patients", {"patient_id": patient_id, "date_of_birth": date_of_birth, "sex": sex})
+    earliest = np.maximum(date_of_birth, START)
+
+    #practice_registrations - one spell each; a quarter end, and half of those re-register
+    first_start = random_dates(rng, np.maximum(date_of_birth, np.datetime64("1990-01-01")), np.full(n, np.datetime64("2015-01-01")))
+    first_end = np.full(n, np.datetime64("NaT"), dtype="datetime64[D]")
+    ends = rng.random(n) < 0.25
+    first_end[ends] = first_start[ends] + rng.integers(365, 8000, ends.sum()).astype("timedelta64[D]")
+    again = np.flatnonzero(ends & (rng.random(n) < 0.5))
+    second_start = first_end[again] + rng.integers(0, 400, len(again)).astype("timedelta64[D]")
+    tables["practice_registrations"] = Table("practice_registrations", {
+        "patient_id": np.r_[patient_id, patient_id[again]],
+        "start_date": np.r_[first_start, second_start],
+        "end_date": np.r_[first_end, np.full(len(again), np.datetime64("NaT"), dtype="datetime64[D]")],
+    })
+
+    #addresses - one from registration, a third move once
+    moves = np.flatnonzero(rng.random(n) < 0.33)
+    move_date = random_dates(rng, first_start[moves], np.full(len(moves), END))
+    end_date = np.full(n, np.datetime64("NaT"), dtype="datetime64[D]")
+    end_date[moves] = move_date
+    address_patients = np.r_[patient_id, patient_id[moves]]
+    m = len(address_patients)
+    tables["addresses"] = Table("addresses", {
+        "patient_id": address_patients,
+        "address_id": rng.integers(1, 10 ** 7, m),
+        "start_date": np.r_[first_start, move_date],
+        "end_date": np.r_[end_date, np.full(len(moves), np.datetime64("NaT"), dtype="datetime64[D]")],
+        "has_postcode": rng.random(m) < 0.95,
+        "imd_rounded": rng.integers(0, 329, m) * 100,
+    })
+
+    #ons_deaths
+    died = np.flatnonzero(rng.random(n) < 0.08)
+    tables["ons_deaths"] = Table("ons_deaths", {
+        "patient_id": patient_id[died],
+        "date": random_dates(rng, earliest[died], np.full(len(died), END)),
+    })
+
+    #apcs
+    counts = event_counts(rng, events_per_patient["apcs"], n)
+    rows = np.repeat(np.arange(n), counts)
+    tables["apcs"] = Table("apcs", {
+        "patient_id": patient_id[rows],
+        "admission_date": random_dates(rng, earliest[rows], np.full(len(rows), END)),
+    })
+
+    #medications / clinical_events - codelist hits at each list's prevalence, plus background events
+    listed = referenced_codelists(definition)
+    for table, code_columns in CODE_COLUMNS.items():
+        every_code = {column: set() for column in code_columns}
+        hits = []
+        for column in code_columns:
+            for name in listed.get((table, column), []):
+                codes = getattr(codelists, name)
+                codes = np.array(sorted(codes), dtype=object)
+                every_code[column].update(codes)
+                has = np.flatnonzero(rng.random(n) < prevalence.get(name, DEFAULT_PREVALENCE))
+                rows = np.repeat(has, 1 + rng.poisson(0.5, len(has)))
+                hits.append((column, rows, codes[skewed_picks(rng, len(codes), len(rows))]))
+        background = np.repeat(np.arange(n), event_counts(rng, events_per_patient[table], n))
+        noise = {column: noise_codes(rng, column, 5000, every_code[column]) for column in code_columns}
+
+        rows = np.concatenate([background] + [r for _, r, _ in hits])
+        columns = {"patient_id": patient_id[rows], "date": random_dates(rng, earliest[rows], np.full(len(rows), END))}
+        for column in code_columns:
+            #Every row gets a noise code, then codelist hits overwrite their own column
+            values = noise[column][skewed_picks(rng, len(noise[column]), len(rows))]
+            offset = len(background)
+            for hit_column, hit_rows, hit_codes in hits:
+                if hit_column == column:
+                    values[offset:offset + len(hit_rows)] = hit_codes
+                offset += len(hit_rows)
+            columns[column] = values
+        if table == "clinical_events":
+            numeric_value = np.round(rng.normal(27, 5, len(rows)), 1)
+            numeric_value[rng.random(len(rows)) < 0.2] = np.nan
+            columns["numeric_value"] = numeric_value
+        tables[table] = Table(table, columns).sorted()
+
+    return {name: tables[name] for name in SCHEMAS}
+
+
+def generate_tables(definition, output, population_size, seed=1, prevalence=None, events_per_patient=None, file_format="csv", use_cache=True):
+    #Writes <table>.<file_format> for each table to `output`; -> (cache directory, whether it was a cache hit)
+    key = cache_key(definition, population_size, seed, prevalence or {}, events_per_patient or {})
+    cached = CACHE_DIR / f"{definition}-{population_size}-{key}"
+    hit = use_cache and all((cached / f"{name}.arrow").exists() for name in SCHEMAS)
+    if hit:
+        tables = None
+    else:
+        tables = generate(definition, population_size, seed, prevalence, events_per_patient)
+        if use_cache:
+            tmp = cached.with_name(cached.name + f".tmp{os.getpid()}")
+            tmp.mkdir(parents=True, exist_ok=True)
+            for name, table in tables.items():
+                write_table(tmp / f"{name}.arrow", table)
+            shutil.rmtree(cached, ignore_errors=True)
+            tmp.rename(cached)
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    for name in SCHEMAS:
+        path = output / f"{name}.{file_format}"
+        if tables is not None:
+            write_table(path, tables[name])
+        elif file_format == "arrow":
+            shutil.copyfile(cached / f"{name}.arrow", path)
+        else:
+            #Straight from the cached arrow file, without going through numpy
+            write_arrow(path, feather.read_table(cached / f"{name}.arrow"))
+    return cached, hit
@@ -0,0 +1,341 @@
+######################################
+
+# Evaluates query nodes over a Database
+
+# Patient-level results are numpy arrays aligned with db.patient_ids and are cached by
+# node, so a series used by several variables (eg. first_cohort_abx_rx) is computed once.
+# Frames evaluate to sorted row indices into their table.
+
+# Nulls follow the table kinds: NaT for dates, NaN for numbers, None for codes. Boolean
+# results have no null - a comparison with a null is false, which is what ehrql's
+# where()/except_where() do with a null condition.
+
+######################################
+
+import numpy as np
+
+from .query import Codes, Column, Count, Events, Exists, Function, Pick, Value, frame_table, row_table, walk
+from .tables import PATIENT_TABLES, is_null, null_value
+from .top1 import top1
+
+
+class Evaluator:
+    def __init__(self, db, fused=True, store=None, plain=False):
+        self.db = db
+        self.fused = fused
+        #Every node evaluated as written - no indexes, grouped passes or top1: the reference
+        #the other paths are checked against (tests/, benchmarks/)
+        self.plain = plain
+        self.store = store #engine/materialise.py SeriesStore, or None
+        self.cache = {}
+        self.frames = {}
+        self.codes = {}
+        self.lookups = {}
+
+    def evaluate(self, node):
+        if node not in self.cache:
+            result = self._patient(node)
+            if np.ndim(result) == 0:
+                #Only literals in it, eg. start_date + years(1)
+                result = np.full(self.db.n_patients, result)
+            self.cache[node] = result
+        return self.cache[node]
+
+    def evaluate_all(self, nodes):
+        stored = {}
+        if self.store is not None:
+            #Aggregates another action (or an earlier run) already materialised
+            for node in walk(nodes):
+                if isinstance(node, (Exists, Count, Pick)):
+                    key = stored[node] = self.store.key(self.db, node)
+                    value = None if key is None else self.store.get(node, key)
+                    if value is not None:
+                        self.cache[node] = value
+        missing = [node for node, key in stored.items() if key is not None and node not in self.cache]
+        self.grouped(walk(nodes))
+        results = [self.evaluate_target(node) for node in nodes]
+        for node in missing:
+            if node in self.cache:
+                self.store.put(node, stored[node], self.cache[node])
+        return results
+
+    def grouped(self, nodes):
+        #Passes that answer several of `nodes` at once, before any is evaluated by itself
+        if self.fused and not self.plain:
+            from .fused import evaluate_fused
+            evaluate_fused(self, nodes)
+        if not self.plain:
+            #Several windows back from one index date in one pass - see engine/lookback.py
+            from .lookback import evaluate_lookbacks
+            evaluate_lookbacks(self, nodes)
+            from .windows import build_indexes
+            build_indexes(self, nodes)
+
+    def evaluate_target(self, node):
+        #One of the nodes asked for by evaluate_all (engine/profile.py times each)
+        return self.evaluate(node)
+
+    def spawn(self, db):
+        #An evaluator like this one over another database - see engine/pushdown.py
+        return type(self)(db, fused=self.fused, plain=self.plain)
+
+    def rows(self, frame):
+        #Row indices (ascending, so grouped by patient and in date order) of a frame
+        if frame not in self.frames:
+            if isinstance(frame, Events):
+                self.frames[frame] = np.arange(len(self.db[frame.table]))
+            else:
+                rows = self.rows(frame.source)
+                condition = self.values(frame.condition, frame_table(frame), rows)
+                self.frames[frame] = rows[~condition] if frame.exclude else rows[condition]
+        return self.frames[frame]
+
+    def resolve(self, codes):
+        if codes not in self.codes:
+            self.codes[codes] = codes.resolve()
+        return self.codes[codes]
+
+    def lookup(self, op, column, codes):
+        #Codelist compiled against an encoded column's vocabulary - see engine/tables.py
+        key = (op, column, codes)
+        if key not in self.lookups:
+            self.lookups[key] = self.db[column.table].compile(column.name, self.resolve(codes), categorise=op == "to_category")
+        return self.lookups[key]
+
+    def values(self, node, table, rows):
+        #Values of `node` for the given rows of `table`; patient-level nodes are broadcast
+        if isinstance(node, (Value, Codes)) or row_table(node) is None:
+            values = self.argument(node)
+            if isinstance(values, np.ndarray):
+                return values[self.db.pidx(table)[rows]]
+            return values
+        if isinstance(node, Column):
+            if node.name in self.db[node.table].vocabularies:
+                return self.db[node.table].decode(node.name, self.db[node.table][node.name][rows])
+            return self.db[node.table][node.name][rows]
+        if is_code_lookup(node, self.db):
+            column = node.args[0]
+            return self.lookup(node.op, column, node.args[1])[self.db[column.table][column.name][rows]]
+        return self.apply(node.op, [self.values(arg, table, rows) for arg in node.args])
+
+    def argument(self, node):
+        #Literals stay scalars, codelists are resolved by apply()
+        if isinstance(node, Value):
+            return node.value
+        if isinstance(node, Codes):
+            return node
+        return self.evaluate(node)
+
+    def _patient(self, node):
+        db = self.db
+        if isinstance(node, Value):
+            return np.full(db.n_patients, node.value)
+        if isinstance(node, Column):
+            return db.patient_column(node.table, node.name)
+        if not self.plain:
+            indexed = self.indexed(node)
+            if indexed is not None:
+                return indexed
+        if isinstance(node, Exists):
+            table = frame_table(node.source)
+            out = np.zeros(db.n_patients, dtype=bool)
+            if table in PATIENT_TABLES:
+                out[db.pidx(table)] = True
+            else:
+                out[db.pidx(table)[self.rows(node.source)]] = True
+            return out
+        if isinstance(node, Count):
+            table = frame_table(node.source)
+            return np.bincount(db.pidx(table)[self.rows(node.source)], minlength=db.n_patients)
+        if isinstance(node, Pick):
+            return self.pick(node)
+        if isinstance(node, Function):
+            return self.apply(node.op, [self.argument(arg) for arg in node.args])
+        raise TypeError(node)
+
+    def indexed(self, node):
+        #Result from an index over the rows, or None to evaluate the node as written
+        if isinstance(node, Exists) and frame_table(node.source) == "practice_registrations":
+            from .registrations import evaluate_covers
+            covered = evaluate_covers(self, node)
+            if covered is not None:
+                return covered
+        if isinstance(node, (Exists, Count)):
+            from .windows import evaluate_window
+            windowed = evaluate_window(self, node)
+            if windowed is not None:
+                return windowed
+        if isinstance(node, (Exists, Count, Pick)) or (isinstance(node, Function) and node.op == "to_category"):
+            #Status/ever/last-date queries over a categorised codelist - see engine/timeline.py
+            from .timeline import evaluate_timeline
+            return evaluate_timeline(self, node)
+        return None
+
+    def pick(self, node):
+        table = frame_table(node.source)
+        rows = self.rows(node.source)
+        pidx = self.db.pidx(table)[rows]
+        sort_values = self.db[table][node.sort_column][rows]
+        #Each patient's first/last row by the sort column, without sorting - see engine/top1.py
+        chosen = None if self.plain else top1(pidx, sort_values, self.db.n_patients, last=node.last)
+        if chosen is None:
+            #Sort values with no int64 key: order within patient (rows are grouped by patient)
+            order = np.lexsort((sort_values, pidx))
+            grouped = pidx[order]
+            edges = np.r_[grouped[1:] != grouped[:-1], True] if node.last else np.r_[True, grouped[1:] != grouped[:-1]]
+            chosen = order[np.flatnonzero(edges)] if len(pidx) else pidx
+        values = self.db[table][node.column]
+        if node.column in self.db[table].vocabularies:
+            out = np.full(self.db.n_patients, None, dtype=object)
+            out[pidx[chosen]] = self.db[table].decode(node.column, values[rows[chosen]])
+            return out
+        if values.dtype.kind in "iu":
+            values = values.astype(float) #patients with no row get NaN
+        out = np.full(self.db.n_patients, null_value(values.dtype), dtype=values.dtype)
+        out[pidx[chosen]] = values[rows[chosen]]
+        return out
+
+    def apply(self, op, args):
+        if isinstance(args[-1], Codes):
+            args = args[:-1] + [self.resolve(args[-1])]
+        return OPS[op](*args)
+
+
+def is_code_lookup(node, db):
+    #is_in/to_category of an encoded code column against a codelist
+    return (
+        isinstance(node, Function)
+        and node.op in ("is_in", "to_category")
+        and isinstance(node.args[0], Column)
+        and node.args[0].name in db[node.args[0].table].vocabularies
+        and isinstance(node.args[1], Codes)
+    )
+
+
+def not_null(values):
+    if isinstance(values, np.ndarray):
+        return ~is_null(values)
+    return values is not None and not (isinstance(values, np.datetime64) and np.isnat(values))
+
+
+def compare(fn):
+    def op(a, b):
+        with np.errstate(invalid="ignore"):
+            return fn(a, b) & not_null(a) & not_null(b)
+    return op
+
+
+def is_in(values, codelist):
+    codelist = set(codelist)
+    return np.fromiter((v in codelist for v in values), dtype=bool, count=len(values))
+
+
+def to_category(values, codelist):
+    return np.fromiter((codelist.get(v) for v in values), dtype=object, count=len(values))
+
+
+def add_days(dates, n):
+    n = np.asarray(n)
+    if n.dtype.kind == "f":
+        #A null number of days gives a null date
+        return np.where(np.isnan(n), np.datetime64("NaT"), dates + np.nan_to_num(n).astype("timedelta64[D]"))
+    return dates + n.astype("timedelta64[D]")
+
+
+def add_months(dates, n):
+    #As ehrql: a day that doesn't exist in the target month rolls on to the 1st of the next
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    month_starts = dates.astype("datetime64[M]")
+    day = (dates - month_starts).astype(int)
+    target = month_starts + np.asarray(n).astype("timedelta64[M]")
+    month_length = ((target + 1).astype("datetime64[D]") - target.astype("datetime64[D]")).astype(int)
+    result = np.where(
+        day < month_length,
+        target.astype("datetime64[D]") + day.astype("timedelta64[D]"),
+        (target + 1).astype("datetime64[D]"),
+    )
+    return np.where(np.isnat(dates), np.datetime64("NaT"), result)
+
+
+def date_part(part):
+    def op(dates):
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        years = dates.astype("datetime64[Y]")
+        if part == "year":
+            values = years.astype(int) + 1970
+        elif part == "month":
+            values = (dates.astype("datetime64[M]") - years).astype(int) + 1
+        else:
+            values = (dates - dates.astype("datetime64[M]")).astype(int) + 1
+        return np.where(np.isnat(dates), np.nan, values)
+    return op
+
+
+def age_on(date_of_birth, dates):
+    year, month, day = (date_part(p) for p in ("year", "month", "day"))
+    age = year(dates) - year(date_of_birth)
+    birthday_to_come = (month(dates) < month(date_of_birth)) | (
+        (month(dates) == month(date_of_birth)) & (day(dates) < day(date_of_birth))
+    )
+    return age - birthday_to_come
+
+
+def imd_decile(imd_rounded):
+    #imd_rounded is the rank (to nearest 100) out of 32,844 LSOAs
+    decile = np.floor(np.asarray(imd_rounded, dtype=float) * 10 / 32844) + 1
+    return np.where(np.isnan(decile), np.nan, np.minimum(decile, 10))
+
+
+OPS = {
+    "and": np.logical_and,
+    "or": np.logical_or,
+    "not": np.logical_not,
+    "eq": compare(np.equal),
+    "ne": compare(np.not_equal),
+    "lt": compare(np.less),
+    "le": compare(np.less_equal),
+    "gt": compare(np.greater),
+    "ge": compare(np.greater_equal),
+    "between": lambda x, low, high: compare(np.greater_equal)(x, low) & compare(np.less_equal)(x, high),
+    "is_null": lambda x: ~not_null(x),
+    "is_not_null": not_null,
+    "is_in": is_in,
+    "to_category": to_category,
+    "add_days": add_days,
+    "add_months": add_months,
+    "year": date_part("year"),
+    "month": date_part("month"),
+    "day": date_part("day"),
+    "age_on": age_on,
+    "imd_decile": imd_decile,
+    "if_else": lambda condition, a, b: np.where(condition, a, b),
+    "add": np.add,
+    "sub": np.subtract,
+    "mul": np.multiply,
+    "floordiv": np.floor_divide,
+}
+
+
+def run_dataset(db, dataset, fused=True, store=None, pushdown=True, plain=False, evaluator=None):
+    #-> (patient_ids, {variable: values}) for patients in the population. evaluator: an
+    #Evaluator over db to run with (engine/profile.py's), in place of fused/store/plain
+    from .canonical import canonical_dataset
+    #Equivalent subtrees written differently are evaluated once - see engine/canonical.py
+    dataset = canonical_dataset(dataset)
+    if evaluator is None:
+        evaluator = Evaluator(db, fused=fused, store=store, plain=plain)
+    names = list(dataset.variables)
+    nodes = [dataset.variables[n] for n in names]
+    #Stored series are over all patients, so with a store everything is
+    if not pushdown or evaluator.store is not None:
+        population, *columns = evaluator.evaluate_all([dataset.population] + nodes)
+        keep = np.flatnonzero(population)
+        return db.patient_ids[keep], {name: values[keep] for name, values in zip(names, columns)}
+    from .pushdown import MAX_SHARE, restricted_evaluator
+    keep = np.flatnonzero(evaluator.evaluate_all([dataset.population])[0])
+    if len(keep) > MAX_SHARE * db.n_patients:
+        columns = evaluator.evaluate_all(nodes)
+        return db.patient_ids[keep], {name: values[keep] for name, values in zip(names, columns)}
+    #The rest only for the population - see engine/pushdown.py
+    columns = restricted_evaluator(evaluator, keep).evaluate_all(nodes)
+    return db.patient_ids[keep], dict(zip(names, columns))
@@ -0,0 +1,125 @@
+######################################
+
+# Fused evaluation of codelist flags
+
+# The cohort asks ~20 times "is there an event with a code in X before the index date"
+# (the has_* comorbidities, harmful_alcohol, allergy, prior outcome). One at a time,
+# each is a full pass over clinical_events with a string lookup per row.
+
+# By default (--no-fused turns it off) those Exists nodes are grouped by table, date
+# column, index date and any other conditions. Each group is one pass: each row's code id
+# picks its bitmask from an array built from all the group's codelists, the rows with any
+# bit set are cut to the index date, and their masks are OR-ed per patient. Each flag is
+# then one bit of that mask. For the cohort's 21 flags over 10M events (benchmarks/fused_codelists.py) that is
+# 0.16s, against 0.22s through a windows index per codelist and 0.97s one at a time.
+
+######################################
+
+import numpy as np
+
+from .query import Codes, Column, Events, Exists, Filter, Function, flatten, row_table
+
+MAX_FLAGS = 64 #bits in a uint64 mask; bigger groups are done in chunks
+
+
+def is_code_test(condition, table):
+    return (
+        isinstance(condition, Function)
+        and condition.op == "is_in"
+        and isinstance(condition.args[0], Column)
+        and condition.args[0].table == table
+        and isinstance(condition.args[1], Codes)
+    )
+
+
+def is_index_test(condition, table):
+    return (
+        isinstance(condition, Function)
+        and condition.op in ("lt", "le")
+        and isinstance(condition.args[0], Column)
+        and condition.args[0].table == table
+        and row_table(condition.args[1]) is None
+    )
+
+
+def fusable(node):
+    #(group key, code column, codes, "lt"/"le") for Exists(<code is_in> & <date before index> & ...)
+    if not isinstance(node, Exists):
+        return None
+    table, conditions = flatten(node.source)
+    if any(exclude for _, exclude in conditions):
+        return None
+    code_tests = [c for c, _ in conditions if is_code_test(c, table)]
+    index_tests = [c for c, _ in conditions if is_index_test(c, table)]
+    if len(code_tests) != 1 or len(index_tests) != 1:
+        return None
+    code_test, index_test = code_tests[0], index_tests[0]
+    others = frozenset(c for c, _ in conditions if c is not code_test and c is not index_test)
+    key = (table, index_test.args[0].name, index_test.args[1], others)
+    return key, code_test.args[0].name, code_test.args[1], index_test.op
+
+
+def find_groups(nodes):
+    groups = {}
+    for node in nodes:
+        match = fusable(node)
+        if match is not None:
+            key, *member = match
+            groups.setdefault(key, []).append((node, *member))
+    return {key: members for key, members in groups.items() if len(members) > 1}
+
+
+def evaluate_fused(evaluator, nodes):
+    #Fills evaluator.cache for every fusable Exists node in `nodes`
+    pending = [node for node in nodes if node not in evaluator.cache]
+    for key, members in find_groups(pending).items():
+        evaluate_group(evaluator, key, members)
+
+
+def evaluate_group(evaluator, key, members):
+    db = evaluator.db
+    table, date_column, index, others = key
+
+    frame = Events(table)
+    for condition in sorted(others, key=repr):
+        frame = Filter(frame, condition)
+    frame_rows = evaluator.rows(frame)
+    any_on_or_before = any(op == "le" for *_, op in members)
+
+    for chunk_start in range(0, len(members), MAX_FLAGS):
+        chunk = members[chunk_start:chunk_start + MAX_FLAGS]
+        masks = {}
+        on_or_before_bits = 0
+        for bit, (node, code_column, codes, op) in enumerate(chunk):
+            #Bitmask per vocabulary id of the code column, so each row is one gather
+            mask = masks.setdefault(code_column, np.zeros(len(db[table].vocabularies[code_column]), dtype=np.uint64))
+            mask[db[table].positions(code_column, evaluator.resolve(codes))] |= np.uint64(1 << bit)
+            if op == "le":
+                on_or_before_bits |= 1 << bit
+
+        #Only rows with a code in one of the codelists are compared with the index date
+        ids = {c: db[table][c] if isinstance(frame, Events) else db[table][c][frame_rows] for c in masks}
+        hit = np.zeros(len(frame_rows), dtype=bool)
+        for code_column, mask in masks.items():
+            hit |= (mask != 0)[ids[code_column]]
+        hits = np.flatnonzero(hit)
+        rows = frame_rows[hits]
+        bits = np.zeros(len(rows), dtype=np.uint64)
+        for code_column, mask in masks.items():
+            bits |= mask[ids[code_column][hits]]
+        dates = db[table][date_column][rows]
+        index_dates = evaluator.values(index, table, rows)
+        before = dates < index_dates
+        if any_on_or_before:
+            #Same-day rows only count for the <= flags
+            bits = np.where(before, bits, np.where(dates == index_dates, bits & np.uint64(on_or_before_bits), 0))
+        else:
+            bits = np.where(before, bits, 0)
+
+        pidx = db.pidx(table)[rows]
+        starts = np.flatnonzero(np.r_[True, pidx[1:] != pidx[:-1]]) if len(pidx) else pidx
+        patient_bits = np.zeros(db.n_patients, dtype=np.uint64)
+        if len(rows):
+            patient_bits[pidx[starts]] = np.bitwise_or.reduceat(bits, starts)
+        for bit, (node, *_) in enumerate(chunk):
+            evaluator.cache[node] = ((patient_bits >> np.uint64(bit)) & np.uint64(1)).astype(bool)
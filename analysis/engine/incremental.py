@@ -0,0 +1,225 @@
+######################################
+
+# Incremental re-extraction (generate-dataset --incremental STATE_DIR)
+
+#python analysis/run_engine.py generate-dataset cohort --tables tpp_extract --output output/dataset.arrow --incremental .incremental
+
+# Every variable is per patient, so a patient's results only change if their own rows
+# do. Alongside the output, STATE_DIR keeps the full results, a digest of each patient's
+# rows in the tables the definition reads, and the high-watermark (latest date) of each
+# of those tables. On the next run only patients whose digest differs - new rows, edited
+# or deleted rows, new or vanished patients - are re-evaluated, on a database cut down to
+# their rows, and their results are patched into the previous ones.
+
+# The digest, not the watermark, decides who is re-run: corrections to old records
+# don't move the watermark. The watermark is kept to report how many rows are new.
+# A change to the definition, its codelists or STATE_VERSION forces a full run.
+
+######################################
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from .evaluate import run_dataset
+from .materialise import codelist_digest
+from .output import read_arrow, write_arrow
+from .query import Codes, Column, Events, walk
+from .shards import merge
+from .tables import SCHEMAS, Database, encode_codes
+
+#Bump when engine results or the digest change, so old state isn't patched with new results
+STATE_VERSION = 1
+#Past this share of patients changed, a full run is cheaper than cutting down the database
+FULL_RUN_SHARE = 0.2
+
+
+def fingerprint(dataset):
+    #Changes with the definition and the content of its codelists
+    import codelists
+    nodes = walk([dataset.population, *dataset.variables.values()])
+    names = sorted({name for node in nodes if isinstance(node, Codes) for name in node.names})
+    spec = {
+        "version": STATE_VERSION,
+        "population": repr(dataset.population),
+        "variables": {name: repr(node) for name, node in dataset.variables.items()},
+        #The CSVs' content, so a hand-edited codelist forces a full run - see engine/materialise.py
+        "codelists": {name: codelist_digest(codelists, name) for name in names},
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def referenced_tables(dataset):
+    nodes = walk([dataset.population, *dataset.variables.values()])
+    return sorted({node.table for node in nodes if isinstance(node, (Events, Column))})
+
+
+def watermarks(db, tables):
+    #Latest date in each table, as an ISO date (None if it has none)
+    marks = {}
+    for name in tables:
+        latest = None
+        for column, kind in SCHEMAS[name].items():
+            if kind == "date" and column in db[name]:
+                dates = db[name][column]
+                dates = dates[~np.isnat(dates)]
+                if len(dates) and (latest is None or dates.max() > latest):
+                    latest = dates.max()
+        marks[name] = None if latest is None else str(latest)
+    return marks
+
+
+def rows_after(db, tables, marks):
+    #Rows dated after the previous watermark - just for the report
+    counts = {}
+    for name in tables:
+        after = np.zeros(len(db[name]), dtype=bool)
+        if marks.get(name):
+            for column, kind in SCHEMAS[name].items():
+                if kind == "date" and column in db[name]:
+                    after |= db[name][column] > np.datetime64(marks[name])
+        counts[name] = int(after.sum())
+    return counts
+
+
+def stable_hashes(values):
+    #uint64 per value, the same in every run (hash() is salted per process)
+    return np.array([
+        int.from_bytes(hashlib.blake2b(b"\0" if v is None else str(v).encode(), digest_size=8).digest(), "little")
+        for v in values
+    ], dtype=np.uint64)
+
+
+def mix(x):
+    #splitmix64 finaliser
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def column_hashes(table, column):
+    values = table[column]
+    if column in table.vocabularies:
+        return stable_hashes(table.vocabularies[column])[values]
+    if values.dtype.kind == "O":
+        if SCHEMAS[table.name].get(column) == "bool":
+            #Nullable bools (eg. addresses.has_postcode read from CSV): 0, 1, and 2 for null
+            return np.where(values == None, 2, values == True).astype(np.uint64)
+        ids, vocabulary = encode_codes(values)
+        return stable_hashes(vocabulary)[ids]
+    if values.dtype.kind in "Mf":
+        return values.view(np.uint64)
+    return values.astype(np.int64).view(np.uint64)
+
+
+def patient_digests(db, tables):
+    #uint64 per patient (aligned with db.patient_ids) over their rows in `tables` - row
+    #order doesn't matter, any added, removed or edited row changes it
+    with np.errstate(over="ignore"):
+        digests = np.zeros(db.n_patients, dtype=np.uint64)
+        for salt, name in enumerate(tables, 1):
+            table = db[name]
+            #Columns folded in FNV-style, then one mix per row
+            rows = np.full(len(table), np.uint64(salt))
+            for column in SCHEMAS[name]:
+                if column in table:
+                    rows *= np.uint64(0x100000001B3)
+                    rows += column_hashes(table, column)
+            rows = mix(rows)
+            pidx = db.pidx(name)
+            if len(pidx) and (pidx[1:] < pidx[:-1]).any():
+                #Event tables are sorted by patient already; patient tables may not be
+                order = np.argsort(pidx, kind="stable")
+                pidx, rows = pidx[order], rows[order]
+            per_patient = np.zeros(db.n_patients, dtype=np.uint64)
+            if len(pidx):
+                starts = np.flatnonzero(np.r_[True, pidx[1:] != pidx[:-1]])
+                per_patient[pidx[starts]] = np.add.reduceat(rows, starts)
+            digests += mix(per_patient ^ np.uint64(salt))
+    return digests
+
+
+def subset(db, patient_ids):
+    #Database of just these patients' rows
+    wanted = np.zeros(db.n_patients, dtype=bool)
+    wanted[np.searchsorted(db.patient_ids, patient_ids[np.isin(patient_ids, db.patient_ids)])] = True
+    return Database({name: table.take(np.flatnonzero(wanted[db.pidx(name)])) for name, table in db.tables.items()})
+
+
+class State:
+    def __init__(self, directory, name):
+        self.directory = Path(directory)
+        self.meta_path = self.directory / f"{name}.json"
+        self.results_path = self.directory / f"{name}.results.arrow"
+        self.digests_path = self.directory / f"{name}.digests.arrow"
+
+    def load(self, fingerprint):
+        #-> (meta, patient_ids, columns, digest ids, digests), or None to run in full
+        if not self.meta_path.exists():
+            return None
+        meta = json.loads(self.meta_path.read_text())
+        if meta["fingerprint"] != fingerprint:
+            return None
+        patient_ids, columns = read_arrow(self.results_path)
+        digests = feather.read_table(self.digests_path)
+        return (
+            meta, patient_ids, columns,
+            digests.column("patient_id").to_numpy(), digests.column("digest").to_numpy(),
+        )
+
+    def save(self, meta, patient_ids, columns, kinds, digest_ids, digests):
+        #Data files first, the metadata that points at them last
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = f".tmp{os.getpid()}"
+        write_arrow(str(self.results_path) + tmp, patient_ids, columns, kinds)
+        digest_table = pa.table({"patient_id": pa.array(digest_ids, pa.int64()), "digest": pa.array(digests, pa.uint64())})
+        feather.write_feather(digest_table, str(self.digests_path) + tmp, compression="uncompressed")
+        os.replace(str(self.results_path) + tmp, self.results_path)
+        os.replace(str(self.digests_path) + tmp, self.digests_path)
+        self.meta_path.write_text(json.dumps(meta, indent=1))
+
+
+def run_incremental(db, dataset, name, state_dir, kinds, fused=True):
+    #-> (patient_ids, columns, summary) - the same result as run_dataset(db, dataset)
+    key = fingerprint(dataset)
+    tables = [table for table in referenced_tables(dataset) if table in db]
+    digests = patient_digests(db, tables)
+    marks = watermarks(db, tables)
+    state = State(state_dir, name)
+    previous = state.load(key)
+
+    changed = None
+    if previous is not None:
+        meta, old_ids, old_columns, old_digest_ids, old_digests = previous
+        #Changed: a different digest, or only in one of the two runs
+        position = np.searchsorted(old_digest_ids, db.patient_ids)
+        found = position < len(old_digest_ids)
+        found[found] = old_digest_ids[position[found]] == db.patient_ids[found]
+        same = np.zeros(db.n_patients, dtype=bool)
+        same[found] = old_digests[position[found]] == digests[found]
+        changed = np.union1d(db.patient_ids[~same], np.setdiff1d(old_digest_ids, db.patient_ids))
+
+    if changed is None or len(changed) > FULL_RUN_SHARE * db.n_patients:
+        patient_ids, columns = run_dataset(db, dataset, fused=fused)
+        summary = {"mode": "full", "changed": int(db.n_patients if changed is None else len(changed)), "patients": int(db.n_patients)}
+    else:
+        new_ids, new_columns = run_dataset(subset(db, changed), dataset, fused=fused)
+        keep = ~np.isin(old_ids, changed)
+        patient_ids, columns = merge([
+            (old_ids[keep], {column: values[keep] for column, values in old_columns.items()}),
+            (new_ids, new_columns),
+        ])
+        summary = {"mode": "incremental", "changed": int(len(changed)), "patients": int(db.n_patients)}
+    if previous is not None:
+        summary["rows_after_watermark"] = rows_after(db, tables, meta["watermarks"])
+
+    meta = {"fingerprint": key, "tables": tables, "watermarks": marks, "rows": int(len(patient_ids))}
+    state.save(meta, patient_ids, columns, kinds, db.patient_ids, digests)
+    return patient_ids, columns, summary
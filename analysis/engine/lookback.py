@@ -0,0 +1,149 @@
+######################################
+
+# Look-back feature matrices: codelists x windows before a per-patient index date
+
+#python analysis/run_engine.py generate-dataset cohort_lookback --tables dummy_tables --output output/dataset_lookback.arrow
+
+# n_hosp_appt_6m, corticosteroid_60d_before_abx and drug_linked_to_neuropathy_60d_before_abx
+# each look back one window from first_cohort_abx_rx; the sensitivity analyses want
+# them at 30/60/90/180/365 days too. lookback_features() adds a variable per codelist x
+# window, each written as the ehrql query it stands for:
+
+#   medications.where(medications.dmd_code.is_in(X))
+#       .where(medications.date.is_on_or_between(index_date - days(w), index_date - days(1)))
+#       .exists_for_patient()
+
+# Evaluated as written that is a query per cell. Instead evaluate_lookbacks() groups the
+# exists/count queries over the same table, index date and window end: their windows
+# only differ in how far back they start, so they nest. Each group is one pass over the
+# rows of any of its codelists - a row's days before the index date picks a bucket (the
+# shortest window holding it), one bincount per codelist gives rows per (patient,
+# bucket), and a cumulative sum over the buckets gives every window's count at once.
+
+# Any group with more than one window takes this path, whether or not the variables came
+# from lookback_features(); a window offset must be a literal number of days.
+
+######################################
+
+import numpy as np
+
+from .fused import MAX_FLAGS, is_code_test
+from .query import Column, Count, Exists, Function, Value, days, flatten, row_table, tables
+from .tables import SORT_COLUMNS
+
+
+def lookback_features(dataset, table, codelists, windows, index_date, code_column=None, count=False, name="{codelist}_{window}d"):
+    #Adds to `dataset`, for each codelist x window, whether (with count: how many) rows of
+    #`table` with a code in the codelist are dated in [index_date - window, index_date - 1
+    #day]. codelists: {label: codes, or None for every row}; windows in days.
+    #-> {(label, window): variable name}
+    frame = getattr(tables, table)
+    dates = getattr(frame, SORT_COLUMNS[table])
+    names = {}
+    for label, codes in codelists.items():
+        rows = frame if codes is None else frame.where(getattr(frame, code_column).is_in(codes))
+        for window in windows:
+            windowed = rows.where(dates.is_on_or_between(index_date - days(window), index_date - days(1)))
+            names[label, window] = name.format(codelist=label, window=window)
+            setattr(dataset, names[label, window], windowed.count_for_patient() if count else windowed.exists_for_patient())
+    return names
+
+
+def offset(node):
+    #-> (patient-level date node, days added) for x or add_days(x, n), else None
+    if isinstance(node, Function) and node.op == "add_days":
+        date, n = node.args
+        if not (isinstance(n, Value) and isinstance(n.value, (int, np.integer))):
+            return None
+        node, n = date, int(n.value)
+    else:
+        n = 0
+    return None if row_table(node) is not None else (node, n)
+
+
+def match_lookback(node):
+    #Exists/Count over an optional where(code.is_in(codes)) and one
+    #date.is_on_or_between(index + days(a), index + days(b)) -> ((table, index, days
+    #back to the window end), code column, codes, days back to the window start), else None
+    if not isinstance(node, (Exists, Count)):
+        return None
+    table, conditions = flatten(node.source)
+    if table not in SORT_COLUMNS or any(exclude for _, exclude in conditions):
+        return None
+    code_tests = [c for c, _ in conditions if is_code_test(c, table)]
+    others = [c for c, _ in conditions if not is_code_test(c, table)]
+    if len(code_tests) > 1 or len(others) != 1:
+        return None
+    between = others[0]
+    if not (isinstance(between, Function) and between.op == "between" and between.args[0] == Column(table, SORT_COLUMNS[table])):
+        return None
+    start, end = offset(between.args[1]), offset(between.args[2])
+    if start is None or end is None or start[0] != end[0] or start[1] > end[1]:
+        return None
+    code_column, codes = (code_tests[0].args[0].name, code_tests[0].args[1]) if code_tests else (None, None)
+    return (table, start[0], -end[1]), code_column, codes, -start[1]
+
+
+def find_groups(nodes, db):
+    #Groups of more than one window, the only ones that gain from sharing a pass
+    groups = {}
+    for node in nodes:
+        matched = match_lookback(node)
+        if matched is not None and matched[0][0] in db:
+            key, *member = matched
+            groups.setdefault(key, []).append((node, *member))
+    return {key: members for key, members in groups.items() if len({back for *_, back in members}) > 1}
+
+
+def evaluate_lookbacks(evaluator, nodes):
+    #Fills evaluator.cache for every grouped look-back query in `nodes`
+    pending = [node for node in nodes if node not in evaluator.cache]
+    for key, members in find_groups(pending, evaluator.db).items():
+        evaluate_group(evaluator, key, members)
+
+
+def evaluate_group(evaluator, key, members):
+    db = evaluator.db
+    table, index, end = key
+    #Each window is [end, back] days before the index date; buckets by back, ascending
+    backs = np.unique([back for *_, back in members])
+    features = list(dict.fromkeys((code_column, codes) for _, code_column, codes, _ in members))
+    for chunk_start in range(0, len(features), MAX_FLAGS):
+        chunk = features[chunk_start:chunk_start + MAX_FLAGS]
+        #One gather per code column: a bit per codelist (every row for no codelist)
+        bits = np.zeros(len(db[table]), dtype=np.uint64)
+        masks = {}
+        for bit, (code_column, codes) in enumerate(chunk):
+            if codes is None:
+                bits |= np.uint64(1 << bit)
+                continue
+            mask = masks.setdefault(code_column, np.zeros(len(db[table].vocabularies[code_column]), dtype=np.uint64))
+            mask[db[table].positions(code_column, evaluator.resolve(codes))] |= np.uint64(1 << bit)
+        for code_column, mask in masks.items():
+            bits |= mask[db[table][code_column]]
+        rows = np.flatnonzero(bits)
+        bits = bits[rows]
+
+        #Days before the index date; null dates (either) are in no window
+        dates = db[table][SORT_COLUMNS[table]][rows].astype("datetime64[D]")
+        index_dates = np.asarray(evaluator.values(index, table, rows), dtype="datetime64[D]")
+        before = index_dates - dates
+        keep = ~np.isnat(before)
+        keep[keep] = (before[keep] >= np.timedelta64(end, "D")) & (before[keep] <= np.timedelta64(int(backs[-1]), "D"))
+        rows, bits = rows[keep], bits[keep]
+        bucket = np.searchsorted(backs, before[keep].astype(np.int64), side="left")
+        #Counted over just the patients with any row left (rows are grouped by patient)
+        pidx = db.pidx(table)[rows]
+        new_patient = np.r_[True, pidx[1:] != pidx[:-1]] if len(pidx) else pidx.astype(bool)
+        patients = pidx[new_patient]
+        cells = (np.cumsum(new_patient) - 1) * len(backs) + bucket
+
+        for bit, feature in enumerate(chunk):
+            these = (bits & np.uint64(1 << bit)) != 0
+            counts = np.bincount(cells[these], minlength=len(patients) * len(backs)).reshape(len(patients), len(backs))
+            counts = np.cumsum(counts, axis=1)
+            for node, code_column, codes, back in members:
+                if (code_column, codes) == feature:
+                    window = np.zeros(db.n_patients, dtype=np.int64)
+                    window[patients] = counts[:, np.searchsorted(backs, back)]
+                    evaluator.cache[node] = window > 0 if isinstance(node, Exists) else window
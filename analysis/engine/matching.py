@@ -0,0 +1,118 @@
+######################################
+
+# Case-control matching, in process
+
+# Does the job of the matching:v1.1.0 action for our CTC outputs. Controls are bucketed
+# on the exact-match (category) variables and, within a bucket, sorted on the numeric
+# match variable (age). Cases are taken in index-date order and each takes the
+# nearest still-available controls within tolerance.
+
+# "Nearest available" uses two union-find arrays over the sorted controls: next_right[i]
+# points at the first unused control at or after i, next_left[i] at the first unused one
+# at or before i. Using a control links it to its neighbour, so each lookup is a bisect
+# plus a near-constant pointer chase, however many controls have been used up.
+
+######################################
+
+from bisect import bisect_left
+from math import isnan
+
+import numpy as np
+
+
+class NearestAvailable:
+    def __init__(self, values):
+        #values sorted ascending; one union-find per direction, with sentinels at the ends
+        self.values = values
+        n = len(values)
+        self.next_right = list(range(n + 1))
+        self.next_left = list(range(n + 1)) #shifted by one: slot i+1 is control i, slot 0 is "none"
+
+    def _find(self, parent, i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def right(self, i):
+        return self._find(self.next_right, i)
+
+    def left(self, i):
+        return self._find(self.next_left, i + 1) - 1
+
+    def take(self, i):
+        self.next_right[i] = i + 1
+        self.next_left[i + 1] = i
+
+    def nearest(self, lo, hi, target, tolerance):
+        #Closest unused position in [lo, hi) with |value - target| <= tolerance, else None
+        p = bisect_left(self.values, target, lo, hi)
+        r = self.right(p) if p < hi else hi
+        l = self.left(p - 1) if p > lo else lo - 1
+        best = None
+        if l >= lo and target - self.values[l] <= tolerance:
+            best = l
+        if r < hi and self.values[r] - target <= tolerance:
+            if best is None or self.values[r] - target < target - self.values[best]:
+                best = r
+        return best
+
+
+def bucket_keys(columns, exact_variables, n):
+    #Integer bucket id per row from the exact-match columns (dict factorise - cheaper than sorting strings)
+    keys = np.zeros(n, dtype=np.int64)
+    for variable in exact_variables:
+        levels = {}
+        codes = np.fromiter((levels.setdefault(v, len(levels)) for v in columns[variable].tolist()), dtype=np.int64, count=n)
+        keys = keys * (len(levels) or 1) + codes
+    return keys
+
+
+def match(cases, controls, match_variables, matches_per_case, index_date_variable, seed=1):
+    #cases/controls: dicts of numpy columns incl. "patient_id"
+    #-> (case_rows, control_rows) of equal length: control_rows[k] is matched to case_rows[k]
+    exact = [v for v, rule in match_variables.items() if rule == "category"]
+    numeric = [(v, float(rule)) for v, rule in match_variables.items() if rule != "category"]
+    if len(numeric) > 1:
+        raise ValueError("only one numeric match variable is supported")
+    n_cases, n_controls = len(cases["patient_id"]), len(controls["patient_id"])
+
+    #Shared bucket ids across cases and controls
+    keys = bucket_keys({v: np.concatenate([cases[v], controls[v]]) for v in exact}, exact, n_cases + n_controls)
+    case_keys, control_keys = keys[:n_cases], keys[n_cases:]
+
+    if numeric:
+        (variable, tolerance), = numeric
+        case_values, control_values = cases[variable].astype(float), controls[variable].astype(float)
+    else:
+        tolerance, case_values, control_values = 0.0, np.zeros(n_cases), np.zeros(n_controls)
+
+    #Controls sorted by bucket, then value, then a seeded shuffle so ties aren't broken by patient_id
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.permutation(n_controls), control_values, control_keys))
+    order = order[~np.isnan(control_values[order])]
+    sorted_keys = control_keys[order]
+    index = NearestAvailable(control_values[order].tolist())
+    bounds = {}
+    if len(order):
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+        bounds = {int(sorted_keys[s]): (int(s), int(e)) for s, e in zip(starts, ends)}
+
+    #Stream cases in index date order
+    matched_cases, matched_positions = [], []
+    case_keys, case_values = case_keys.tolist(), case_values.tolist()
+    for c in np.lexsort((cases["patient_id"], cases[index_date_variable])).tolist():
+        if case_keys[c] not in bounds or isnan(case_values[c]):
+            continue
+        lo, hi = bounds[case_keys[c]]
+        for _ in range(matches_per_case):
+            position = index.nearest(lo, hi, case_values[c], tolerance)
+            if position is None:
+                break
+            index.take(position)
+            matched_cases.append(c)
+            matched_positions.append(position)
+    return np.array(matched_cases, dtype=np.int64), order[np.array(matched_positions, dtype=np.int64)]
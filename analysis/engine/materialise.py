@@ -0,0 +1,175 @@
+######################################
+
+# Materialised patient-level series shared across actions (--series-cache)
+
+#python analysis/run_engine.py generate-dataset cohort --tables tpp_extract --output output/dataset.arrow --series-cache
+
+# Several actions compute the same intermediates: has_registration_1y_before_* is in
+# three definitions, tendinitis_case_date in both CTC ones, and the first outcome dates
+# in measure_definition.py repeat those in dataset_definition.py. With --series-cache the
+# engine keeps each aggregate series (exists/count/first/last for patient, and each
+# measure part) in .series_cache/ (SERIES_CACHE_DIR), named by a hash of:
+
+# - the expression, with the content of any codelists it uses: a hash of each CSV's bytes
+#   and the columns read from it, so a hand-edited CSV is seen even if codelists.json's
+#   sha wasn't updated
+# - the tables it was computed over: path, size and modification time of every table
+#   file, as patient alignment depends on all of them
+# - for measure parts, the intervals
+
+# so any later action - or a rerun - asking for the same series over the same extract
+# reads it instead of recomputing it. Files are plain .npz (no pickle), written to a
+# temporary name and renamed, and the directory is kept under a size bound by deleting
+# the least recently used (oldest access time, kept as the file's mtime) first. There is
+# no index file, so actions running side by side can share the directory.
+
+######################################
+
+import dataclasses
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .measures import Ranges, Sparse
+from .query import Codes
+from .tables import encode_codes
+
+CACHE_DIR = Path(os.environ.get("SERIES_CACHE_DIR", Path(__file__).resolve().parents[2] / ".series_cache"))
+MAX_BYTES = 1024 * 2 ** 20
+#Bump when engine results or the file layout change
+STORE_VERSION = 1
+
+
+#(file, size, mtime) -> sha1 of the file, so each CSV is only read once per process
+_digests = {}
+
+
+def codelist_digest(codelists, name):
+    #A registered codelist's columns and the sha1 of its CSV's content
+    filename, column, category_column = codelists.CODELISTS[name]
+    path = codelists.CODELIST_DIR / filename
+    stat = path.stat()
+    stamp = (str(path), stat.st_size, stat.st_mtime_ns)
+    if stamp not in _digests:
+        _digests[stamp] = hashlib.sha1(path.read_bytes()).hexdigest()
+    return [filename, column, category_column, _digests[stamp]]
+
+
+def codelists_in(item):
+    #Codelist names used anywhere in a query node or measure part
+    if isinstance(item, Codes):
+        return set(item.names)
+    if isinstance(item, tuple):
+        return set().union(*map(codelists_in, item)) if item else set()
+    if dataclasses.is_dataclass(item):
+        return set().union(*(codelists_in(getattr(item, f.name)) for f in dataclasses.fields(item)))
+    return set()
+
+
+def pack(value):
+    #-> arrays for np.savez
+    if isinstance(value, Sparse):
+        return {"type": np.array("sparse"), "keys": value.keys, "values": value.values}
+    if isinstance(value, Ranges):
+        return {"type": np.array("ranges"), "pidx": value.pidx, "lo": value.lo, "hi": value.hi}
+    if value.dtype.kind == "O":
+        #Codes/strings with None as null, held as ids into a vocabulary
+        ids, vocabulary = encode_codes(value)
+        return {"type": np.array("object"), "ids": ids, "vocabulary": vocabulary[:-1].astype(str)}
+    return {"type": np.array("array"), "values": value}
+
+
+def unpack(arrays):
+    kind = str(arrays["type"])
+    if kind == "sparse":
+        return Sparse(arrays["keys"], arrays["values"])
+    if kind == "ranges":
+        #Already sorted, so the lexsort in Ranges() keeps them as they are
+        return Ranges(arrays["pidx"], arrays["lo"], arrays["hi"])
+    if kind == "object":
+        vocabulary = np.empty(len(arrays["vocabulary"]) + 1, dtype=object)
+        vocabulary[:-1] = arrays["vocabulary"].tolist()
+        return vocabulary[arrays["ids"]]
+    return arrays["values"]
+
+
+class SeriesStore:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        #The bound may have been lowered since the last run
+        if self.directory.exists():
+            self.evict()
+
+    def key(self, db, item, extra=None):
+        #None if the data can't be identified (eg. a shard or subset database) - not cached
+        if not db.sources:
+            return None
+        import codelists
+        spec = {
+            "version": STORE_VERSION,
+            "sources": db.sources,
+            "item": repr(item),
+            "codelists": {name: codelist_digest(codelists, name) for name in sorted(codelists_in(item))},
+            "extra": extra,
+        }
+        return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+    def path(self, item, key):
+        #eg. pick-<hash>.npz, firstininterval-<hash>.npz
+        return self.directory / f"{type(item).__name__.lower()}-{key[:20]}.npz"
+
+    def get(self, item, key):
+        #-> the stored value, or None
+        path = self.path(item, key)
+        try:
+            with np.load(path, allow_pickle=False) as arrays:
+                value = unpack(arrays)
+        except (OSError, ValueError, KeyError):
+            #Missing, evicted while we read it, or a partial file from a killed writer
+            self.misses += 1
+            return None
+        try:
+            os.utime(path) #most recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, item, key, value):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(item, key)
+        tmp = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        with open(tmp, "wb") as f:
+            np.savez(f, **pack(value))
+        os.replace(tmp, path)
+        self.written += 1
+        self.evict()
+
+    def evict(self):
+        #Delete least recently used files until the directory is within max_bytes
+        entries = []
+        for path in self.directory.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue #removed by another action
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    def summary(self):
+        return f"series cache: {self.hits} read, {self.misses} not found, {self.written} written ({self.directory})"
@@ -0,0 +1,294 @@
+######################################
+
+# Measures over many intervals in one sweep
+
+# ehrql's generate-measures re-evaluates every measure for every INTERVAL, so our 20
+# measures x 120 months filter medications/clinical_events ~2,400 times. Here each event
+# set (table + codelist) is filtered once, its rows are already sorted by (patient, date),
+# and each event is placed in its interval(s) with one searchsorted over the interval
+# starts. Results are sparse (patient, interval) values keyed patient * n_intervals + i:
+
+# - count in interval: run-length counts of each (patient, interval) key
+# - exists in interval: first occurrence of each key
+# - exists in [date - a, date - b] for a per-(patient, interval) date: binary search in
+#   the patient's sorted event dates
+# - exists in [INTERVAL.start_date - a, - b]: each event maps to the few intervals whose
+#   start falls in [event + b, event + a] - a sliding window over the starts
+# - registered across the interval: runs of intervals from engine/registrations.py
+
+# So the cost grows with the number of events, not events x intervals. Each shape also
+# has query(start, end): the same thing as an ordinary query for one fixed interval,
+# which is what generate-measures evaluates and what the sweep is checked against.
+
+######################################
+
+import csv
+from dataclasses import dataclass
+
+import numpy as np
+
+from .evaluate import add_months
+from .query import days, tables
+from .registrations import RegistrationIndex
+from .tables import SORT_COLUMNS
+
+
+def monthly_intervals(start, n):
+    #months(n).starting_on(start)
+    start = np.datetime64(start, "D")
+    starts = add_months(np.full(n + 1, start), np.arange(n + 1))
+    return starts[:-1], starts[1:] - np.timedelta64(1, "D")
+
+
+class Sparse:
+    #Values for some (patient, interval) pairs; absent pairs are 0
+    def __init__(self, keys, values):
+        self.keys = keys #sorted, unique
+        self.values = values
+
+    def lookup(self, keys, n_intervals):
+        position = np.searchsorted(self.keys, keys)
+        found = position < len(self.keys)
+        found[found] = self.keys[position[found]] == keys[found]
+        out = np.zeros(len(keys), dtype=self.values.dtype)
+        out[found] = self.values[position[found]]
+        return out
+
+    def totals(self, n_intervals):
+        return np.bincount(self.keys % n_intervals, weights=self.values, minlength=n_intervals)
+
+
+class Ranges:
+    #Value 1 for each patient over runs of intervals [lo, hi]; runs don't overlap
+    def __init__(self, pidx, lo, hi):
+        order = np.lexsort((lo, pidx))
+        self.pidx, self.lo, self.hi = pidx[order], lo[order], hi[order]
+
+    def lookup(self, keys, n_intervals):
+        pidx, i = keys // n_intervals, keys % n_intervals
+        #Last run starting at or before (patient, i)
+        run_keys = self.pidx * n_intervals + self.lo
+        position = np.searchsorted(run_keys, pidx * n_intervals + i, side="right") - 1
+        ok = position >= 0
+        ok[ok] = (self.pidx[position[ok]] == pidx[ok]) & (self.hi[position[ok]] >= i[ok])
+        return ok.astype(np.int64)
+
+    def totals(self, n_intervals):
+        diff = np.zeros(n_intervals + 1, dtype=np.int64)
+        np.add.at(diff, self.lo, 1)
+        np.add.at(diff, self.hi + 1, -1)
+        return np.cumsum(diff[:-1])
+
+
+class Sweep:
+    #Shared state for one run: the intervals and each event set, filtered once
+    def __init__(self, db, starts, ends, store=None):
+        self.db = db
+        self.starts = starts.astype(np.int64)
+        self.ends = ends.astype(np.int64)
+        self.n_intervals = len(starts)
+        self.store = store #engine/materialise.py SeriesStore, or None
+        self._events = {}
+        self._values = {}
+
+    def value(self, part):
+        #Each numerator/denominator/anchor date is evaluated once and shared
+        if part not in self._values:
+            key = None
+            if self.store is not None:
+                key = self.store.key(self.db, part, extra=[self.starts.tolist(), self.ends.tolist()])
+            value = None if key is None else self.store.get(part, key)
+            if value is None:
+                value = part.evaluate(self)
+                if key is not None:
+                    self.store.put(part, key, value)
+            self._values[part] = value
+        return self._values[part]
+
+    def events(self, table, code_column, codes):
+        #(patient index, date as int days) of matching rows, sorted by patient then date
+        key = (table, code_column, codes)
+        if key not in self._events:
+            rows = np.flatnonzero(self.db[table].compile(code_column, codes.resolve())[self.db[table][code_column]])
+            dates = self.db[table][SORT_COLUMNS[table]][rows]
+            rows, dates = rows[~np.isnat(dates)], dates[~np.isnat(dates)]
+            self._events[key] = (self.db.pidx(table)[rows], dates.astype(np.int64))
+        return self._events[key]
+
+    def interval_of(self, dates):
+        #Index of the interval containing each date, or -1
+        i = np.searchsorted(self.starts, dates, side="right") - 1
+        inside = (i >= 0) & (dates <= self.ends[np.maximum(i, 0)])
+        return np.where(inside, i, -1)
+
+    def keys(self, pidx, i):
+        return pidx.astype(np.int64) * self.n_intervals + i
+
+
+def shift(date, n):
+    return str(np.datetime64(date, "D") + n)
+
+
+def coded_events(table, code_column, codes):
+    frame = getattr(tables, table)
+    return frame, frame.where(getattr(frame, code_column).is_in(codes))
+
+
+@dataclass(frozen=True)
+class CountInInterval:
+    #<table>.where(code.is_in(codes)).where(date.is_during(INTERVAL)).count_for_patient()
+    table: str
+    code_column: str
+    codes: object
+
+    def evaluate(self, sweep):
+        pidx, dates = sweep.events(self.table, self.code_column, self.codes)
+        i = sweep.interval_of(dates)
+        keys = sweep.keys(pidx[i >= 0], i[i >= 0])
+        #keys are sorted already (patient, then date so interval) - count runs
+        unique, counts = np.unique(keys, return_counts=True)
+        return Sparse(unique, counts.astype(np.int64))
+
+    def query(self, start, end):
+        frame, events = coded_events(self.table, self.code_column, self.codes)
+        return events.where(frame.date.is_on_or_between(start, end)).count_for_patient()
+
+
+@dataclass(frozen=True)
+class ExistsInInterval(CountInInterval):
+    #... .exists_for_patient()
+    def evaluate(self, sweep):
+        counts = super().evaluate(sweep)
+        return Sparse(counts.keys, np.ones(len(counts.keys), dtype=np.int64))
+
+    def query(self, start, end):
+        frame, events = coded_events(self.table, self.code_column, self.codes)
+        return events.where(frame.date.is_on_or_between(start, end)).exists_for_patient()
+
+
+@dataclass(frozen=True)
+class FirstInInterval:
+    #<table>.where(code.is_in(codes)).where(date.is_during(INTERVAL)).sort_by(date).first_for_patient().date
+    table: str
+    code_column: str
+    codes: object
+
+    def evaluate(self, sweep):
+        pidx, dates = sweep.events(self.table, self.code_column, self.codes)
+        i = sweep.interval_of(dates)
+        keys, dates = sweep.keys(pidx[i >= 0], i[i >= 0]), dates[i >= 0]
+        #Keys are already in order (rows are by patient then date, and so by interval), so
+        #the first of each run of a key is its earliest date - no sort needed
+        first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else keys
+        return Sparse(keys[first], dates[first])
+
+    def query(self, start, end):
+        frame, events = coded_events(self.table, self.code_column, self.codes)
+        return events.where(frame.date.is_on_or_between(start, end)).sort_by(frame.date).first_for_patient().date
+
+
+@dataclass(frozen=True)
+class ExistsBeforeDate:
+    #<table>.where(code.is_in(codes)).where(date.is_on_or_between(<date> - days(start), <date> - days(end))).exists_for_patient()
+    #where <date> is a per-(patient, interval) date such as FirstInInterval
+    table: str
+    code_column: str
+    codes: object
+    date: object
+    start: int
+    end: int
+
+    def evaluate(self, sweep):
+        anchors = sweep.value(self.date)
+        pidx, dates = sweep.events(self.table, self.code_column, self.codes)
+        #Events sorted by (patient, date): search patient * span + date
+        span = np.int64(1 << 32)
+        events = pidx.astype(np.int64) * span + (dates + (1 << 31))
+        anchor_pidx = anchors.keys // sweep.n_intervals
+        base = anchor_pidx * span + (1 << 31)
+        low = np.searchsorted(events, base + anchors.values - self.start, side="left")
+        high = np.searchsorted(events, base + anchors.values - self.end, side="right")
+        hit = high > low
+        return Sparse(anchors.keys[hit], np.ones(hit.sum(), dtype=np.int64))
+
+    def query(self, start, end):
+        frame, events = coded_events(self.table, self.code_column, self.codes)
+        date = self.date.query(start, end)
+        return events.where(frame.date.is_on_or_between(date - days(self.start), date - days(self.end))).exists_for_patient()
+
+
+@dataclass(frozen=True)
+class ExistsBeforeIntervalStart:
+    #<table>.where(code.is_in(codes)).where(date.is_on_or_between(INTERVAL.start_date - days(start), INTERVAL.start_date - days(end))).exists_for_patient()
+    table: str
+    code_column: str
+    codes: object
+    start: int
+    end: int
+
+    def evaluate(self, sweep):
+        pidx, dates = sweep.events(self.table, self.code_column, self.codes)
+        #An event at d is in the window for intervals starting in [d + end, d + start]
+        first = np.searchsorted(sweep.starts, dates + self.end, side="left")
+        last = np.searchsorted(sweep.starts, dates + self.start, side="right")
+        width = last - first
+        keep = width > 0
+        pidx, first, width = pidx[keep], first[keep], width[keep]
+        #Windows are shorter than a month so width is 1 or 2 - expand them
+        repeated = np.repeat(np.arange(len(first)), width)
+        offsets = np.arange(len(repeated)) - np.repeat(np.cumsum(width) - width, width)
+        keys = np.unique(sweep.keys(pidx[repeated], first[repeated] + offsets))
+        return Sparse(keys, np.ones(len(keys), dtype=np.int64))
+
+    def query(self, start, end):
+        frame, events = coded_events(self.table, self.code_column, self.codes)
+        return events.where(frame.date.is_on_or_between(shift(start, -self.start), shift(start, -self.end))).exists_for_patient()
+
+
+@dataclass(frozen=True)
+class RegisteredSpanning:
+    #practice_registrations.spanning(INTERVAL.start_date, INTERVAL.end_date).exists_for_patient()
+    def evaluate(self, sweep):
+        return Ranges(*RegistrationIndex.for_db(sweep.db).interval_runs(sweep.starts, sweep.ends))
+
+    def query(self, start, end):
+        return tables.practice_registrations.spanning(start, end).exists_for_patient()
+
+
+@dataclass(frozen=True)
+class Measure:
+    name: str
+    numerator: object
+    denominator: object
+
+
+def run_measures(db, measures, starts, ends, store=None):
+    #-> rows of (measure, interval_start, interval_end, ratio, numerator, denominator)
+    sweep = Sweep(db, starts, ends, store=store)
+    rows = []
+    for measure in measures:
+        rows.extend(measure_rows(sweep, measure))
+    return rows
+
+
+def measure_rows(sweep, measure):
+    n = sweep.n_intervals
+    numerator, denominator = sweep.value(measure.numerator), sweep.value(measure.denominator)
+    #Only patients with a non-zero denominator are counted
+    in_denominator = denominator.lookup(numerator.keys, n) != 0
+    numerator_totals = np.bincount(numerator.keys[in_denominator] % n, weights=numerator.values[in_denominator], minlength=n)
+    denominator_totals = denominator.totals(n)
+    rows = []
+    for i in range(n):
+        num, den = int(numerator_totals[i]), int(denominator_totals[i])
+        start, end = sweep.starts[i].astype("datetime64[D]"), sweep.ends[i].astype("datetime64[D]")
+        rows.append((measure.name, start, end, num / den if den else None, num, den))
+    return rows
+
+
+def write_measures(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["measure", "interval_start", "interval_end", "ratio", "numerator", "denominator"])
+        for name, start, end, ratio, num, den in rows:
+            writer.writerow([name, start, end, "" if ratio is None else ratio, num, den])
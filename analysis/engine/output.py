@@ -0,0 +1,181 @@
+######################################
+
+# Dataset writers - same CSV layout as ehrql's generate-dataset, or typed Arrow/Parquet
+
+# The output format follows the file suffix, as with ehrql: .csv/.csv.gz, .arrow
+# (Arrow IPC file - memory-mappable, R reads it with arrow::read_feather) or .parquet.
+# Typed files keep dates, booleans and ints as such, and str columns (categories such
+# as sex or latest_ethnicity_group) are dictionary-encoded, so they arrive as factors.
+# Rows are written in batches, so only one batch is ever converted at a time - for CSV,
+# formatted as text.
+
+# .csv.gz is compressed in blocks on a thread pool (zlib releases the GIL) while the
+# rows are still being formatted, and each block is written as its own gzip member. A
+# multi-member file is a standard gzip stream - gunzip, R's gzfile/readr and Python's
+# gzip all read it as one - and at most `queue` blocks are held in memory at a time.
+
+######################################
+
+import csv
+import gzip
+import io
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from .tables import column_to_numpy, is_null
+
+BATCH_ROWS = 64 * 1024
+#Uncompressed bytes per gzip member
+GZIP_BLOCK = 4 * 2 ** 20
+
+ARROW_KINDS = {
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "date": pa.date32(),
+    "code": pa.string(),
+    "str": pa.dictionary(pa.int32(), pa.string()),
+}
+
+
+def format_column(values, kind):
+    nulls = is_null(values) if values.dtype.kind in "MfO" else np.zeros(len(values), dtype=bool)
+    if kind == "bool":
+        text = np.where(values.astype(bool), "T", "F").astype(object)
+    elif kind == "int" and values.dtype.kind == "f":
+        text = np.array([str(int(v)) for v in np.nan_to_num(values)], dtype=object)
+    elif kind == "date":
+        text = values.astype("datetime64[D]").astype(str).astype(object)
+    else:
+        text = np.array([str(v) for v in values], dtype=object)
+    text[nulls] = ""
+    return text
+
+
+class ParallelGzip(io.RawIOBase):
+    #Binary file that gzips GZIP_BLOCK-sized blocks on `threads` threads, in order
+    def __init__(self, path, level=6, threads=None, queue=None):
+        self.file = open(path, "wb")
+        self.level = level
+        threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(threads)
+        self.queue = queue or 2 * threads
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= GZIP_BLOCK:
+            self.submit(bytes(self.buffer[:GZIP_BLOCK]))
+            del self.buffer[:GZIP_BLOCK]
+        return len(data)
+
+    def submit(self, block):
+        if len(self.pending) >= self.queue:
+            self.file.write(self.pending.popleft().result())
+        #mtime=0, so the same rows always give the same bytes
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level, mtime=0))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.pending:
+                #An empty file still gets one (empty) member, so it's valid gzip
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+            super().close()
+
+
+def write_csv(path, patient_ids, columns, kinds, gzip_level=6, gzip_threads=None, gzip_queue=None):
+    path = str(path)
+    names = list(columns)
+    if path.endswith(".gz"):
+        f = io.TextIOWrapper(ParallelGzip(path, gzip_level, gzip_threads, gzip_queue), newline="")
+    else:
+        f = open(path, "w", newline="")
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(["patient_id"] + names)
+        #In batches, so blocks go to the compressors while later rows are formatted, and
+        #only one batch is held as text
+        for start in range(0, len(patient_ids), BATCH_ROWS):
+            stop = start + BATCH_ROWS
+            formatted = [format_column(columns[name][start:stop], kinds[name]) for name in names]
+            writer.writerows(zip(patient_ids[start:stop].tolist(), *formatted))
+
+
+def arrow_schema(names, kinds):
+    return pa.schema([("patient_id", pa.int64())] + [(name, ARROW_KINDS[kinds[name]]) for name in names])
+
+
+def arrow_batches(patient_ids, columns, kinds, batch_rows=BATCH_ROWS):
+    names = list(columns)
+    #Dictionaries are built once over the whole column - an IPC file can't change them between batches
+    encoded = {
+        name: pa.array(columns[name], type=pa.string(), from_pandas=True).dictionary_encode()
+        for name in names if kinds[name] == "str"
+    }
+    for start in range(0, len(patient_ids), batch_rows):
+        stop = start + batch_rows
+        arrays = [pa.array(patient_ids[start:stop], type=pa.int64())]
+        for name in names:
+            if name in encoded:
+                arrays.append(encoded[name].slice(start, stop - start))
+            else:
+                #from_pandas: NaT/NaN become nulls (nullable ints are held as floats)
+                arrays.append(pa.array(columns[name][start:stop], type=ARROW_KINDS[kinds[name]], from_pandas=True))
+        yield pa.RecordBatch.from_arrays(arrays, schema=arrow_schema(names, kinds))
+
+
+def write_arrow(path, patient_ids, columns, kinds):
+    schema = arrow_schema(list(columns), kinds)
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in arrow_batches(patient_ids, columns, kinds):
+            writer.write_batch(batch)
+
+
+def write_parquet(path, patient_ids, columns, kinds):
+    with pq.ParquetWriter(str(path), arrow_schema(list(columns), kinds)) as writer:
+        for batch in arrow_batches(patient_ids, columns, kinds):
+            writer.write_batch(batch)
+
+
+def write_dataset(path, patient_ids, columns, kinds, **gzip_options):
+    #gzip_options (gzip_level, gzip_threads, gzip_queue) are for .csv.gz
+    path = str(path)
+    if path.endswith((".arrow", ".feather")):
+        write_arrow(path, patient_ids, columns, kinds)
+    elif path.endswith(".parquet"):
+        write_parquet(path, patient_ids, columns, kinds)
+    else:
+        write_csv(path, patient_ids, columns, kinds, **gzip_options)
+
+
+def read_arrow(path):
+    #-> (patient_ids, columns) from a typed .arrow dataset, held the way the engine holds results
+    table = feather.read_table(str(path))
+    columns = {}
+    for field in table.schema:
+        if field.name == "patient_id":
+            continue
+        array = table.column(field.name)
+        if pa.types.is_dictionary(field.type):
+            array = array.cast(pa.string())
+        kind = {pa.date32(): "date", pa.int64(): "int", pa.float64(): "float", pa.bool_(): "bool"}.get(array.type, "str")
+        columns[field.name] = column_to_numpy(array, kind)
+    return table.column("patient_id").to_numpy().astype(np.int64), columns
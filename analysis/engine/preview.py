@@ -0,0 +1,154 @@
+######################################
+
+# Sampled preview of a definition's variables (show)
+
+#python analysis/run_engine.py show cohort fluoroquinolone_exp --tables dummy_tables_1m --sample 1000
+
+# ehrql's show() only prints anything once the whole definition has run. This evaluates
+# the variables asked for - or the whole dataset - for a seeded random sample of
+# patients instead. The sample is restricted at load: every table the variables read is
+# filtered to the sampled patients before it is converted to numpy, so the evaluator
+# only ever sees their rows. .arrow tables are memory-mapped and only their patient_id
+# column is read in full; .csv tables are still parsed whole, so convert them first for
+# quick previews.
+
+# The sample is the n patients, of everyone in any table (the universe of a full run),
+# with the smallest seeded hash of their patient_id - a uniform sample without
+# replacement that a larger n only adds to. Prints the first rows and a summary of each
+# column: nulls, then true count (bool), min/mean/max (int, float), min/max (date) or
+# the most common values (str, code).
+
+######################################
+
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .evaluate import Evaluator
+from .output import format_column
+from .query import Column, Events, as_node, kind_of, walk
+from .tables import Database, from_arrow, is_null, load_arrow_tables
+
+SAMPLE = 1000
+ROWS = 10
+#Most common values listed for str/code columns
+TOP = 3
+
+
+def mix(patient_ids, seed):
+    #splitmix64 of patient_id and seed -> uint64 (uint64 arithmetic wraps)
+    z = np.asarray(patient_ids).astype(np.uint64) + np.uint64(seed * 0x9E3779B97F4A7C15 % 2 ** 64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def sample_ids(arrow_tables, n, seed=1):
+    #-> sorted patient ids: the n (or everyone, if fewer) with the smallest mix()
+    kept_ids, kept_hashes = np.empty(0, np.int64), np.empty(0, np.uint64)
+    if n < 1:
+        return kept_ids
+    for table in arrow_tables.values():
+        ids = np.asarray(table.column("patient_id").to_numpy(), dtype=np.int64)
+        hashes = mix(ids, seed)
+        if len(kept_ids) >= n:
+            #Only patients hashing below the current n-th can get in
+            below = hashes < kept_hashes.max()
+            ids, hashes = ids[below], hashes[below]
+        ids, first = np.unique(np.concatenate([kept_ids, ids]), return_index=True)
+        hashes = np.concatenate([kept_hashes, hashes])[first]
+        if len(ids) > n:
+            keep = np.argpartition(hashes, n - 1)[:n]
+            ids, hashes = ids[keep], hashes[keep]
+        kept_ids, kept_hashes = ids, hashes
+    return np.sort(kept_ids)
+
+
+def tables_used(nodes):
+    return {node.table for node in walk(nodes) if isinstance(node, (Events, Column))}
+
+
+def sample_database(arrow_tables, patient_ids, names):
+    #Database of the tables in `names`, holding only the sampled patients' rows
+    value_set = pa.array(patient_ids, type=pa.int64())
+    tables = {}
+    for name in sorted(names):
+        if name in arrow_tables:
+            table = arrow_tables[name]
+            tables[name] = from_arrow(name, table.filter(pc.is_in(table.column("patient_id"), value_set=value_set)))
+    db = Database(tables)
+    #Everyone sampled, even with no rows in the tables read
+    db.patient_ids = np.asarray(patient_ids, dtype=np.int64)
+    return db
+
+
+def preview(arrow_tables, sample, variables, population=None):
+    #variables: {name: node}. -> (patient_ids, {name: values}) for the sampled patients,
+    #only those in the population if one is given
+    nodes = list(variables.values()) + ([population] if population is not None else [])
+    db = sample_database(arrow_tables, sample, tables_used(nodes))
+    results = Evaluator(db).evaluate_all(nodes)
+    keep = np.flatnonzero(results[-1]) if population is not None else np.arange(db.n_patients)
+    return db.patient_ids[keep], {name: values[keep] for name, values in zip(variables, results)}
+
+
+def summarise(values, kind):
+    #One line about a column: its nulls, then what's in it
+    nulls = is_null(values) if values.dtype.kind in "MfO" else np.zeros(len(values), dtype=bool)
+    present = values[~nulls]
+    if not len(present):
+        described = "-"
+    elif kind == "bool":
+        trues = int(present.astype(bool).sum())
+        described = f"T {trues} ({trues / len(present):.1%})"
+    elif kind in ("int", "float"):
+        present = present.astype(float)
+        number = (lambda v: f"{v:g}") if kind == "float" else (lambda v: f"{int(v)}")
+        described = f"min {number(present.min())}, mean {present.mean():.4g}, max {number(present.max())}"
+    elif kind == "date":
+        present = present.astype("datetime64[D]")
+        described = f"min {present.min()}, max {present.max()}"
+    else:
+        distinct, counts = np.unique(present.astype(str), return_counts=True)
+        top = np.argsort(-counts, kind="stable")[:TOP]
+        described = f"{len(distinct)} distinct: " + ", ".join(f"{distinct[i]} {counts[i]}" for i in top)
+    return f"{int(nulls.sum())} null, {described}"
+
+
+def render(patient_ids, columns, kinds, rows=ROWS):
+    #-> the first `rows` rows as aligned text, then a summary line per column
+    names = ["patient_id", *columns]
+    cells = [[str(v) for v in patient_ids[:rows]]]
+    cells += [format_column(columns[name][:rows], kinds[name]).tolist() for name in columns]
+    widths = [max([len(name)] + [len(c) for c in column]) for name, column in zip(names, cells)]
+    lines = ["  ".join(name.ljust(width) for name, width in zip(names, widths)).rstrip()]
+    for row in zip(*cells):
+        lines.append("  ".join(c.ljust(width) for c, width in zip(row, widths)).rstrip())
+    if len(patient_ids) > rows:
+        lines.append(f"... {len(patient_ids) - rows} more")
+    lines.append("")
+    width = max([len(name) for name in columns] + [0])
+    for name in columns:
+        lines.append(f"{name.ljust(width)}  {kinds[name].ljust(5)}  {summarise(columns[name], kinds[name])}")
+    return "\n".join(lines)
+
+
+def show(value, tables="dummy_tables", n=SAMPLE, seed=1, rows=ROWS, name="value"):
+    #ehrql-style show() over a sample: of a Series, a {name: Series} dict, or a Dataset
+    #(its population only)
+    started = time.perf_counter()
+    arrow_tables = load_arrow_tables(tables, memory_map=True)
+    if hasattr(value, "variables"):
+        variables, population = value.variables, value.population
+    elif isinstance(value, dict):
+        variables, population = {k: as_node(v) for k, v in value.items()}, None
+    else:
+        variables, population = {name: as_node(value)}, None
+    sample = sample_ids(arrow_tables, n, seed)
+    patient_ids, columns = preview(arrow_tables, sample, variables, population)
+    kinds = {name: kind_of(node) for name, node in variables.items()}
+    counted = f"{len(sample)} sampled patients" if population is None else f"{len(patient_ids)} of {len(sample)} sampled patients in the population"
+    print(f"{counted} (seed {seed}), {time.perf_counter() - started:.2f}s\n")
+    print(render(patient_ids, columns, kinds, rows))
@@ -0,0 +1,375 @@
+######################################
+
+# Profiling report for generate-dataset / generate-measures (--profile)
+
+#python analysis/run_engine.py generate-dataset cohort --tables dummy_tables_1m --output output/engine/dataset.arrow --profile
+
+# Records wall time, rows scanned and peak memory for every node the evaluator computes,
+# and rolls them up per dataset variable (or per measure). Nodes are cached, so a shared
+# subexpression such as first_cohort_rx is costed once - against the first variable that
+# needed it - and listed with every variable that uses it. The report is JSON, written
+# next to the output as <name>.profile.json.
+
+# A dataset is profiled through run_dataset, so the plan is the one an ordinary run takes:
+# canonical form, the population first and then, pushed down, the variables over its
+# patients' rows only. The grouped passes (fused flags, look-backs, window indexes) are
+# steps of their own - "<grouped>" for the population, then "<grouped, pushed down>" (or
+# "<grouped, variables>" if not) - and the nodes they answer are put down to them.
+
+# - seconds: wall time including the node's own inputs (self_seconds: without them)
+# - rows_scanned: rows read, also including inputs - source rows for a frame filter,
+#   frame rows for exists/count/first/last, patients for patient-level functions
+# - peak_bytes: peak memory allocated while computing it (tracemalloc - numpy reports
+#   its buffers), above what was allocated when it started
+
+# Memory tracing slows evaluation a little, so profile times are for comparison with
+# other profile runs rather than with ordinary ones.
+
+######################################
+
+import dataclasses
+import hashlib
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from .canonical import canonical_dataset
+from .evaluate import Evaluator, run_dataset
+from .measures import RegisteredSpanning, Sweep, measure_rows
+from .query import Codes, Column, Count, Events, Exists, Filter, Function, Pick, Value, frame_table, walk
+from .registrations import TABLE as REGISTRATIONS
+
+
+class Step:
+    def __init__(self):
+        self.seconds = 0.0
+        self.child_seconds = 0.0
+        self.rows_scanned = 0 #by this step itself
+        self.total_rows = 0 #including nested steps
+        self.peak_bytes = 0
+
+    @property
+    def self_seconds(self):
+        return self.seconds - self.child_seconds
+
+    def as_dict(self):
+        return {
+            "seconds": round(self.seconds, 6),
+            "self_seconds": round(self.self_seconds, 6),
+            "rows_scanned": int(self.total_rows),
+            "peak_bytes": int(self.peak_bytes),
+        }
+
+
+class Profiler:
+    #Nested timing/memory steps; tracemalloc's single peak is reset around each step and
+    #carried up to the enclosing ones
+    def __init__(self):
+        self.stack = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def step(self):
+        step = Step()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1].high = max(self.stack[-1].high, peak)
+        tracemalloc.reset_peak()
+        step.base = step.high = current
+        self.stack.append(step)
+        started = time.perf_counter()
+        try:
+            yield step
+        finally:
+            step.seconds = time.perf_counter() - started
+            self.stack.pop()
+            step.high = max(step.high, tracemalloc.get_traced_memory()[1])
+            step.peak_bytes = step.high - step.base
+            step.total_rows += step.rows_scanned
+            if self.stack:
+                parent = self.stack[-1]
+                parent.high = max(parent.high, step.high)
+                parent.child_seconds += step.seconds
+                parent.total_rows += step.total_rows
+            tracemalloc.reset_peak()
+
+    def scanned(self, n):
+        if self.stack:
+            self.stack[-1].rows_scanned += n
+
+    def stop(self):
+        tracemalloc.stop()
+
+
+class Recording:
+    #What a profiled run_dataset has recorded, shared with the pushed-down evaluator
+    def __init__(self, targets):
+        self.profiler = Profiler()
+        self.steps = {} #node -> Step, for nodes and frames computed
+        self.names = {} #target node -> its names ("<population>" and variables)
+        for name, node in targets.items():
+            self.names.setdefault(node, []).append(name)
+        self.variables = [] #(name, Step), in evaluation order
+        self.first_needed_by = {}
+        self.pushed_down = None #patients, if pushed down
+
+
+class ProfilingEvaluator(Evaluator):
+    def __init__(self, db, recording, fused=True, plain=False):
+        super().__init__(db, fused=fused, plain=plain)
+        self.recording = recording
+        self.profiler = recording.profiler
+        self.steps = recording.steps
+
+    def spawn(self, db):
+        self.recording.pushed_down = int(db.n_patients)
+        return ProfilingEvaluator(db, self.recording, fused=self.fused, plain=self.plain)
+
+    def grouped(self, nodes):
+        #Once for the population, then (pushed down or not) for the variables
+        if self.recording.pushed_down is not None:
+            name = "<grouped, pushed down>"
+        elif any(name == "<grouped>" for name, _ in self.recording.variables):
+            name = "<grouped, variables>"
+        else:
+            name = "<grouped>"
+        self.record(name, super().grouped, nodes)
+
+    def evaluate_target(self, node):
+        done = {name for name, _ in self.recording.variables}
+        name = next(n for n in self.recording.names[node] if n not in done)
+        return self.record(name, super().evaluate_target, node)
+
+    def record(self, name, fn, *args):
+        #fn(*args) as the step for `name`, which nodes it is first to compute are put down to
+        before = set(self.cache) | set(self.steps)
+        with self.profiler.step() as step:
+            result = fn(*args)
+        for node in (set(self.cache) | set(self.steps)) - before:
+            self.recording.first_needed_by.setdefault(node, name)
+        self.recording.variables.append((name, step))
+        return result
+
+    def evaluate(self, node):
+        if node in self.cache:
+            return self.cache[node]
+        with self.profiler.step() as step:
+            result = super().evaluate(node)
+            self.profiler.scanned(self.scanned(node))
+        self.steps[node] = step
+        return result
+
+    def rows(self, frame):
+        if frame in self.frames:
+            return self.frames[frame]
+        with self.profiler.step() as step:
+            rows = super().rows(frame)
+            if isinstance(frame, Filter):
+                self.profiler.scanned(len(self.frames[frame.source]))
+        self.steps[frame] = step
+        return rows
+
+    def scanned(self, node):
+        if isinstance(node, (Exists, Count, Pick)):
+            if node.source in self.frames:
+                return len(self.frames[node.source])
+            #Patient tables, and registration queries answered from the index
+            return len(self.db[frame_table(node.source)])
+        if isinstance(node, Column):
+            return len(self.db[node.table])
+        return self.db.n_patients
+
+
+class ProfilingSweep(Sweep):
+    def __init__(self, db, starts, ends, profiler):
+        super().__init__(db, starts, ends)
+        self.profiler = profiler
+        self.steps = {}
+
+    def value(self, part):
+        if part in self._values:
+            return self._values[part]
+        with self.profiler.step() as step:
+            result = super().value(part)
+            if isinstance(part, RegisteredSpanning):
+                self.profiler.scanned(len(self.db[REGISTRATIONS]))
+        self.steps[part] = step
+        return result
+
+    def events(self, table, code_column, codes):
+        if (table, code_column, codes) not in self._events:
+            self.profiler.scanned(len(self.db[table]))
+        pidx, dates = super().events(table, code_column, codes)
+        self.profiler.scanned(len(pidx))
+        return pidx, dates
+
+
+def describe(node):
+    #ehrql-like spelling of a node (or measure part), for reading the report
+    if isinstance(node, Events):
+        return node.table
+    if isinstance(node, Filter):
+        return f"{describe(node.source)}.{'except_where' if node.exclude else 'where'}({describe(node.condition)})"
+    if isinstance(node, Column):
+        return f"{node.table}.{node.name}"
+    if isinstance(node, Value):
+        return str(node.value)
+    if isinstance(node, Codes):
+        return "+".join(node.names)
+    if isinstance(node, Function):
+        return f"{node.op}({', '.join(describe(arg) for arg in node.args)})"
+    if isinstance(node, Exists):
+        return f"{describe(node.source)}.exists_for_patient()"
+    if isinstance(node, Count):
+        return f"{describe(node.source)}.count_for_patient()"
+    if isinstance(node, Pick):
+        which = "last" if node.last else "first"
+        return f"{describe(node.source)}.sort_by({node.sort_column}).{which}_for_patient().{node.column}"
+    if dataclasses.is_dataclass(node):
+        fields = ", ".join(describe(getattr(node, f.name)) for f in dataclasses.fields(node))
+        return f"{type(node).__name__}({fields})"
+    return str(node)
+
+
+def node_id(node):
+    #Stable across runs, so reports can be compared node by node
+    return hashlib.sha1(repr(node).encode()).hexdigest()[:12]
+
+
+def node_entries(steps, targets, first_needed_by):
+    #-> one entry per computed node/part, most expensive (self time) first
+    used_by = {}
+    for name, target in targets.items():
+        for node in walk([target]):
+            used_by.setdefault(node, []).append(name)
+    entries = []
+    for node, step in steps.items():
+        entries.append({
+            "id": node_id(node),
+            "expression": describe(node),
+            "kind": "frame" if isinstance(node, (Events, Filter)) else "series",
+            #Variables that are exactly this node
+            "names": [name for name, target in targets.items() if target == node],
+            "first_needed_by": first_needed_by.get(node),
+            "used_by": used_by.get(node, []),
+            **step.as_dict(),
+        })
+    return sorted(entries, key=lambda e: -e["self_seconds"])
+
+
+def memory_summary():
+    #ru_maxrss is KiB on Linux
+    return {"max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def profile_dataset(db, dataset, fused=True):
+    #run_dataset under the profiler -> (patient_ids, columns, report)
+    dataset = canonical_dataset(dataset)
+    targets = {"<population>": dataset.population, **dataset.variables}
+    recording = Recording(targets)
+    evaluator = ProfilingEvaluator(db, recording, fused=fused)
+
+    with recording.profiler.step() as total:
+        patient_ids, columns = run_dataset(db, dataset, evaluator=evaluator)
+    recording.profiler.stop()
+
+    first_needed_by = recording.first_needed_by
+    report = {
+        "evaluate_seconds": round(total.seconds, 6),
+        "evaluate_peak_bytes": int(total.peak_bytes),
+        "n_patients": int(db.n_patients),
+        "n_rows": int(len(patient_ids)),
+        #Patients the variables were evaluated for, or None if not pushed down
+        "pushed_down_patients": recording.pushed_down,
+        "table_rows": {name: len(table) for name, table in db.tables.items()},
+        "variables": [
+            {"name": name, "nodes_computed": sum(1 for v in first_needed_by.values() if v == name), **step.as_dict()}
+            for name, step in recording.variables
+        ],
+        "nodes": node_entries(recording.steps, targets, first_needed_by),
+    }
+    return patient_ids, columns, report
+
+
+def profile_measures(db, measures, starts, ends):
+    #run_measures, one measure at a time under the profiler -> (rows, report)
+    profiler = Profiler()
+    sweep = ProfilingSweep(db, starts, ends, profiler)
+    first_needed_by = {}
+    per_measure = {}
+    rows = []
+
+    with profiler.step() as total:
+        for measure in measures:
+            before = set(sweep.steps)
+            with profiler.step() as step:
+                rows.extend(measure_rows(sweep, measure))
+            for computed in set(sweep.steps) - before:
+                first_needed_by[computed] = measure.name
+            per_measure[measure.name] = step
+    profiler.stop()
+
+    #A measure uses its numerator, denominator and any part they're built on (eg. an anchor date)
+    targets = {}
+    for measure in measures:
+        for part in (measure.numerator, measure.denominator):
+            targets.setdefault(measure.name, []).append(part)
+            if hasattr(part, "date"):
+                targets[measure.name].append(part.date)
+    used_by = {}
+    for name, parts in targets.items():
+        for part in parts:
+            used_by.setdefault(part, []).append(name)
+    parts = []
+    for part, step in sweep.steps.items():
+        parts.append({
+            "id": node_id(part),
+            "expression": describe(part),
+            "first_needed_by": first_needed_by.get(part),
+            "used_by": used_by.get(part, []),
+            **step.as_dict(),
+        })
+
+    report = {
+        "evaluate_seconds": round(total.seconds, 6),
+        "evaluate_peak_bytes": int(total.peak_bytes),
+        "n_patients": int(db.n_patients),
+        "n_intervals": int(len(starts)),
+        "table_rows": {name: len(table) for name, table in db.tables.items()},
+        "measures": [
+            {"name": name, "parts_computed": sum(1 for v in first_needed_by.values() if v == name), **step.as_dict()}
+            for name, step in per_measure.items()
+        ],
+        "parts": sorted(parts, key=lambda e: -e["self_seconds"]),
+    }
+    return rows, report
+
+
+def report_path(output):
+    #output/dataset.csv.gz -> output/dataset.profile.json
+    output = Path(output)
+    return output.with_name(output.name.split(".")[0] + ".profile.json")
+
+
+def write_report(output, report, **header):
+    path = report_path(output)
+    report = {"created": datetime.now().isoformat(timespec="seconds"), **header, **report, **memory_summary()}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    return path
+
+
+def summary(report, key, n=10):
+    #The n slowest variables/measures, for the console
+    slowest = sorted(report[key], key=lambda e: -e["seconds"])[:n]
+    return "\n".join(
+        f"  {e['seconds']:8.3f}s {e['rows_scanned']:>12,} rows {e['peak_bytes'] / 2 ** 20:8.1f} MiB  {e['name']}"
+        for e in slowest
+    )
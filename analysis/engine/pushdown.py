@@ -0,0 +1,61 @@
+######################################
+
+# Population push-down for generate-dataset
+
+# Only patients in the population are written, but the variables are whole-table
+# queries: as written, has_diabetes looks at every patient's clinical_events. The cohort
+# keeps ~5% of patients (a cohort prescription, registered, no allergy, no prior
+# outcome), so run_dataset evaluates the population first and, when it is a small enough
+# share of everyone, cuts the database down to those patients' rows - a semi-join of
+# every table on the population's patient ids - and evaluates the variables there. Cost
+# then follows the cohort rather than the database.
+
+# The cut is a binary search per population patient into each event table (sorted by
+# patient), so it doesn't scan them. Series already worked out for the population, such
+# as first_cohort_abx_rx, are carried over rather than evaluated again.
+
+######################################
+
+import numpy as np
+
+from .tables import Database
+
+#Above this share of patients in the population, the cut costs more than it saves
+MAX_SHARE = 0.5
+
+
+def rows_of(table, patient_ids):
+    #Rows of `table` belonging to the (sorted, distinct) patient_ids, ascending
+    patient_id = table["patient_id"]
+    order = None
+    if len(patient_id) and (patient_id[1:] < patient_id[:-1]).any():
+        #Patient tables may not be sorted by patient
+        order = np.argsort(patient_id, kind="stable")
+        patient_id = patient_id[order]
+    starts = np.searchsorted(patient_id, patient_ids, side="left")
+    counts = np.searchsorted(patient_id, patient_ids, side="right") - starts
+    rows = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    return rows if order is None else np.sort(order[rows])
+
+
+def restrict(db, keep):
+    #Database of the patients at positions `keep` (ascending) of db.patient_ids, holding
+    #only their rows - still sorted, so not sorted again
+    patient_ids = db.patient_ids[keep]
+    tables = {}
+    for name, table in db.tables.items():
+        tables[name] = table.take(rows_of(table, patient_ids))
+    restricted = Database(tables, presorted=True)
+    #Everyone in the population, so results line up with `keep`
+    restricted.patient_ids = patient_ids
+    return restricted
+
+
+def restricted_evaluator(evaluator, keep):
+    #Evaluator over restrict(evaluator.db, keep), starting from what `evaluator` has done
+    restricted = evaluator.spawn(restrict(evaluator.db, keep))
+    restricted.cache = {node: values[keep] for node, values in evaluator.cache.items()}
+    #Codelists resolved and compiled against the same vocabularies
+    restricted.codes = evaluator.codes
+    restricted.lookups = evaluator.lookups
+    return restricted
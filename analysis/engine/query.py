@@ -0,0 +1,458 @@
+######################################
+
+# Query model for the local engine - just the parts of ehrql the study definitions use
+
+# Nodes are frozen dataclasses, so two identical expressions compare and hash equal and
+# the evaluator only computes them once. The small wrapper classes at the bottom give
+# the same spelling as ehrql (medications.where(...).sort_by(...).first_for_patient())
+# so engine/study.py can be read side by side with the real definitions.
+
+######################################
+
+from dataclasses import dataclass
+from datetime import date
+
+import numpy as np
+
+from .tables import PATIENT_TABLES, SCHEMAS
+
+
+class Node:
+    pass
+
+
+#Frames - sets of rows from one event table
+
+@dataclass(frozen=True)
+class Events(Node):
+    table: str
+
+
+@dataclass(frozen=True)
+class Filter(Node):
+    source: Node
+    condition: Node
+    exclude: bool = False #except_where: drop rows where condition is true, keep false/null
+
+
+#Values - evaluated per row (if they reference an event table column) or per patient
+
+@dataclass(frozen=True)
+class Column(Node):
+    table: str
+    name: str
+
+
+@dataclass(frozen=True)
+class Value(Node):
+    value: object
+
+
+@dataclass(frozen=True)
+class Codes(Node):
+    #Reference to codelists registered in analysis/codelists.py, unioned
+    names: tuple
+
+    def __add__(self, other):
+        return Codes(self.names + other.names)
+
+    def resolve(self):
+        import codelists
+        resolved = [getattr(codelists, name) for name in self.names]
+        if any(isinstance(codes, dict) for codes in resolved):
+            categories = {}
+            for codes in resolved:
+                categories.update(codes)
+            return categories
+        return [code for codes in resolved for code in codes]
+
+
+@dataclass(frozen=True)
+class Function(Node):
+    op: str
+    args: tuple
+
+
+@dataclass(frozen=True)
+class Exists(Node):
+    source: Node
+
+
+@dataclass(frozen=True)
+class Count(Node):
+    source: Node
+
+
+@dataclass(frozen=True)
+class Pick(Node):
+    #sort_by(sort_column).first_for_patient() / last_for_patient(), then .column
+    source: Node
+    sort_column: str
+    column: str
+    last: bool = False
+
+
+def frame_table(frame):
+    while isinstance(frame, Filter):
+        frame = frame.source
+    return frame.table
+
+
+def flatten(frame):
+    #Filter chain -> (table, [(condition, exclude), ...]) innermost first
+    conditions = []
+    while isinstance(frame, Filter):
+        conditions.append((frame.condition, frame.exclude))
+        frame = frame.source
+    return frame.table, conditions[::-1]
+
+
+def children(node):
+    if isinstance(node, Filter):
+        return (node.source, node.condition)
+    if isinstance(node, Function):
+        return node.args
+    if isinstance(node, (Exists, Count, Pick)):
+        return (node.source,)
+    return ()
+
+
+def walk(nodes):
+    #Every node reachable from `nodes`, each once, children before parents
+    seen = set()
+    order = []
+
+    def visit(node):
+        if node in seen:
+            return
+        seen.add(node)
+        for child in children(node):
+            visit(child)
+        order.append(node)
+
+    for node in nodes:
+        visit(node)
+    return order
+
+
+def row_table(node):
+    #Event table whose rows this value is defined over, or None for patient-level values
+    if isinstance(node, Column):
+        return None if node.table in PATIENT_TABLES else node.table
+    if isinstance(node, Function):
+        for arg in node.args:
+            table = row_table(arg)
+            if table is not None:
+                return table
+    return None
+
+
+#Result kinds, used by the output writers
+
+BOOL_OPS = {"and", "or", "not", "eq", "ne", "lt", "le", "gt", "ge", "is_null", "is_not_null", "is_in", "between"}
+INT_OPS = {"year", "month", "day", "age_on", "imd_decile", "floordiv"}
+DATE_OPS = {"add_days", "add_months"}
+
+
+def kind_of(node):
+    if isinstance(node, (Exists,)):
+        return "bool"
+    if isinstance(node, Count):
+        return "int"
+    if isinstance(node, Column):
+        return SCHEMAS[node.table][node.name]
+    if isinstance(node, Pick):
+        return SCHEMAS[frame_table(node.source)][node.column]
+    if isinstance(node, Value):
+        if isinstance(node.value, np.datetime64):
+            return "date"
+        return {bool: "bool", int: "int", float: "float"}.get(type(node.value), "str")
+    if isinstance(node, Function):
+        if node.op in BOOL_OPS:
+            return "bool"
+        if node.op in INT_OPS:
+            return "int"
+        if node.op in DATE_OPS:
+            return "date"
+        if node.op == "to_category":
+            return "str"
+        if node.op == "if_else":
+            return kind_of(node.args[1])
+        return kind_of(node.args[0])
+    raise TypeError(node)
+
+
+#ehrql-style wrappers
+
+def as_node(value):
+    if isinstance(value, Series):
+        return value.node
+    if isinstance(value, Node):
+        return value
+    if isinstance(value, str):
+        #Dates are written as strings; anything else is a category, eg. == "N"
+        try:
+            return Value(np.datetime64(date.fromisoformat(value), "D"))
+        except ValueError:
+            return Value(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        #.is_in(["E", "S"]) - a tuple, so nodes stay hashable
+        return Value(tuple(value))
+    if isinstance(value, date):
+        return Value(np.datetime64(value, "D"))
+    return Value(value)
+
+
+class Duration:
+    def __init__(self, unit, n):
+        self.unit = unit
+        self.n = n
+
+    def __neg__(self):
+        return Duration(self.unit, self.n * -1)
+
+    def __radd__(self, other):
+        #"2010-12-01" + days(n)
+        return Series(as_node(other)) + self
+
+
+def days(n):
+    return Duration("days", n)
+
+
+def weeks(n):
+    return Duration("days", n * 7)
+
+
+def months(n):
+    return Duration("months", n)
+
+
+def years(n):
+    return Duration("months", n * 12)
+
+
+def codes(*names):
+    return Codes(tuple(names))
+
+
+class Series:
+    __hash__ = None
+
+    def __init__(self, node):
+        self.node = node
+
+    def _f(self, op, *others):
+        return Series(Function(op, (self.node,) + tuple(as_node(o) for o in others)))
+
+    def __and__(self, other):
+        return self._f("and", other)
+
+    def __or__(self, other):
+        return self._f("or", other)
+
+    def __invert__(self):
+        return self._f("not")
+
+    def __eq__(self, other):
+        return self._f("eq", other)
+
+    def __ne__(self, other):
+        return self._f("ne", other)
+
+    def __lt__(self, other):
+        return self._f("lt", other)
+
+    def __le__(self, other):
+        return self._f("le", other)
+
+    def __gt__(self, other):
+        return self._f("gt", other)
+
+    def __ge__(self, other):
+        return self._f("ge", other)
+
+    def __add__(self, other):
+        if isinstance(other, Duration):
+            op = "add_days" if other.unit == "days" else "add_months"
+            return self._f(op, other.n)
+        return self._f("add", other)
+
+    def __sub__(self, other):
+        if isinstance(other, Duration):
+            return self + (-other)
+        return self._f("sub", other)
+
+    def __mul__(self, other):
+        return self._f("mul", other)
+
+    def __floordiv__(self, other):
+        return self._f("floordiv", other)
+
+    def is_null(self):
+        return self._f("is_null")
+
+    def is_not_null(self):
+        return self._f("is_not_null")
+
+    def is_in(self, codelist):
+        return self._f("is_in", codelist)
+
+    def to_category(self, codelist):
+        return self._f("to_category", codelist)
+
+    def is_before(self, other):
+        return self < other
+
+    def is_on_or_before(self, other):
+        return self <= other
+
+    def is_after(self, other):
+        return self > other
+
+    def is_on_or_after(self, other):
+        return self >= other
+
+    def is_on_or_between(self, low, high):
+        return self._f("between", low, high)
+
+    @property
+    def year(self):
+        return self._f("year")
+
+    @property
+    def month(self):
+        return self._f("month")
+
+    @property
+    def day(self):
+        return self._f("day")
+
+
+class When:
+    def __init__(self, condition):
+        self.condition = condition
+
+    def then(self, value):
+        return (self.condition, value)
+
+
+def when(condition):
+    return When(condition)
+
+
+def case(*cases, otherwise=None):
+    #Nested if_else - first matching case wins
+    result = as_node(otherwise)
+    for condition, value in reversed(cases):
+        result = Function("if_else", (as_node(condition), as_node(value), result))
+    return Series(result)
+
+
+class Row:
+    def __init__(self, frame, sort_column, last):
+        self._frame = frame
+        self._sort_column = sort_column
+        self._last = last
+
+    def __getattr__(self, column):
+        if column.startswith("_"):
+            raise AttributeError(column)
+        if column == "imd_decile":
+            #Derived from imd_rounded, as in ehrql
+            imd = Pick(self._frame.node, self._sort_column, "imd_rounded", self._last)
+            return Series(Function("imd_decile", (imd,)))
+        return Series(Pick(self._frame.node, self._sort_column, column, self._last))
+
+
+class Sorted:
+    def __init__(self, frame, sort_column):
+        self._frame = frame
+        self._sort_column = sort_column
+
+    def first_for_patient(self):
+        return Row(self._frame, self._sort_column, False)
+
+    def last_for_patient(self):
+        return Row(self._frame, self._sort_column, True)
+
+
+class Frame:
+    def __init__(self, node):
+        self.node = node
+        self.table = frame_table(node)
+
+    def __getattr__(self, column):
+        if column.startswith("_") or column not in SCHEMAS[self.table]:
+            raise AttributeError(column)
+        return Series(Column(self.table, column))
+
+    def where(self, condition):
+        return Frame(Filter(self.node, as_node(condition)))
+
+    def except_where(self, condition):
+        return Frame(Filter(self.node, as_node(condition), exclude=True))
+
+    def sort_by(self, column):
+        return Sorted(self, column.node.name)
+
+    def exists_for_patient(self):
+        return Series(Exists(self.node))
+
+    def count_for_patient(self):
+        return Series(Count(self.node))
+
+
+class PatientsFrame(Frame):
+    def age_on(self, date_):
+        return Series(Function("age_on", (Column("patients", "date_of_birth"), as_node(date_))))
+
+
+class AddressesFrame(Frame):
+    def for_patient_on(self, date_):
+        #As ehrql: address active on the date, latest start wins
+        active = self.where(self.start_date <= date_).except_where(self.end_date <= date_)
+        return active.sort_by(active.start_date).last_for_patient()
+
+
+class RegistrationsFrame(Frame):
+    def spanning(self, start, end):
+        return self.where(self.start_date <= start).except_where(self.end_date <= end)
+
+
+class Tables:
+    patients = PatientsFrame(Events("patients"))
+    ons_deaths = Frame(Events("ons_deaths"))
+    medications = Frame(Events("medications"))
+    clinical_events = Frame(Events("clinical_events"))
+    practice_registrations = RegistrationsFrame(Events("practice_registrations"))
+    addresses = AddressesFrame(Events("addresses"))
+    apcs = Frame(Events("apcs"))
+
+
+tables = Tables()
+
+
+class Dataset:
+    def __init__(self):
+        object.__setattr__(self, "variables", {})
+        object.__setattr__(self, "population", None)
+
+    def define_population(self, condition):
+        object.__setattr__(self, "population", as_node(condition))
+
+    def configure_dummy_data(self, **kwargs):
+        pass
+
+    def __setattr__(self, name, value):
+        self.variables[name] = as_node(value)
+
+    def __getattr__(self, name):
+        try:
+            return Series(self.variables[name])
+        except KeyError:
+            raise AttributeError(name)
+
+
+def create_dataset():
+    return Dataset()
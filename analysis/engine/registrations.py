@@ -0,0 +1,121 @@
+######################################
+
+# Index over practice_registrations for spanning/covering queries
+
+# Every registration query in the study has the same shape:
+
+#   practice_registrations.where(start_date <= A).except_where(end_date < B).exists_for_patient()
+
+# (spanning(A, B) is the same with end_date <= B). That is "of the patient's spells
+# starting on or before A, does the one that ends latest end on/after B". So each
+# patient's spells are kept sorted by start_date with a running max of end_date - the
+# spells merged into how far the patient's registration reaches by each start - and a
+# query is one binary search per patient, O(log k) in their k spells. The dates are
+# converted and the index built once per Database, shared by all registration queries.
+
+# The index also gives, for a list of intervals, the runs of intervals each patient is
+# registered across - what RegisteredSpanning needs for every measure interval in one
+# pass.
+
+######################################
+
+import numpy as np
+
+from .query import Column, Events, Exists, Filter, Function, row_table
+
+TABLE = "practice_registrations"
+#Dates as days since 1970, well inside +/- FAR; null start never matches, null end never ends
+FAR = 10 ** 7
+
+
+class RegistrationIndex:
+    def __init__(self, db):
+        table = db[TABLE] #sorted by patient, then start_date
+        self.n_patients = db.n_patients
+        self.pidx = db.pidx(TABLE).astype(np.int64)
+        self.start = days(table["start_date"], FAR)
+        self.end = days(table["end_date"], FAR)
+        #Spells ordered by a composite (patient, start) key to search, and the latest end so far per patient
+        self.width = 2 * FAR + 2
+        keys = self.pidx * self.width + (self.start + FAR)
+        order = np.argsort(keys, kind="stable") #a no-op bar null start_dates, which sort last here
+        self.keys, self.spell_pidx = keys[order], self.pidx[order]
+        offset = self.spell_pidx * self.width
+        self.reach = np.maximum.accumulate(offset + self.end[order] + FAR) - offset - FAR
+
+    @classmethod
+    def for_db(cls, db):
+        #Built once per Database
+        if TABLE not in db.indexes:
+            db.indexes[TABLE] = cls(db)
+        return db.indexes[TABLE]
+
+    def covers_all(self, start, end, strict=False):
+        #Whether each patient has a spell with start_date <= start and end_date >= end (>
+        #end if strict) - start/end are aligned with patient_ids, or a single date. A null
+        #start matches nothing, a null end any spell
+        start_days, end_days = days(start, -FAR - 1), days(end, -FAR)
+        patients = np.arange(self.n_patients, dtype=np.int64)
+        #The patient's last spell starting on or before start, if any
+        position = np.searchsorted(self.keys, patients * self.width + (start_days + FAR), side="right") - 1
+        found = (position >= 0) & (start_days >= -FAR)
+        found[found] = self.spell_pidx[position[found]] == patients[found]
+        reach = self.reach[np.maximum(position, 0)]
+        return found & ((reach > end_days) if strict else (reach >= end_days))
+
+    def interval_runs(self, starts, ends):
+        #-> (pidx, lo, hi): per patient, non-overlapping runs of interval indices with a spell spanning each
+        starts, ends = np.asarray(starts).astype(np.int64), np.asarray(ends).astype(np.int64)
+        lo = np.searchsorted(starts, self.start, side="left")
+        hi = np.searchsorted(ends, self.end, side="left") - 1 #spanning: end_date after the interval end
+        keep = (hi >= lo) & (self.start < FAR)
+        return merge_runs(self.pidx[keep], lo[keep], hi[keep])
+
+
+def days(dates, null):
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    return np.where(np.isnat(dates), null, dates.astype(np.int64))
+
+
+def merge_runs(pidx, lo, hi):
+    #Union of each patient's runs, so a patient with overlapping spells counts once
+    order = np.lexsort((lo, pidx))
+    pidx, lo, hi = pidx[order], lo[order], hi[order]
+    if not len(pidx):
+        return pidx, lo, hi
+    #Running max of hi within each patient (offset by patient so it restarts at each one)
+    offset = pidx * (int(hi.max()) + 2)
+    reach = np.maximum.accumulate(offset + hi) - offset
+    new_run = np.r_[True, (pidx[1:] != pidx[:-1]) | (lo[1:] > reach[:-1] + 1)]
+    starts = np.flatnonzero(new_run)
+    ends = np.r_[starts[1:], len(pidx)] - 1
+    return pidx[starts], lo[starts], reach[ends]
+
+
+def match_covers(node):
+    #Exists over where(start_date <= A).except_where(end_date < B) (or <= B) -> (A, B, strict), else None
+    if not isinstance(node, Exists):
+        return None
+    outer = node.source
+    if not (isinstance(outer, Filter) and outer.exclude and isinstance(outer.source, Filter)):
+        return None
+    inner = outer.source
+    if inner.exclude or not (isinstance(inner.source, Events) and inner.source.table == TABLE):
+        return None
+    start, end = inner.condition, outer.condition
+    if not (
+        isinstance(start, Function) and start.op == "le" and start.args[0] == Column(TABLE, "start_date")
+        and isinstance(end, Function) and end.op in ("lt", "le") and end.args[0] == Column(TABLE, "end_date")
+        and row_table(start.args[1]) is None and row_table(end.args[1]) is None
+    ):
+        return None
+    return start.args[1], end.args[1], end.op == "le"
+
+
+def evaluate_covers(evaluator, node):
+    #Patient-level result for a matching Exists node, or None to evaluate it the ordinary way
+    matched = match_covers(node)
+    if matched is None or TABLE not in evaluator.db:
+        return None
+    start, end, strict = matched
+    return RegistrationIndex.for_db(evaluator.db).covers_all(evaluator.argument(start), evaluator.argument(end), strict)
@@ -0,0 +1,230 @@
+######################################
+
+# Risk-set (incidence density) control sampling during extraction (--risk-set)
+
+#python analysis/run_engine.py generate-dataset ctc_tendinitis --tables tpp_extract --output output/ctc_sampled.arrow --risk-set
+
+# The CTC extraction evaluates every variable - the 12 exposure windows included - for
+# all potential controls, only for matching to keep 3 per case. Here the extraction
+# samples them itself, in two passes:
+
+# 1. Over everyone, only what sampling needs: the population, the case flag and index
+#    date, the category match variables (sex) and the date of birth behind age.
+# 2. For each case, in index date order, draw matches_per_case controls at random from
+#    its risk set: patients in the population, in the same strata, within the age
+#    tolerance at the case's index date, and not (yet) a case by that date. Every
+#    variable is then evaluated for the cases and sampled controls only, with each
+#    control taking its case's index date - as matching's "no_offset" does.
+
+# As in incidence density sampling, a patient can be a control for several cases, and a
+# control for an earlier case before becoming a case themselves. The draw is seeded, so
+# a rerun samples the same controls. Rows come out in sets - case then its controls -
+# with set_id the case's patient_id, the same as matching's output.
+
+######################################
+
+import numpy as np
+
+from .evaluate import Evaluator, add_months, age_on
+from .matching import bucket_keys
+from .query import Function
+from .tables import Database, Table
+
+#Rounds of vectorised draws before a case still short of controls is sampled exhaustively
+MAX_ROUNDS = 8
+#Dates as days since 1970, well inside +/- FAR
+FAR = 10 ** 7
+
+
+def age_bounds(index_dates, min_age, max_age):
+    #-> (earliest, latest) date of birth with min_age <= age_on(dob, index_date) <= max_age
+    def first_ok(candidates, ok):
+        out = candidates[-1]
+        for candidate in reversed(candidates[:-1]):
+            out = np.where(ok(candidate), candidate, out)
+        return out
+
+    min_age, max_age = np.asarray(min_age).astype(np.int64), np.asarray(max_age).astype(np.int64)
+    one = np.timedelta64(1, "D")
+    #Around the birthday, add_months' rolling of 29 February can be a day out either way
+    latest = add_months(index_dates, -12 * min_age)
+    latest = first_ok([latest + one, latest, latest - one], lambda dob: age_on(dob, index_dates) >= min_age)
+    earliest = add_months(index_dates, -12 * (max_age + 1)) + one
+    earliest = first_ok([earliest - one, earliest, earliest + one], lambda dob: age_on(dob, index_dates) <= max_age)
+    return earliest, latest
+
+
+def risk_set_ranges(case_keys, case_dates, case_ages, pool_keys, pool_dobs, tolerance):
+    #-> (order of the pool, lo, hi): each case's strata/age range of the sorted pool
+    days = lambda dates: np.where(np.isnat(dates), FAR, dates.astype(np.int64)) + FAR
+    width = 2 * FAR + 1
+    pool = pool_keys * width + (days(pool_dobs) if pool_dobs is not None else 0)
+    order = np.argsort(pool, kind="stable")
+    pool = pool[order]
+    if pool_dobs is None:
+        lo = np.searchsorted(pool, case_keys, side="left")
+        hi = np.searchsorted(pool, case_keys, side="right")
+        return order, lo, hi
+    earliest, latest = age_bounds(case_dates, np.ceil(case_ages - tolerance), np.floor(case_ages + tolerance))
+    lo = np.searchsorted(pool, case_keys * width + days(earliest), side="left")
+    hi = np.searchsorted(pool, case_keys * width + days(latest), side="right")
+    return order, lo, np.maximum(hi, lo)
+
+
+def draw(rng, lo, hi, eligible, k):
+    #-> (case, position) pairs: up to k distinct eligible positions in [lo, hi) per case,
+    #uniformly without replacement. eligible(cases, positions) -> bool
+    n = len(lo)
+    size = hi - lo
+    #Draws with replacement, 2k per case a round; the first k distinct eligible ones are kept
+    cases, positions, sequence = [], [], []
+    need = np.where(size > 0, k, 0)
+    drawn = 0
+    for _ in range(MAX_ROUNDS):
+        active = np.flatnonzero(need > 0)
+        if not len(active):
+            break
+        c = np.repeat(active, 2 * k)
+        p = lo[c] + (rng.random(len(c)) * size[c]).astype(np.int64)
+        ok = eligible(c, p)
+        cases.append(c[ok])
+        positions.append(p[ok])
+        sequence.append(drawn + np.flatnonzero(ok))
+        drawn += len(c)
+        chosen_cases, _ = first_distinct(cases, positions, sequence, k)
+        need = np.where(size > 0, k, 0) - np.bincount(chosen_cases, minlength=n)
+    chosen_cases, chosen_positions = first_distinct(cases, positions, sequence, k)
+    short = np.flatnonzero(need > 0)
+    if len(short):
+        #Few eligible in range: take k of them at random, from scratch for these cases
+        keep = ~np.isin(chosen_cases, short)
+        chosen_cases, chosen_positions = [chosen_cases[keep]], [chosen_positions[keep]]
+        for case in short.tolist():
+            candidates = np.arange(lo[case], hi[case])
+            candidates = candidates[eligible(np.full(len(candidates), case), candidates)]
+            picked = rng.permutation(candidates)[:k]
+            chosen_cases.append(np.full(len(picked), case))
+            chosen_positions.append(picked)
+        chosen_cases, chosen_positions = np.concatenate(chosen_cases), np.concatenate(chosen_positions)
+    order = np.lexsort((chosen_positions, chosen_cases))
+    return chosen_cases[order], chosen_positions[order]
+
+
+def first_distinct(cases, positions, sequence, k):
+    #Of the accepted draws so far, each case's first k distinct positions in draw order
+    if not cases:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    cases, positions, sequence = np.concatenate(cases), np.concatenate(positions), np.concatenate(sequence)
+    order = np.lexsort((sequence, positions, cases))
+    cases, positions, sequence = cases[order], positions[order], sequence[order]
+    first = np.r_[True, (cases[1:] != cases[:-1]) | (positions[1:] != positions[:-1])] if len(cases) else np.empty(0, bool)
+    cases, positions, sequence = cases[first], positions[first], sequence[first]
+    order = np.lexsort((sequence, cases))
+    cases, positions = cases[order], positions[order]
+    starts = np.searchsorted(cases, cases, side="left")
+    keep = np.arange(len(cases)) - starts < k
+    return cases[keep], positions[keep]
+
+
+def row_database(db, pidx):
+    #Database with one pseudo-patient per entry of pidx (a patient can appear several
+    #times) holding that patient's rows; pseudo patient_ids are 0..len(pidx)-1
+    tables = {}
+    #Sorted, distinct patients make the searches below cache-friendly
+    wanted, inverse = np.unique(db.patient_ids[pidx], return_inverse=True)
+    for name, table in db.tables.items():
+        patient_id = table["patient_id"]
+        #Event tables are sorted by patient already; patient tables may not be
+        order = np.arange(len(patient_id))
+        if len(patient_id) and (patient_id[1:] < patient_id[:-1]).any():
+            order = np.argsort(patient_id, kind="stable")
+        starts = np.searchsorted(patient_id[order], wanted, side="left")[inverse]
+        counts = np.searchsorted(patient_id[order], wanted, side="right")[inverse] - starts
+        owner = np.repeat(np.arange(len(pidx)), counts)
+        rows = order[np.repeat(starts, counts) + np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)]
+        taken = table.take(rows)
+        taken.columns["patient_id"] = owner.astype(np.int64)
+        tables[name] = Table(name, taken.columns, taken.vocabularies)
+    rows_db = Database(tables)
+    #Everyone, even with no rows in any table, so results line up with pidx
+    rows_db.patient_ids = np.arange(len(pidx), dtype=np.int64)
+    return rows_db
+
+
+def run_risk_set(db, dataset, config, seed=1, fused=True):
+    #-> (patient_ids, {"set_id": ..., variable: values}) for the cases and their sampled controls
+    variables = dataset.variables
+    case_node = variables[config["case_variable"]]
+    index_node = variables[config["index_date_variable"]]
+    k = config["matches_per_case"]
+    exact = [v for v, rule in config["match_variables"].items() if rule == "category"]
+    numeric = [(v, float(rule)) for v, rule in config["match_variables"].items() if rule != "category"]
+    if len(numeric) > 1:
+        raise ValueError("only one numeric match variable is supported")
+    dob_node, tolerance = None, 0.0
+    if numeric:
+        (variable, tolerance), = numeric
+        node = variables[variable]
+        #The age has to be worked out again at each case's date
+        if not (isinstance(node, Function) and node.op == "age_on" and node.args[1] == index_node):
+            raise ValueError(f"{variable} must be age_on(<date of birth>, {config['index_date_variable']})")
+        dob_node = node.args[0]
+
+    #Pass 1: what sampling needs, for everyone
+    evaluator = Evaluator(db, fused=fused)
+    nodes = [dataset.population, case_node, index_node] + [variables[v] for v in exact] + ([dob_node] if dob_node else [])
+    population, is_case, index_dates, *rest = evaluator.evaluate_all(nodes)
+    dobs = rest[len(exact)] if dob_node else None
+    index_dates = index_dates.astype("datetime64[D]")
+
+    pool = np.flatnonzero(population)
+    keys = bucket_keys({v: values[pool] for v, values in zip(exact, rest)}, exact, len(pool))
+    pool_dobs = None if dobs is None else dobs[pool].astype("datetime64[D]")
+    #Date each pool member became a case (NaT: never) - a case's risk set excludes earlier cases
+    became_case = np.where(is_case[pool], index_dates[pool], np.datetime64("NaT"))
+
+    in_pool = np.flatnonzero(is_case[pool] & ~np.isnat(index_dates[pool]))
+    #Cases in index date order (then patient_id), as matching takes them
+    in_pool = in_pool[np.lexsort((db.patient_ids[pool[in_pool]], index_dates[pool[in_pool]]))]
+    case_dates = index_dates[pool[in_pool]]
+    case_ages = None
+    if pool_dobs is not None:
+        case_ages = age_on(pool_dobs[in_pool], case_dates)
+        ok = ~np.isnan(case_ages)
+        in_pool, case_dates, case_ages = in_pool[ok], case_dates[ok], case_ages[ok]
+        #Patients with no date of birth have no age to match on
+        candidates = np.flatnonzero(~np.isnat(pool_dobs))
+    else:
+        candidates = np.arange(len(pool))
+
+    order, lo, hi = risk_set_ranges(
+        keys[in_pool], case_dates, case_ages, keys[candidates], None if pool_dobs is None else pool_dobs[candidates], tolerance,
+    )
+    sorted_pool = candidates[order]
+    sorted_became = became_case[sorted_pool]
+
+    def eligible(cases, positions):
+        #Not the case itself, and not a case on or before its date
+        member = sorted_pool[positions]
+        return (member != in_pool[cases]) & ~(sorted_became[positions] <= case_dates[cases])
+
+    rng = np.random.default_rng(seed)
+    control_cases, control_positions = draw(rng, lo, hi, eligible, k)
+
+    #Pass 2: everything, for cases then each case's controls
+    set_index = np.concatenate([np.arange(len(in_pool)), control_cases])
+    role = np.concatenate([np.ones(len(in_pool), dtype=bool), np.zeros(len(control_cases), dtype=bool)])
+    members = np.concatenate([in_pool, sorted_pool[control_positions]])
+    rows = np.lexsort((~role, set_index))
+    set_index, role, members = set_index[rows], role[rows], members[rows]
+
+    rows_db = row_database(db, pool[members])
+    evaluator = Evaluator(rows_db, fused=fused)
+    #Each row's index date is its case's, and its role is the one it was sampled for
+    evaluator.cache[index_node] = case_dates[set_index]
+    evaluator.cache[case_node] = role
+    names = list(variables)
+    columns = evaluator.evaluate_all([variables[name] for name in names])
+    patient_ids = db.patient_ids[pool[members]]
+    set_ids = db.patient_ids[pool[in_pool]][set_index]
+    return patient_ids, {"set_id": set_ids, **dict(zip(names, columns))}
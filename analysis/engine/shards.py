@@ -0,0 +1,70 @@
+######################################
+
+# Patient-sharded extraction
+
+#python analysis/run_engine.py generate-dataset cohort --tables dummy_tables_1m --output output/engine/dataset.arrow --shards 8
+
+# Every variable in our definitions is per patient, so patients can be split into shards
+# and each shard evaluated on its own. Patients are hash-partitioned on patient_id. The
+# raw arrow tables are read once in the parent; each forked worker takes its shard's
+# rows, converts them to numpy and runs the definition, so conversion and evaluation
+# both run in parallel. Shard results are merged back into patient_id order - the order
+# a serial run writes - so the output is identical.
+
+######################################
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+
+from .evaluate import run_dataset
+from .study import DATASETS
+from .tables import Database, from_arrow
+
+#Arrow tables for the workers - set in the parent just before forking, so they are shared rather than pickled
+_TABLES = None
+
+
+def shard_of(patient_ids, n_shards):
+    #Fibonacci hash, so runs of consecutive ids spread evenly across shards
+    hashed = (np.asarray(patient_ids).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    return (hashed % np.uint64(n_shards)).astype(np.int64)
+
+
+def shard_database(arrow_tables, shard, n_shards):
+    tables = {}
+    for name, table in arrow_tables.items():
+        keep = shard_of(table.column("patient_id").to_numpy(), n_shards) == shard
+        tables[name] = from_arrow(name, table.filter(pa.array(keep)))
+    return Database(tables)
+
+
+def run_shard(definition, shard, n_shards, fused):
+    db = shard_database(_TABLES, shard, n_shards)
+    return run_dataset(db, DATASETS[definition](), fused=fused)
+
+
+def merge(parts):
+    #Shards hold disjoint patients; put them back in patient_id order
+    patient_ids = np.concatenate([ids for ids, _ in parts])
+    order = np.argsort(patient_ids, kind="stable")
+    names = list(parts[0][1])
+    columns = {name: np.concatenate([columns[name] for _, columns in parts])[order] for name in names}
+    return patient_ids[order], columns
+
+
+def run_sharded(arrow_tables, definition, n_shards, workers=None, fused=True):
+    #-> (patient_ids, {variable: values}), as run_dataset on the whole database
+    global _TABLES
+    _TABLES = arrow_tables
+    try:
+        #fork, so workers see _TABLES without a copy (the study runs on Linux)
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(min(workers or n_shards, n_shards), mp_context=context) as pool:
+            futures = [pool.submit(run_shard, definition, shard, n_shards, fused) for shard in range(n_shards)]
+            parts = [future.result() for future in futures]
+    finally:
+        _TABLES = None
+    return merge(parts)
@@ -0,0 +1,362 @@
+######################################
+
+# The study definitions, mirrored for the local engine
+
+# Keep these in step with the ehrql definitions in analysis/ - they are written the
+# same way on purpose so a change to one is easy to copy to the other, and
+# tests/test_mirror.py fails when a variable or measure is missing here or differs.
+
+######################################
+
+from datetime import date
+
+from .measures import (
+    CountInInterval, ExistsBeforeDate, ExistsBeforeIntervalStart, ExistsInInterval, FirstInInterval, Measure,
+    RegisteredSpanning, monthly_intervals,
+)
+from .lookback import lookback_features
+from .query import case, codes, create_dataset, days, months, tables, when, years
+
+patients = tables.patients
+medications = tables.medications
+clinical_events = tables.clinical_events
+practice_registrations = tables.practice_registrations
+addresses = tables.addresses
+apcs = tables.apcs
+ons_deaths = tables.ons_deaths
+
+start_date = "2010-12-01"
+end_date = "2024-08-01"
+
+#Codelists - names as registered in analysis/codelists.py
+
+amoxicillin_codes = codes("amoxicillin_codes")
+amox_clavulanicacid_codes = codes("amox_clavulanicacid_codes")
+cefalexin_codes = codes("cefalexin_codes")
+trimethoprim_codes = codes("trimethoprim_codes")
+trim_sulfa_codes = codes("trim_sulfa_codes")
+fluoroquinolone_codes = codes("fluoroquinolone_codes")
+
+cohort_abx_codes = amox_clavulanicacid_codes + fluoroquinolone_codes
+
+tendinitis_codes = codes("tendinitis_codes")
+neuropathy_newdx_codes = codes("neuropathy_newdx_codes")
+combo_outcome_codes = tendinitis_codes + neuropathy_newdx_codes
+
+ethnicity_codelist = codes("ethnicity_codelist")
+bmi_codelist = codes("bmi_codelist")
+harmful_alcohol_codelist = codes("harmful_alcohol_codelist")
+
+comorbidity_codelists_ctv3 = {
+    "had_cancer": codes("lung_cancer_codelist", "notlung_nothaem_cancer_codelist", "haem_cancer_codelist"),
+    "chronic_liver_disease": codes("chronic_liver_disease_codelist"),
+    "chronic_resp_disease": codes("chronic_resp_exc_asthma_codelist", "asthma_codelist"),
+    "diabetes": codes("diabetes_codelist"),
+    "dementia": codes("dementia_codelist"),
+    "hiv": codes("hiv_codelist"),
+    "heart_failure": codes("heart_failure_codelist"),
+    "hemiplegia": codes("hemiplegia_codelist"),
+    "multiple_sclerosis": codes("multiple_sclerosis_codelist"),
+    "rheumatoid_arthritis": codes("rheumatoid_arthritis_codelist"),
+    "solid_organ_transplant": codes("solid_organ_transplant_codelist"),
+    "stroke_tia": codes("stroke_codelist", "tia_codelist"),
+}
+
+comorbidity_codelists_snomedct = {
+    "aaa": codes("aaa_codelist"),
+    "ckd": codes("ckd_codelist"),
+    "coronary_hd": codes("coronary_hd_codelist"),
+    "hypertension": codes("hypertension_codelist"),
+    "peptic_ulcer": codes("peptic_ulcer_codelist"),
+    "pvd": codes("pvd_codelist"),
+}
+
+corticosteroid_codes = codes("corticosteroid_codes")
+drug_causes_of_neuropathy_codes = codes("phenytoin_codes", "amiodarone_codes", "metronidazole_codes", "nitrofurantoin_codes")
+cohort_abx_allergy_codes = codes("fluoroquinolone_allergy_codes", "co_amox_allergy_codes")
+
+
+#Look-back windows (days) for the sensitivity analyses - cohort_lookback
+lookback_windows = [30, 60, 90, 180, 365]
+
+
+def cohort_dataset(lookback_windows=None):
+    #analysis/dataset_definition.py; with lookback_windows, plus the look-back
+    #covariates at each of them (engine only)
+    dataset = create_dataset()
+
+    first_cohort_rx = medications.where(
+        medications.dmd_code.is_in(cohort_abx_codes)
+    ).where(
+        medications.date.is_on_or_between(start_date, end_date)
+    ).sort_by(medications.date).first_for_patient()
+
+    first_cohort_abx_rx = first_cohort_rx.date
+
+    dataset.fluoroquinolone_exp = first_cohort_rx.dmd_code.is_in(fluoroquinolone_codes)
+
+    has_registration_1y_before_cohort_abx = (
+        practice_registrations.where(practice_registrations.start_date <= (first_cohort_abx_rx + years(1)))
+        .except_where(practice_registrations.end_date < end_date)
+        .exists_for_patient()
+    )
+
+    prior_tendinitis_or_neuropathy = clinical_events.where(
+        clinical_events.snomedct_code.is_in(combo_outcome_codes)
+    ).where(
+        clinical_events.date.is_on_or_before(first_cohort_abx_rx)
+    ).exists_for_patient()
+
+    cohort_abx_allergy = clinical_events.where(
+        clinical_events.snomedct_code.is_in(cohort_abx_allergy_codes)
+    ).where(
+        clinical_events.date.is_on_or_before(first_cohort_abx_rx)
+    ).exists_for_patient()
+
+    dataset.define_population(
+        patients.exists_for_patient()
+        & has_registration_1y_before_cohort_abx
+        & ~cohort_abx_allergy
+        & ~prior_tendinitis_or_neuropathy
+    )
+
+    dataset.first_tendinitis_diagnosis_date = clinical_events.where(
+        clinical_events.snomedct_code.is_in(tendinitis_codes)
+    ).where(
+        clinical_events.date.is_on_or_after(start_date)
+    ).sort_by(clinical_events.date).first_for_patient().date
+
+    dataset.first_neuropathy_diagnosis_date = clinical_events.where(
+        clinical_events.snomedct_code.is_in(neuropathy_newdx_codes)
+    ).where(
+        clinical_events.date.is_on_or_after(start_date)
+    ).sort_by(clinical_events.date).first_for_patient().date
+
+    dataset.sex = patients.sex
+    dataset.age = patients.age_on(first_cohort_abx_rx)
+    dataset.date_of_birth = patients.date_of_birth
+    dataset.imd = addresses.for_patient_on(first_cohort_abx_rx).imd_rounded
+    patient_address = addresses.for_patient_on(first_cohort_abx_rx)
+    dataset.imd_decile = patient_address.imd_decile
+    dataset.date_of_death = ons_deaths.date
+
+    dataset.last_bmi = (
+        clinical_events.where(clinical_events.snomedct_code.is_in(bmi_codelist))
+        .where(clinical_events.date.is_on_or_before(first_cohort_abx_rx))
+        .sort_by(clinical_events.date)
+        .last_for_patient()
+        .numeric_value
+    )
+
+    dataset.latest_ethnicity_code = (
+        clinical_events.where(clinical_events.snomedct_code.is_in(ethnicity_codelist))
+        .where(clinical_events.date.is_on_or_before(end_date))
+        .sort_by(clinical_events.date)
+        .last_for_patient()
+        .snomedct_code
+    )
+    dataset.latest_ethnicity_group = dataset.latest_ethnicity_code.to_category(ethnicity_codelist)
+
+    dataset.harmful_alcohol = (
+        clinical_events.where(clinical_events.ctv3_code.is_in(harmful_alcohol_codelist))
+        .where(clinical_events.date.is_on_or_before(first_cohort_abx_rx))
+        .exists_for_patient()
+    )
+
+    dataset.n_hosp_appt_6m = apcs.where(apcs.admission_date.is_on_or_between(
+        first_cohort_abx_rx - months(6), first_cohort_abx_rx - days(1)
+    )).count_for_patient()
+
+    for condition, codelist in comorbidity_codelists_ctv3.items():
+        setattr(
+            dataset,
+            f"has_{condition}",
+            clinical_events.where(clinical_events.ctv3_code.is_in(codelist))
+            .where(clinical_events.date.is_before(first_cohort_abx_rx))
+            .exists_for_patient(),
+        )
+
+    for condition, codelist in comorbidity_codelists_snomedct.items():
+        setattr(
+            dataset,
+            f"has_{condition}",
+            clinical_events.where(clinical_events.snomedct_code.is_in(codelist))
+            .where(clinical_events.date.is_before(first_cohort_abx_rx))
+            .exists_for_patient(),
+        )
+
+    dataset.date_cohort_prescription = first_cohort_abx_rx
+    dataset.year_cohort_prescription = first_cohort_abx_rx.year
+
+    dataset.corticosteroid_60d_before_abx = medications.where(
+        medications.dmd_code.is_in(corticosteroid_codes)
+    ).where(
+        medications.date.is_on_or_between(first_cohort_abx_rx - days(60), first_cohort_abx_rx - days(1))
+    ).exists_for_patient()
+
+    dataset.drug_linked_to_neuropathy_60d_before_abx = medications.where(
+        medications.dmd_code.is_in(drug_causes_of_neuropathy_codes)
+    ).where(
+        medications.date.is_on_or_between(first_cohort_abx_rx - days(60), first_cohort_abx_rx - days(1))
+    ).exists_for_patient()
+
+    if lookback_windows:
+        #Every codelist x window in one pass per table - see engine/lookback.py
+        lookback_features(dataset, "apcs", {"hosp_appt": None}, lookback_windows, first_cohort_abx_rx, count=True, name="n_{codelist}_{window}d")
+        lookback_features(
+            dataset, "medications",
+            {"corticosteroid": corticosteroid_codes, "drug_linked_to_neuropathy": drug_causes_of_neuropathy_codes},
+            lookback_windows, first_cohort_abx_rx, code_column="dmd_code", name="{codelist}_{window}d_before_abx",
+        )
+
+    return dataset
+
+
+antibiotic_codelists_dmd = {
+    "amoxicillin": amoxicillin_codes,
+    "amox_clavulanic_acid": amox_clavulanicacid_codes,
+    "cefalexin": cefalexin_codes,
+    "trimethoprim": trimethoprim_codes,
+    "trim_sulfamethoxazole": trim_sulfa_codes,
+    "fluoroquinolones": fluoroquinolone_codes,
+}
+
+tendinitis_periods = {
+    "risk": (days(30), days(1)),
+    "reference": (days(180), days(151)),
+}
+
+
+def ctc_tendinitis_dataset():
+    #analysis/ctc_definition_tendinitis_combined.py
+    dataset = create_dataset()
+
+    tendinitis_case_date = clinical_events.where(
+        clinical_events.snomedct_code.is_in(tendinitis_codes)
+    ).where(
+        clinical_events.date.is_after(start_date)
+    ).sort_by(clinical_events.date).first_for_patient().date
+
+    is_case = tendinitis_case_date.is_not_null()
+
+    has_registration_1y_before_tendinitis = (
+        practice_registrations.where(practice_registrations.start_date <= (tendinitis_case_date + years(1)))
+        .except_where(practice_registrations.end_date < end_date)
+        .exists_for_patient()
+    )
+
+    has_registration_1y_before_start_date = (
+        practice_registrations.where(practice_registrations.start_date <= (start_date + years(1)))
+        .except_where(practice_registrations.end_date < end_date)
+        .exists_for_patient()
+    )
+
+    prior_tendinitis = clinical_events.where(
+        clinical_events.snomedct_code.is_in(tendinitis_codes)
+    ).where(
+        clinical_events.date.is_on_or_before(start_date)
+    ).exists_for_patient()
+
+    dataset.define_population(
+        patients.exists_for_patient()
+        & ~prior_tendinitis
+        & ((is_case & has_registration_1y_before_tendinitis) | (~is_case & has_registration_1y_before_start_date))
+    )
+
+    N_days = (date.fromisoformat(end_date) - date.fromisoformat(start_date)).days
+    patient_sequence = (
+        patients.date_of_birth.year * 10000
+        + patients.date_of_birth.month * 100
+        + patients.date_of_birth.day
+    )
+    offset_days = patient_sequence - ((patient_sequence // N_days) * N_days)
+    random_date = start_date + days(offset_days)
+
+    index_date = case(when(is_case).then(tendinitis_case_date), otherwise=random_date)
+
+    dataset.tendinitis_case = is_case
+    dataset.sex = patients.sex
+    dataset.age = patients.age_on(index_date)
+    dataset.tendinitis_case_date = index_date
+
+    for antibiotic, codelist in antibiotic_codelists_dmd.items():
+        for period_label, (start_offset, end_offset) in tendinitis_periods.items():
+            setattr(
+                dataset,
+                f"{antibiotic}_{period_label}_tendinitis",
+                medications.where(medications.dmd_code.is_in(codelist))
+                .where(medications.date.is_on_or_between(index_date - start_offset, index_date - end_offset))
+                .exists_for_patient(),
+            )
+
+    return dataset
+
+
+DATASETS = {
+    "cohort": cohort_dataset,
+    "cohort_lookback": lambda: cohort_dataset(lookback_windows),
+    "ctc_tendinitis": ctc_tendinitis_dataset,
+}
+
+#generate-dataset --risk-set: controls sampled as match_tendinitis in project.yaml matches them
+RISK_SETS = {
+    "ctc_tendinitis": {
+        "case_variable": "tendinitis_case",
+        "index_date_variable": "tendinitis_case_date",
+        "match_variables": {"sex": "category", "age": 5},
+        "matches_per_case": 3,
+    },
+}
+
+
+def abx_outcome_measures():
+    #analysis/measure_definition.py - same measures, same order
+    intervals = monthly_intervals("2010-12-01", 120)
+
+    antibiotics = {
+        "amoxicillin": amoxicillin_codes,
+        "cefalexin": cefalexin_codes,
+        "co_amoxiclav": amox_clavulanicacid_codes,
+        "trimethoprim": trimethoprim_codes,
+        "co_trimoxazole": trim_sulfa_codes,
+        "fluoroquinolone": fluoroquinolone_codes,
+    }
+    outcomes = {
+        "tendinitis": tendinitis_codes,
+        "neuropathy": neuropathy_newdx_codes,
+    }
+
+    first_outcome_dates = {
+        outcome_name: FirstInInterval("clinical_events", "snomedct_code", outcome_codes)
+        for outcome_name, outcome_codes in outcomes.items()
+    }
+
+    measures = []
+    for ab_name, ab_codes in antibiotics.items():
+        for outcome_name in outcomes:
+            measures.append(Measure(
+                f"{outcome_name}_prev_{ab_name}_trends",
+                numerator=ExistsBeforeDate("medications", "dmd_code", ab_codes, first_outcome_dates[outcome_name], 30, 1),
+                denominator=ExistsBeforeIntervalStart("medications", "dmd_code", ab_codes, 30, 1),
+            ))
+
+    denominator_abxcount = RegisteredSpanning()
+    for name, abx_codes in [
+        ("fluoroquinolone_trends", fluoroquinolone_codes),
+        ("amoxicillin_trends", amoxicillin_codes),
+        ("cefalexin_trends", cefalexin_codes),
+        ("coamox_trends", amox_clavulanicacid_codes),
+        ("trim_trends", trimethoprim_codes),
+        ("co_trim_trends", trim_sulfa_codes),
+    ]:
+        measures.append(Measure(name, CountInInterval("medications", "dmd_code", abx_codes), denominator_abxcount))
+
+    measures.append(Measure("tendinitis_trends", ExistsInInterval("clinical_events", "snomedct_code", tendinitis_codes), denominator_abxcount))
+    measures.append(Measure("neuropathy_trends", ExistsInInterval("clinical_events", "snomedct_code", neuropathy_newdx_codes), denominator_abxcount))
+
+    return measures, intervals
+
+
+MEASURES = {
+    "abx_outcomes": abx_outcome_measures,
+}
@@ -0,0 +1,307 @@
+######################################
+
+# TPP-shaped tables held as numpy columns
+
+# Event tables are sorted by (patient_id, date) on load, so every patient's rows are
+# contiguous and in date order. `Database.pidx(table)` maps each row to its position in
+# the sorted list of all patient ids, which is how patient-level series are aligned.
+
+# Code columns (dmd_code, snomedct_code, ctv3_code) are dictionary-encoded: the column
+# holds int32 ids into `table.vocabularies[column]`, the distinct codes with a None
+# appended, and a null code is id -1 - so that slot. A codelist compiles to an array
+# over the same slots (Table.compile), and is_in/to_category over rows is then a
+# single gather, lookup[ids], rather than a string hash per row.
+
+######################################
+
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+
+#Only the tables/columns the study definitions use. Kinds: date, code, str, int, float, bool
+SCHEMAS = {
+    "patients": {"date_of_birth": "date", "sex": "str"},
+    "ons_deaths": {"date": "date"},
+    "medications": {"date": "date", "dmd_code": "code"},
+    "clinical_events": {"date": "date", "snomedct_code": "code", "ctv3_code": "code", "numeric_value": "float"},
+    "practice_registrations": {"start_date": "date", "end_date": "date"},
+    "addresses": {"address_id": "int", "start_date": "date", "end_date": "date", "has_postcode": "bool", "imd_rounded": "int"},
+    "apcs": {"admission_date": "date"},
+}
+
+#One row per patient - their columns are patient-level series
+PATIENT_TABLES = {"patients", "ons_deaths"}
+
+#Column each event table is sorted on within patient
+SORT_COLUMNS = {
+    "medications": "date",
+    "clinical_events": "date",
+    "practice_registrations": "start_date",
+    "addresses": "start_date",
+    "apcs": "admission_date",
+}
+
+ARROW_TYPES = {
+    "date": pa.date32(),
+    "code": pa.string(),
+    "str": pa.string(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "bool": pa.bool_(),
+}
+
+
+class Table:
+    def __init__(self, name, columns, vocabularies=None):
+        self.name = name
+        self.columns = dict(columns)
+        self.vocabularies = dict(vocabularies or {})
+        for column, kind in SCHEMAS.get(name, {}).items():
+            if kind == "code" and column in self.columns and column not in self.vocabularies:
+                self.columns[column], self.vocabularies[column] = encode_codes(self.columns[column])
+        self._positions = {}
+
+    def __len__(self):
+        return len(self.columns["patient_id"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def take(self, rows):
+        return Table(self.name, {k: v[rows] for k, v in self.columns.items()}, self.vocabularies)
+
+    def decode(self, column, ids):
+        #Codes (None for null) for ids of an encoded column
+        return self.vocabularies[column][ids]
+
+    def positions_index(self, column):
+        #{code: vocabulary id}, built on first use
+        if column not in self._positions:
+            self._positions[column] = {code: i for i, code in enumerate(self.vocabularies[column][:-1].tolist())}
+        return self._positions[column]
+
+    def positions(self, column, codes):
+        #Vocabulary ids of those `codes` that occur in the column
+        index = self.positions_index(column)
+        return np.array([index[code] for code in codes if code in index], dtype=np.int64)
+
+    def compile(self, column, codelist, categorise=False):
+        #Lookup over the column's vocabulary: True for codes in the codelist (False for
+        #null), or with `categorise` each code's category from a {code: category}
+        #codelist (None for null or unlisted)
+        size = len(self.vocabularies[column])
+        if categorise:
+            lookup = np.full(size, None, dtype=object)
+            index = self.positions_index(column)
+            for code, category in codelist.items():
+                if code in index:
+                    lookup[index[code]] = category
+            return lookup
+        lookup = np.zeros(size, dtype=bool)
+        lookup[self.positions(column, codelist)] = True
+        return lookup
+
+    def sorted(self):
+        #Stable sort by patient then the table's date column (NaT sorts last)
+        patient_id = self.columns["patient_id"]
+        if not (self.name in SORT_COLUMNS and SORT_COLUMNS[self.name] in self.columns):
+            return self.take(np.argsort(patient_id, kind="stable"))
+        dates = self.columns[SORT_COLUMNS[self.name]]
+        if len(patient_id) and dates.dtype.kind == "M":
+            #One int64 key (patient, date) sorts much faster than a two-key lexsort
+            days = dates.astype("datetime64[D]").astype(np.int64)
+            null = np.isnat(dates)
+            low, high = (days[~null].min(), days[~null].max()) if (~null).any() else (0, 0)
+            span = int(high - low) + 2
+            ids = patient_id - patient_id.min()
+            if int(ids.max()) < np.iinfo(np.int64).max // span:
+                key = ids * span + np.where(null, span - 1, days - low)
+                return self.take(np.argsort(key, kind="stable"))
+        return self.take(np.lexsort([dates, patient_id]))
+
+
+class Database:
+    def __init__(self, tables, presorted=False):
+        #presorted: event tables are already in (patient_id, date) order
+        self.tables = {name: (t if presorted or name in PATIENT_TABLES else t.sorted()) for name, t in tables.items()}
+        #Universe of patients is everyone in any table, as in ehrql
+        self.patient_ids = np.unique(np.concatenate(
+            [t["patient_id"] for t in self.tables.values()] or [np.empty(0, np.int64)]
+        ))
+        self._pidx = {}
+        self.indexes = {} #built on first use, eg. engine/registrations.py
+        self.sources = {} #set by load_tables
+
+    def __getitem__(self, name):
+        return self.tables[name]
+
+    def __contains__(self, name):
+        return name in self.tables
+
+    @property
+    def n_patients(self):
+        return len(self.patient_ids)
+
+    def pidx(self, name):
+        if name not in self._pidx:
+            self._pidx[name] = np.searchsorted(self.patient_ids, self.tables[name]["patient_id"])
+        return self._pidx[name]
+
+    def patient_column(self, name, column):
+        #Align a one-row-per-patient table with patient_ids; missing patients are null
+        table = self.tables[name]
+        values = table[column]
+        out = np.full(self.n_patients, null_value(values.dtype), dtype=values.dtype)
+        out[self.pidx(name)] = values
+        return out
+
+
+def null_value(dtype):
+    if dtype.kind == "M":
+        return np.datetime64("NaT")
+    if dtype.kind == "f":
+        return np.nan
+    if dtype.kind == "b":
+        return False
+    return None
+
+
+def is_null(values):
+    if values.dtype.kind == "M":
+        return np.isnat(values)
+    if values.dtype.kind == "f":
+        return np.isnan(values)
+    if values.dtype.kind == "O":
+        return np.equal(values, None)
+    return np.zeros(len(values), dtype=bool)
+
+
+def from_arrow(name, arrow_table):
+    schema = SCHEMAS.get(name, {})
+    columns = {"patient_id": arrow_table.column("patient_id").to_numpy().astype(np.int64)}
+    vocabularies = {}
+    for column, kind in schema.items():
+        if column not in arrow_table.column_names:
+            continue
+        if kind == "code":
+            columns[column], vocabularies[column] = encode_codes(arrow_table.column(column))
+        else:
+            columns[column] = column_to_numpy(arrow_table.column(column), kind)
+    return Table(name, columns, vocabularies)
+
+
+def encode_codes(values):
+    #-> (int32 ids, vocabulary) for a code column given as an arrow or object array
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    elif not isinstance(values, pa.Array):
+        values = pa.array(values, type=pa.string(), from_pandas=True)
+    encoded = values.cast(pa.string()).dictionary_encode()
+    ids = encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32)
+    vocabulary = np.empty(len(encoded.dictionary) + 1, dtype=object)
+    vocabulary[:-1] = encoded.dictionary.to_pylist()
+    return ids, vocabulary
+
+
+def column_to_numpy(array, kind):
+    if kind == "date":
+        return array.cast(pa.date32()).to_numpy(zero_copy_only=False).astype("datetime64[D]")
+    if kind == "int" and array.null_count:
+        #Nullable ints are held as floats with NaN
+        return array.cast(pa.float64()).to_numpy(zero_copy_only=False)
+    if kind == "str":
+        return np.asarray(array.to_numpy(zero_copy_only=False), dtype=object)
+    return array.to_numpy(zero_copy_only=False)
+
+
+def read_arrow_table(path, name, memory_map=False):
+    #memory_map: .arrow columns are only read as they are used (csv is always parsed whole)
+    path = Path(path)
+    if path.suffix in (".arrow", ".feather"):
+        return feather.read_table(path, memory_map=memory_map)
+    schema = SCHEMAS.get(name, {})
+    column_types = {"patient_id": pa.int64()}
+    column_types.update({column: ARROW_TYPES[kind] for column, kind in schema.items()})
+    return pa_csv.read_csv(
+        path,
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            strings_can_be_null=True,
+            true_values=["T", "True", "true", "1"],
+            false_values=["F", "False", "false", "0"],
+        ),
+    )
+
+
+def read_table(path, name):
+    return from_arrow(name, read_arrow_table(path, name))
+
+
+def to_arrow(table):
+    schema = SCHEMAS.get(table.name, {})
+    arrays, names = [pa.array(table["patient_id"], type=pa.int64())], ["patient_id"]
+    for column, kind in schema.items():
+        if column in table.vocabularies:
+            ids = table[column]
+            dictionary = pa.array(table.vocabularies[column][:-1], type=pa.string())
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(ids, mask=ids < 0), dictionary).cast(pa.string()))
+            names.append(column)
+        elif column in table:
+            #from_pandas: NaT/NaN become nulls
+            arrays.append(pa.array(table[column], type=ARROW_TYPES[kind], from_pandas=True))
+            names.append(column)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def write_table(path, table):
+    write_arrow(path, to_arrow(table))
+
+
+def write_arrow(path, arrow_table):
+    #<table>.arrow, or a dummy_tables-style csv(.gz) with T/F booleans
+    path = Path(path)
+    if path.suffix in (".arrow", ".feather"):
+        feather.write_feather(arrow_table, path, compression="uncompressed")
+        return
+    for i, field in enumerate(arrow_table.schema):
+        if field.type == pa.bool_():
+            flags = pc.if_else(arrow_table.column(i), "T", "F")
+            arrow_table = arrow_table.set_column(i, field.name, flags)
+    #gzip module rather than arrow's gzip stream, which compresses several times slower
+    with gzip.open(path, "wb", compresslevel=6) if path.suffix == ".gz" else open(path, "wb") as f:
+        #Unquoted, like dummy_tables/ - codes, dates and sex never contain commas
+        f.write((",".join(arrow_table.column_names) + "\n").encode())
+        pa_csv.write_csv(arrow_table, f, pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+
+
+def table_paths(directory, names=None):
+    #<table>.arrow if present, otherwise <table>.csv(.gz) - the dummy_tables/ layout
+    directory = Path(directory)
+    paths = {}
+    for name in names or SCHEMAS:
+        for suffix in (".arrow", ".csv", ".csv.gz"):
+            path = directory / f"{name}{suffix}"
+            if path.exists():
+                paths[name] = path
+                break
+    return paths
+
+
+def load_arrow_tables(directory, names=None, memory_map=False):
+    return {name: read_arrow_table(path, name, memory_map) for name, path in table_paths(directory, names).items()}
+
+
+def load_tables(directory, names=None):
+    paths = table_paths(directory, names)
+    db = Database({name: from_arrow(name, read_arrow_table(path, name)) for name, path in paths.items()})
+    #Which files (and versions of them) the data came from, eg. for engine/materialise.py
+    db.sources = {name: f"{path.resolve()}:{path.stat().st_size}:{path.stat().st_mtime_ns}" for name, path in paths.items()}
+    return db
@@ -0,0 +1,252 @@
+######################################
+
+# Per-patient status timelines over a categorised codelist
+
+# Smoking status from smoking_clear_codelist needs, at first_cohort_abx_rx, the latest
+# category - but N only if there was never an E or S before - and the last E and S
+# dates. Written in ehrql that is several clinical_events queries:
+
+#   latest = clinical_events.where(ctv3_code.is_in(smoking_clear_codelist))
+#       .where(date.is_on_or_before(X)).sort_by(date).last_for_patient().ctv3_code
+#   latest.to_category(smoking_clear_codelist)                           status as of X
+#   clinical_events.where(ctv3_code.is_in(smoking_clear_codelist))
+#       .where(ctv3_code.to_category(smoking_clear_codelist).is_in(["E", "S"]))
+#       .where(date.is_on_or_before(X)).exists_for_patient()           ever E/S by X
+#   ... .where(ctv3_code.to_category(smoking_clear_codelist) == "E")
+#       .where(date.is_on_or_before(X)).sort_by(date).last_for_patient().date   last E
+
+# each a filter over all of clinical_events. Instead a StatusTimeline is built once per
+# (table, code column, date column, codelist), in one pass over the code column: each
+# categorised event becomes a category id, events are already in (patient, date) order,
+# and runs of the same category are collapsed to their first event - the patient's
+# status changes. Each category also keeps its events' composite (patient, date) keys,
+# as engine/windows.py does. Then for any date bounds, per patient:
+
+# - status as of X: the last run starting on or before X (two binary searches)
+# - ever Y in [A, B] / how many: binary searches in Y's keys
+# - first/last date of Y in [A, B]: the same searches
+
+# Those three shapes take this path whenever the codelist has categories - so does
+# latest_ethnicity_group - and the filters are only the codelist, date bounds against
+# patient-level values and, for the last two, a category test (== "Y", is_in([...]),
+# or an | of ==s). Anything else is evaluated as usual.
+
+######################################
+
+import numpy as np
+
+from .query import Codes, Column, Count, Exists, Filter, Function, Pick, Value, flatten, row_table
+from .tables import SORT_COLUMNS
+from .windows import BOUNDS, FAR, bound, window_bounds
+
+
+class StatusTimeline:
+    def __init__(self, evaluator, table, code_column, date_column, codes):
+        db = evaluator.db
+        #Category of each vocabulary id (None for null or unlisted), then as small ids
+        names = evaluator.lookup("to_category", Column(table, code_column), codes)
+        listed = np.flatnonzero(names != None)
+        self.categories, ids = np.unique(names[listed].astype(str), return_inverse=True)
+        lookup = np.full(len(names), -1, dtype=np.int64)
+        lookup[listed] = ids
+        category = lookup[db[table][code_column]]
+        rows = np.flatnonzero(category >= 0)
+        dates = db[table][date_column][rows]
+        rows, dates = rows[~np.isnat(dates)], dates[~np.isnat(dates)]
+        category = category[rows]
+        pidx = db.pidx(table)[rows].astype(np.int64)
+        self.n_patients = db.n_patients
+        self.width = 2 * FAR + 1
+        #Sorted: rows are in (patient, date) order
+        keys = pidx * self.width + (dates.astype("datetime64[D]").astype(np.int64) + FAR)
+        #A run starts at a patient's first event and wherever their category changes
+        starts = np.r_[True, (pidx[1:] != pidx[:-1]) | (category[1:] != category[:-1])] if len(pidx) else pidx.astype(bool)
+        self.run_keys = keys[starts]
+        self.run_categories = category[starts]
+        self.patients = first_of_runs(pidx)
+        #Each category's events, still sorted, and the patients with any - the only ones
+        #worth searching for it
+        self.keys = [keys[category == i] for i in range(len(self.categories))]
+        self.holders = [first_of_runs(k // self.width) for k in self.keys]
+
+    @staticmethod
+    def key(table, code_column, date_column, codes):
+        return ("timeline", table, code_column, date_column, codes)
+
+    @classmethod
+    def for_db(cls, evaluator, table, code_column, date_column, codes):
+        #Built once per Database and codelist
+        key = cls.key(table, code_column, date_column, codes)
+        if key not in evaluator.db.indexes:
+            evaluator.db.indexes[key] = cls(evaluator, table, code_column, date_column, codes)
+        return evaluator.db.indexes[key]
+
+    def category_ids(self, categories):
+        #Ids of those of `categories` any event has
+        return [int(i) for i in np.flatnonzero(np.isin(self.categories, list(categories)))]
+
+    def search(self, keys, patients, low, high):
+        #-> (first, last): positions in `keys` of each of `patients`' keys dated in
+        #[low, high] - each a date aligned with patient_ids, a single date, or None for no
+        #bound. A null bound matches nothing, so first == last
+        low_days, low_null = bound(low, patients, -FAR)
+        high_days, high_null = bound(high, patients, FAR)
+        offset = patients * self.width + FAR
+        first = np.searchsorted(keys, offset + low_days, side="left")
+        last = np.searchsorted(keys, offset + high_days, side="right")
+        return first, np.where(low_null | high_null, first, np.maximum(last, first))
+
+    def count(self, categories, low=None, high=None):
+        #Events per patient of any of `categories` dated in [low, high]
+        out = np.zeros(self.n_patients, dtype=np.int64)
+        for i in self.category_ids(categories):
+            first, last = self.search(self.keys[i], self.holders[i], low, high)
+            out[self.holders[i]] += last - first
+        return out
+
+    def first_date(self, categories, low=None, high=None, last=False):
+        #Date of each patient's first (last) event of any of `categories` in [low, high]
+        days = np.full(self.n_patients, -1 if last else self.width, dtype=np.int64)
+        reduce = np.maximum if last else np.minimum
+        for i in self.category_ids(categories):
+            first, end = self.search(self.keys[i], self.holders[i], low, high)
+            found = end > first
+            keys = self.keys[i][end[found] - 1 if last else first[found]]
+            patients = self.holders[i][found]
+            days[patients] = reduce(days[patients], keys - patients * self.width)
+        missing = days == (-1 if last else self.width)
+        return np.where(missing, np.datetime64("NaT"), (days - FAR).astype("datetime64[D]"))
+
+    def last_date(self, categories, low=None, high=None):
+        return self.first_date(categories, low, high, last=True)
+
+    def status(self, low=None, high=None):
+        #Category (None if none) of each patient's last event dated in [low, high]: the
+        #last run starting on or before high, if its last event by then is on or after low
+        patients = self.patients
+        high_days, high_null = bound(high, patients, FAR)
+        run = np.searchsorted(self.run_keys, patients * self.width + FAR + high_days, side="right") - 1
+        found = (run >= 0) & ~high_null
+        found[found] = self.run_keys[run[found]] // self.width == patients[found]
+        category = np.where(found, self.run_categories[np.maximum(run, 0)], -1)
+        if low is not None:
+            #The last event by high is the status category's last event by then
+            for i in range(len(self.categories)):
+                these = np.flatnonzero(category == i)
+                first, last = self.search(self.keys[i], patients[these], low, high)
+                category[these[last == first]] = -1
+        out = np.full(self.n_patients, None, dtype=object)
+        found = category >= 0
+        out[patients[found]] = self.categories.astype(object)[category[found]]
+        return out
+
+
+
+def category_test(condition, table):
+    #to_category(code, codes) == "Y" / .is_in([...]) / an | of those -> (code column,
+    #codes, {categories}), else None
+    if not isinstance(condition, Function):
+        return None
+    if condition.op == "or":
+        tests = [category_test(arg, table) for arg in condition.args]
+        if None in tests or len({test[:2] for test in tests}) != 1:
+            return None
+        return tests[0][:2] + (set().union(*(test[2] for test in tests)),)
+    if condition.op not in ("eq", "is_in") or len(condition.args) != 2:
+        return None
+    categorised, value = condition.args
+    if condition.op == "eq" and isinstance(categorised, Value):
+        categorised, value = value, categorised
+    if not (
+        isinstance(categorised, Function) and categorised.op == "to_category"
+        and isinstance(categorised.args[0], Column) and categorised.args[0].table == table
+        and isinstance(categorised.args[1], Codes) and isinstance(value, Value)
+    ):
+        return None
+    categories = {value.value} if condition.op == "eq" else set(value.value)
+    if not all(isinstance(category, str) for category in categories):
+        return None
+    return categorised.args[0].name, categorised.args[1], categories
+
+
+def match_frame(frame, db):
+    #where(code.is_in(codes)), date bounds against patient-level values and at most one
+    #category test -> (table, code column, date column, codes, {categories} or None,
+    #[(op, bound nodes), ...]), else None
+    if not isinstance(frame, Filter):
+        return None
+    table, conditions = flatten(frame)
+    if table not in db or table not in SORT_COLUMNS or any(exclude for _, exclude in conditions):
+        return None
+    date_column = SORT_COLUMNS[table]
+    code_tests, category_tests, bounds = [], [], []
+    for condition, _ in conditions:
+        tested = category_test(condition, table)
+        if tested is not None:
+            category_tests.append(tested)
+            continue
+        if not (isinstance(condition, Function) and isinstance(condition.args[0], Column) and condition.args[0].table == table):
+            return None
+        column, others = condition.args[0], condition.args[1:]
+        if condition.op == "is_in" and isinstance(others[0], Codes) and column.name in db[table].vocabularies:
+            code_tests.append((column.name, others[0]))
+        elif condition.op in BOUNDS and column.name == date_column and all(row_table(arg) is None for arg in others):
+            bounds.append((condition.op, others))
+        else:
+            return None
+    if len(code_tests) != 1 or len(category_tests) > 1 or not bounds:
+        return None
+    (code_column, codes), = code_tests
+    categories = None
+    if category_tests:
+        (category_column, category_codes, categories), = category_tests
+        #Categorised by the codelist filtered on (which may list its names in another order)
+        if category_column != code_column or set(category_codes.names) != set(codes.names):
+            return None
+        codes = category_codes
+    return table, code_column, date_column, codes, categories, bounds
+
+
+def evaluate_timeline(evaluator, node):
+    #Patient-level result for a status, ever/count or first/last date query, or None
+    db = evaluator.db
+    if isinstance(node, (Exists, Count)):
+        matched = match_frame(node.source, db)
+        if matched is None or matched[4] is None:
+            return None
+    elif isinstance(node, Pick):
+        matched = match_frame(node.source, db)
+        if matched is None or matched[4] is None or not node.sort_column == node.column == matched[2]:
+            return None
+    elif isinstance(node, Function) and node.op == "to_category":
+        picked, codes = node.args
+        if not (isinstance(picked, Pick) and picked.last and isinstance(codes, Codes)):
+            return None
+        matched = match_frame(picked.source, db)
+        if (
+            matched is None or matched[4] is not None
+            or picked.sort_column != matched[2] or picked.column != matched[1]
+            or set(codes.names) != set(matched[3].names)
+        ):
+            return None
+        matched = matched[:3] + (codes,) + matched[4:]
+    else:
+        return None
+    table, code_column, date_column, codes, categories, bounds = matched
+    if not isinstance(evaluator.resolve(codes), dict):
+        #No categories to keep a timeline of
+        return None
+    timeline = StatusTimeline.for_db(evaluator, table, code_column, date_column, codes)
+    low, high = window_bounds(evaluator, bounds)
+    if isinstance(node, Exists):
+        return timeline.count(categories, low, high) > 0
+    if isinstance(node, Count):
+        return timeline.count(categories, low, high)
+    if isinstance(node, Pick):
+        return timeline.first_date(categories, low, high, last=node.last).astype(db[table][date_column].dtype)
+    return timeline.status(low, high)
+
+
+def first_of_runs(values):
+    #Distinct values of a sorted array
+    return values[np.r_[True, values[1:] != values[:-1]]] if len(values) else values
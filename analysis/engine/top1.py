@@ -0,0 +1,51 @@
+######################################
+
+# One row per patient for sort_by(...).first_for_patient() / last_for_patient()
+
+# first_cohort_rx, the first outcome dates, last_bmi, latest_ethnicity_code and
+# tendinitis_case_date each sort a frame only to keep one row per patient. Instead of
+# sorting, top1() makes two passes over the rows, in any order, with state over patients:
+# the least (for last: greatest) sort key so far per patient (np.minimum.at /
+# np.maximum.at), then of the rows holding it the earliest (latest) - O(rows + patients).
+
+# The row chosen is the one the stable sort chose: nulls sort after every value, and ties
+# go to the earlier row for first, the later for last - so a patient with a null sort
+# value gets their last null row from last_for_patient, as before.
+
+######################################
+
+import numpy as np
+
+LEAST = np.iinfo(np.int64).min
+GREATEST = np.iinfo(np.int64).max
+
+
+def sort_key(values):
+    #-> int64 in the same order as the values, nulls greatest; None if there is no such key
+    if values.dtype.kind == "M":
+        key = values.view(np.int64)
+        return np.where(np.isnat(values), GREATEST, key)
+    if values.dtype.kind == "f":
+        #IEEE bits, negatives flipped, order like the floats (+ 0.0 makes -0.0 equal 0.0)
+        bits = (values.astype(np.float64) + 0.0).view(np.int64)
+        key = np.where(bits < 0, bits ^ GREATEST, bits)
+        return np.where(np.isnan(values), GREATEST, key)
+    if values.dtype.kind in "iub":
+        return values.astype(np.int64)
+    return None
+
+
+def top1(groups, values, n_groups, last=False):
+    #-> positions (into groups/values) of each group's first - or last - row by value, one
+    #per group with any rows; None if the values have no sort_key (eg. codes)
+    key = sort_key(values)
+    if key is None:
+        return None
+    reduce = np.maximum if last else np.minimum
+    best = np.full(n_groups, LEAST if last else GREATEST, dtype=np.int64)
+    reduce.at(best, groups, key)
+    positions = np.flatnonzero(key == best[groups])
+    unset = -1 if last else len(groups)
+    chosen = np.full(n_groups, unset, dtype=np.int64)
+    reduce.at(chosen, groups[positions], positions)
+    return chosen[chosen != unset]
@@ -0,0 +1,179 @@
+######################################
+
+# Per-patient sorted event dates by codelist, for window exists/count queries
+
+# The CTC definitions ask, for 6 antibiotics x 2 periods, whether a prescription falls
+# in [index_date - start, index_date - end]:
+
+#   medications.where(dmd_code.is_in(X)).where(date.is_on_or_between(A, B)).exists_for_patient()
+
+# Evaluated as written, each of the 12 is a filter over all of medications. Instead, the
+# dates of a codelist's rows are collected once per (table, code column, codelist) as
+# composite (patient, date) keys - already in order, as event tables are sorted by
+# patient then date - and a window is two binary searches, O(log n), per patient. Only
+# patients with any matching row are searched. So another period is two searchsorted
+# calls over an index that already exists, and another drug class is one more index.
+
+# Any exists/count over <code is_in codelist> with date comparisons (between, <, <=, >,
+# >=) against patient-level values takes this path, bar the codelist flags engine/fused.py
+# has already answered; other filters are evaluated as usual.
+
+######################################
+
+import numpy as np
+
+from .fused import MAX_FLAGS
+from .query import Codes, Column, Count, Exists, Function, flatten, row_table
+from .tables import SORT_COLUMNS
+
+#Dates as days since 1970, well inside +/- FAR
+FAR = 10 ** 7
+BOUNDS = {"between", "lt", "le", "gt", "ge"}
+
+
+class CodeDateIndex:
+    def __init__(self, db, table, date_column, rows):
+        #rows: ascending row numbers of the codelist's events
+        dates = db[table][date_column][rows]
+        rows, dates = rows[~np.isnat(dates)], dates[~np.isnat(dates)]
+        pidx = db.pidx(table)[rows].astype(np.int64)
+        self.n_patients = db.n_patients
+        self.width = 2 * FAR + 1
+        #Sorted: rows are in (patient, date) order
+        self.keys = pidx * self.width + (dates.astype("datetime64[D]").astype(np.int64) + FAR)
+        #Patients with any row, the only ones worth searching
+        self.patients = pidx[np.r_[True, pidx[1:] != pidx[:-1]]] if len(pidx) else pidx
+
+    @staticmethod
+    def key(table, code_column, date_column, codes):
+        return ("windows", table, code_column, date_column, codes)
+
+    @classmethod
+    def for_db(cls, evaluator, table, code_column, date_column, codes):
+        #Built once per Database and codelist
+        return cls.build(evaluator, table, code_column, date_column, [codes])[codes]
+
+    @classmethod
+    def build(cls, evaluator, table, code_column, date_column, codes):
+        #-> {codes: index}, building any not in db.indexes with one pass over the code
+        #column for up to MAX_FLAGS codelists, each a bit of a mask per vocabulary id
+        db = evaluator.db
+        missing = [c for c in codes if cls.key(table, code_column, date_column, c) not in db.indexes]
+        for chunk_start in range(0, len(missing), MAX_FLAGS):
+            chunk = missing[chunk_start:chunk_start + MAX_FLAGS]
+            mask = np.zeros(len(db[table].vocabularies[code_column]), dtype=np.uint64)
+            for bit, c in enumerate(chunk):
+                mask[db[table].positions(code_column, evaluator.resolve(c))] |= np.uint64(1 << bit)
+            bits = mask[db[table][code_column]]
+            candidates = np.flatnonzero(bits)
+            bits = bits[candidates]
+            for bit, c in enumerate(chunk):
+                rows = candidates[(bits & np.uint64(1 << bit)) != 0]
+                db.indexes[cls.key(table, code_column, date_column, c)] = cls(db, table, date_column, rows)
+        return {c: db.indexes[cls.key(table, code_column, date_column, c)] for c in codes}
+
+    def count_all(self, low, high):
+        #Rows per patient dated in [low, high] - each a date aligned with patient_ids, a
+        #single date, or None for no bound. A null bound matches nothing
+        pidx = self.patients
+        low_days, low_null = bound(low, pidx, -FAR)
+        high_days, high_null = bound(high, pidx, FAR)
+        offset = pidx * self.width + FAR
+        first = np.searchsorted(self.keys, offset + low_days, side="left")
+        last = np.searchsorted(self.keys, offset + high_days, side="right")
+        counts = np.where(low_null | high_null, 0, np.maximum(last - first, 0))
+        out = np.zeros(self.n_patients, dtype=np.int64)
+        out[pidx] = counts
+        return out
+
+
+def bound(dates, pidx, missing):
+    #-> (days clipped to +/- FAR, null) for the patients in pidx
+    if dates is None:
+        return np.full(len(pidx), missing, dtype=np.int64), np.zeros(len(pidx), dtype=bool)
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    if dates.ndim:
+        dates = dates[pidx]
+    null = np.broadcast_to(np.isnat(dates), pidx.shape)
+    values = np.where(np.isnat(dates), 0, dates.astype(np.int64))
+    return np.broadcast_to(np.clip(values, -FAR, FAR), pidx.shape), null
+
+
+def match_window(node, db):
+    #Exists/Count over where(code.is_in(codes)) plus date bounds -> (table, code column,
+    #date column, codes, [(op, bound nodes), ...]), else None
+    if not isinstance(node, (Exists, Count)):
+        return None
+    table, conditions = flatten(node.source)
+    if table not in db or table not in SORT_COLUMNS or any(exclude for _, exclude in conditions):
+        return None
+    date_column = SORT_COLUMNS[table]
+    code_tests, bounds = [], []
+    for condition, _ in conditions:
+        if not (isinstance(condition, Function) and isinstance(condition.args[0], Column) and condition.args[0].table == table):
+            return None
+        column, others = condition.args[0], condition.args[1:]
+        if condition.op == "is_in" and isinstance(others[0], Codes) and column.name in db[table].vocabularies:
+            code_tests.append((column.name, others[0]))
+        elif condition.op in BOUNDS and column.name == date_column and all(row_table(arg) is None for arg in others):
+            bounds.append((condition.op, others))
+        else:
+            return None
+    if len(code_tests) != 1 or not bounds:
+        return None
+    (code_column, codes), = code_tests
+    return table, code_column, date_column, codes, bounds
+
+
+def build_indexes(evaluator, nodes):
+    #Indexes for every window query in `nodes` not yet evaluated, so codelists on the
+    #same column share one pass
+    groups = {}
+    for node in nodes:
+        matched = None if node in evaluator.cache else match_window(node, evaluator.db)
+        if matched is not None:
+            table, code_column, date_column, codes, _ = matched
+            groups.setdefault((table, code_column, date_column), []).append(codes)
+    for (table, code_column, date_column), codes in groups.items():
+        CodeDateIndex.build(evaluator, table, code_column, date_column, list(dict.fromkeys(codes)))
+
+
+def evaluate_window(evaluator, node):
+    #Patient-level counts (for Exists: whether any) for a matching node, or None
+    matched = match_window(node, evaluator.db)
+    if matched is None:
+        return None
+    table, code_column, date_column, codes, bounds = matched
+    index = CodeDateIndex.for_db(evaluator, table, code_column, date_column, codes)
+    counts = index.count_all(*window_bounds(evaluator, bounds))
+    return counts > 0 if isinstance(node, Exists) else counts
+
+
+def window_bounds(evaluator, bounds):
+    #-> (low, high) dates of the window, each None if unbounded. Several bounds
+    #intersect; each window is [low, high] in whole days
+    lows, highs = [], []
+    for op, args in bounds:
+        values = [evaluator.argument(arg) for arg in args]
+        if op == "between":
+            lows.append(values[0])
+            highs.append(values[1])
+        elif op in ("ge", "gt"):
+            lows.append(shift(values[0], 1 if op == "gt" else 0))
+        else:
+            highs.append(shift(values[0], -1 if op == "lt" else 0))
+    return tightest(lows, np.maximum), tightest(highs, np.minimum)
+
+
+def shift(dates, n):
+    return np.asarray(dates, dtype="datetime64[D]") + np.timedelta64(n, "D")
+
+
+def tightest(dates, fn):
+    #Latest lower / earliest upper bound (np.maximum/minimum keep NaT), or None if unbounded
+    if not dates:
+        return None
+    result = np.asarray(dates[0], dtype="datetime64[D]")
+    for other in dates[1:]:
+        result = fn(result, np.asarray(other, dtype="datetime64[D]"))
+    return result
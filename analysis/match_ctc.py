@@ -0,0 +1,125 @@
+######################################
+
+# Matches CTC cases to potential controls - in-process replacement for matching:v1.1.0
+
+#python:v2 python analysis/match_ctc.py --cases output/ctc_data_cases_tendinitis.csv.gz --controls output/ctc_data_potential_controls_tendinitis.csv.gz --config '{...}'
+
+#Takes the same --config as the matching action and writes the same outputs:
+#matched_cases.arrow (cases + set_id, case, match_counts), matched_matches.arrow (controls +
+#set_id, case, with the case's index date), matched_combined.arrow and matching_report.txt
+
+######################################
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+
+from engine.matching import match
+
+DEFAULT_CONFIG = {
+    "matches_per_case": 1,
+    "match_variables": {},
+    "index_date_variable": "index_date",
+    "generate_match_index_date": "no_offset",
+    "min_matches_per_case": 0,
+    "indicator_variable_name": "case",
+    "output_suffix": "",
+    "seed": 1,
+}
+
+
+def read(path):
+    return pa_csv.read_csv(path, convert_options=pa_csv.ConvertOptions(
+        true_values=["T"], false_values=["F"], strings_can_be_null=True,
+    ))
+
+
+def numpy_columns(table, names):
+    columns = {}
+    for name in names:
+        column = table.column(name)
+        if pa.types.is_date(column.type) or pa.types.is_timestamp(column.type):
+            columns[name] = column.cast(pa.date32()).to_numpy(zero_copy_only=False).astype("datetime64[D]")
+        elif pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+            columns[name] = column.cast(pa.float64()).to_numpy(zero_copy_only=False)
+        else:
+            columns[name] = np.asarray(column.to_numpy(zero_copy_only=False), dtype=object)
+    return columns
+
+
+def run(cases_path, controls_path, config, output_dir):
+    started = time.perf_counter()
+    config = {**DEFAULT_CONFIG, **config}
+    if config["generate_match_index_date"] != "no_offset":
+        raise ValueError("only generate_match_index_date='no_offset' is supported")
+    index_date = config["index_date_variable"]
+    indicator = config["indicator_variable_name"]
+    suffix = config["output_suffix"]
+
+    cases, controls = read(cases_path), read(controls_path)
+    needed = ["patient_id", index_date, *config["match_variables"]]
+    case_rows, control_rows = match(
+        numpy_columns(cases, needed),
+        numpy_columns(controls, needed),
+        config["match_variables"],
+        config["matches_per_case"],
+        index_date,
+        seed=config["seed"],
+    )
+
+    match_counts = np.bincount(case_rows, minlength=cases.num_rows)
+    kept = np.flatnonzero(match_counts >= config["min_matches_per_case"])
+    keep_pair = np.isin(case_rows, kept)
+    case_rows, control_rows = case_rows[keep_pair], control_rows[keep_pair]
+
+    matched_cases = cases.take(pa.array(kept))
+    matched_cases = matched_cases.append_column("set_id", matched_cases.column("patient_id"))
+    matched_cases = matched_cases.append_column(indicator, pa.array(np.ones(len(kept), dtype=np.int64)))
+    matched_cases = matched_cases.append_column("match_counts", pa.array(match_counts[kept]))
+
+    matched_matches = controls.take(pa.array(control_rows))
+    case_ids = cases.column("patient_id").take(pa.array(case_rows))
+    matched_matches = matched_matches.append_column("set_id", case_ids)
+    matched_matches = matched_matches.append_column(indicator, pa.array(np.zeros(len(control_rows), dtype=np.int64)))
+    #no_offset: the control takes its case's index date
+    position = matched_matches.column_names.index(index_date)
+    case_dates = cases.column(index_date).take(pa.array(case_rows)).cast(matched_matches.column(index_date).type)
+    matched_matches = matched_matches.set_column(position, index_date, case_dates)
+
+    matched_combined = pa.concat_tables([matched_cases, matched_matches], promote_options="default")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name, table in (("matched_cases", matched_cases), ("matched_matches", matched_matches), ("matched_combined", matched_combined)):
+        feather.write_feather(table, output_dir / f"{name}{suffix}.arrow", compression="uncompressed")
+
+    counts = pc.value_counts(pa.array(match_counts)).to_pylist()
+    report = [
+        f"Matching completed in {time.perf_counter() - started:.2f} seconds",
+        f"Config: {json.dumps(config)}",
+        f"Cases available: {cases.num_rows}",
+        f"Potential controls available: {controls.num_rows}",
+        f"Cases matched (kept): {len(kept)}",
+        f"Controls matched: {len(control_rows)}",
+        "Matches per case:",
+        *[f"  {c['values']}: {c['counts']}" for c in sorted(counts, key=lambda c: c["values"])],
+    ]
+    (output_dir / f"matching_report{suffix}.txt").write_text("\n".join(report) + "\n")
+    print("\n".join(report))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", required=True)
+    parser.add_argument("--controls", required=True)
+    parser.add_argument("--config", required=True, help="JSON, as for the matching action")
+    parser.add_argument("--output-dir", default="output")
+    args = parser.parse_args()
+    run(args.cases, args.controls, json.loads(args.config), args.output_dir)
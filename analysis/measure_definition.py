@@ -1,5 +1,13 @@
-from ehrql import INTERVAL, case, create_measures, codelist_from_csv, months, weeks, days, when 
+from ehrql import INTERVAL, case, create_measures, months, weeks, days, when 
 from ehrql.tables.tpp import medications, patients, practice_registrations, clinical_events
+from codelists import (
+    fluoroquinolone_codes, amoxicillin_codes, cefalexin_codes,
+    amox_clavulanicacid_codes as co_amox_codes,
+    trimethoprim_codes as trim_codes,
+    trim_sulfa_codes as co_trim_codes,
+    tendinitis_codes,
+    neuropathy_newdx_codes as neuropathy_codes,
+)
 
 measures = create_measures()
 
@@ -10,22 +18,10 @@ measures.configure_dummy_data(population_size=1000)
 
 #De novo dataset generation for measures here - but could make external file for queries that would be shared by both
 
-#Exposures - fq
-fluoroquinolone_codes = codelist_from_csv("codelists/user-jacklsbrist-fluoroquinolones-dmd.csv", column = "code")
-
 #Exposures - comparators
-amoxicillin_codes = codelist_from_csv("codelists/opensafely-amoxicillin-oral.csv", column = "code")
-cefalexin_codes = codelist_from_csv("codelists/opensafely-cefalexin-oral.csv", column = "code")
-co_amox_codes = codelist_from_csv("codelists/opensafely-co-amoxiclav-oral.csv", column = "code")
-trim_codes = codelist_from_csv("codelists/opensafely-trimethoprim.csv", column = "code")
-co_trim_codes = codelist_from_csv("codelists/user-jacklsbrist-trimethoprimsulfamethoxazole-dmd.csv", column = "code")
 
 all_comparator_abx = amoxicillin_codes + cefalexin_codes + co_amox_codes +trim_codes + co_trim_codes
 
-#Outcomes
-tendinitis_codes = codelist_from_csv("codelists/user-jacklsbrist-tendinitis.csv", column = "code")
-neuropathy_codes = codelist_from_csv("codelists/user-jacklsbrist-peripheral-neuropathy.csv", column = "code")
-
 # The use of the special INTERVAL placeholder below is the key part of
 # any measure definition as it allows the definition to be evaluated
 # over a range of different intervals, rather than a fixed pair of dates
@@ -0,0 +1,12 @@
+######################################
+
+# Runs the local engine (analysis/engine/) on TPP-shaped tables
+
+#python analysis/run_engine.py generate-dataset cohort --tables dummy_tables --output output/engine/dataset.arrow
+
+######################################
+
+from engine.cli import main
+
+if __name__ == "__main__":
+    main()
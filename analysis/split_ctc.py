@@ -0,0 +1,49 @@
+######################################
+
+# Splits the combined case-time-control extraction into the cases and potential controls
+# files that matching expects, in one pass over the input.
+
+#python:v2 python analysis/split_ctc.py --input output/ctc_data_tendinitis.csv.gz --cases output/ctc_data_cases_tendinitis.csv.gz --controls output/ctc_data_potential_controls_tendinitis.csv.gz
+
+#Rows are copied as text so the files are byte-for-byte what ehrql would have written.
+#The controls file drops the case flag column, as the old potential controls extraction did.
+
+######################################
+
+import argparse
+import csv
+import gzip
+
+
+def open_text(path, mode):
+    return gzip.open(path, mode + "t", newline="") if str(path).endswith(".gz") else open(path, mode, newline="")
+
+
+def split(input_path, cases_path, controls_path, case_column):
+    counts = {"cases": 0, "controls": 0}
+    with open_text(input_path, "r") as f_in, open_text(cases_path, "w") as f_cases, open_text(controls_path, "w") as f_controls:
+        reader = csv.reader(f_in)
+        header = next(reader)
+        flag = header.index(case_column)
+        cases, controls = csv.writer(f_cases), csv.writer(f_controls)
+        cases.writerow(header)
+        controls.writerow(header[:flag] + header[flag + 1:])
+        for row in reader:
+            if row[flag] == "T":
+                cases.writerow(row)
+                counts["cases"] += 1
+            else:
+                controls.writerow(row[:flag] + row[flag + 1:])
+                counts["controls"] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--cases", required=True)
+    parser.add_argument("--controls", required=True)
+    parser.add_argument("--case-column", default="tendinitis_case")
+    args = parser.parse_args()
+    counts = split(args.input, args.cases, args.controls, args.case_column)
+    print(f"{counts['cases']} cases, {counts['controls']} potential controls")
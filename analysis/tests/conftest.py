@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+#engine and codelists are imported as top-level modules, as run_engine.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
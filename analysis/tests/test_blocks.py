@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from engine.blocks import interval_blocks, run_blocked
+from engine.cli import main
+from engine.dummy import generate
+from engine.measures import run_measures
+from engine.study import MEASURES
+from engine.tables import Database
+
+
+@pytest.fixture(scope="module")
+def tables(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("tables")
+    main(["generate-dummy-tables", "abx_outcomes", "--population-size", "3000", "--output", str(directory), "--format", "arrow", "--no-cache"])
+    return directory
+
+
+@pytest.mark.parametrize("blocks", [2, 7])
+def test_blocks_output_is_serial_output(tables, tmp_path, blocks):
+    serial, blocked = tmp_path / "serial.csv", tmp_path / "blocked.csv"
+    main(["generate-measures", "abx_outcomes", "--tables", str(tables), "--output", str(serial)])
+    main(["generate-measures", "abx_outcomes", "--tables", str(tables), "--output", str(blocked), "--blocks", str(blocks), "--workers", "2"])
+    assert blocked.read_bytes() == serial.read_bytes()
+    assert len(serial.read_text().splitlines()) > 1
+
+
+@pytest.mark.parametrize("blocks", [3, 119, 120, 500])
+def test_run_blocked(blocks):
+    #Uneven blocks, one interval each, and more blocks than intervals
+    db = Database(generate("abx_outcomes", 1000, seed=2))
+    measures, (starts, ends) = MEASURES["abx_outcomes"]()
+    assert run_blocked(db, measures, starts, ends, blocks, workers=2) == run_measures(db, measures, starts, ends)
+
+
+@pytest.mark.parametrize("n_intervals, n_blocks", [(120, 1), (120, 7), (120, 120), (5, 8), (1, 3)])
+def test_interval_blocks(n_intervals, n_blocks):
+    blocks = interval_blocks(n_intervals, n_blocks)
+    assert len(blocks) == min(n_blocks, n_intervals)
+    #Contiguous, covering every interval once, none empty, sizes within one of each other
+    assert blocks[0][0] == 0 and blocks[-1][1] == n_intervals
+    assert all(hi == lo for (_, hi), (lo, _) in zip(blocks, blocks[1:]))
+    sizes = np.array([hi - lo for lo, hi in blocks])
+    assert sizes.min() >= 1 and sizes.max() - sizes.min() <= 1
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import pytest
+
+from engine.cli import main
+
+DUMMY_TABLES = Path(__file__).resolve().parents[2] / "dummy_tables"
+
+
+@pytest.mark.parametrize("argv", [
+    ["generate-dataset", "cohort", "--output", "dataset.csv", "--shards", "0"],
+    ["generate-dataset", "cohort", "--output", "dataset.csv", "--shards", "2", "--workers", "0"],
+    ["generate-dataset", "cohort", "--output", "dataset.csv.gz", "--gzip-threads", "-1"],
+    ["generate-dataset", "cohort", "--output", "dataset.csv.gz", "--gzip-queue", "0"],
+    ["generate-measures", "abx_outcomes", "--output", "measures.csv", "--blocks", "0"],
+    ["generate-measures", "abx_outcomes", "--output", "measures.csv", "--blocks", "2", "--workers", "-2"],
+    ["show", "cohort", "--sample", "0"],
+])
+def test_counts_must_be_positive(argv, tmp_path, monkeypatch, capsys):
+    #Rejected before anything runs, rather than quietly running serially
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exited:
+        main(argv)
+    assert exited.value.code == 2
+    assert "must be at least 1" in capsys.readouterr().err
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("argv, output", [
+    (["generate-dataset", "cohort", "--output"], "output/engine/dataset.csv.gz"),
+    (["generate-dataset", "cohort", "--profile", "--output"], "output/engine/dataset.arrow"),
+    (["generate-dataset", "ctc_tendinitis", "--risk-set", "--output"], "output/engine/sampled.arrow"),
+    (["generate-measures", "abx_outcomes", "--output"], "output/engine/measures.csv"),
+])
+def test_output_directory_created(argv, output, tmp_path):
+    main([*argv, str(tmp_path / output), "--tables", str(DUMMY_TABLES)])
+    assert (tmp_path / output).stat().st_size
@@ -0,0 +1,15 @@
+import shutil
+
+import codelists
+from engine.dummy import cache_key
+
+
+def test_cache_key_follows_codelist_content(tmp_path, monkeypatch):
+    #A hand-edited CSV whose sha in codelists.json wasn't updated gets fresh tables
+    shutil.copytree(codelists.CODELIST_DIR, tmp_path / "codelists")
+    monkeypatch.setattr(codelists, "CODELIST_DIR", tmp_path / "codelists")
+    before = cache_key("cohort", 1000, 1, {}, {})
+    assert cache_key("cohort", 1000, 1, {}, {}) == before
+    with open(tmp_path / "codelists" / codelists.CODELISTS["diabetes_codelist"][0], "a") as f:
+        f.write("XaZZZ,edited by hand\n")
+    assert cache_key("cohort", 1000, 1, {}, {}) != before
@@ -0,0 +1,66 @@
+import csv
+import gzip
+import shutil
+from datetime import date, timedelta
+from pathlib import Path
+
+import pytest
+
+import codelists
+from engine.cli import main
+from engine.incremental import fingerprint
+from engine.study import DATASETS
+
+DUMMY_TABLES = Path(__file__).resolve().parents[2] / "dummy_tables"
+
+
+def edit_table(path, edit):
+    #Rewrites a CSV table with edit(rows) -> rows
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        fields, rows = reader.fieldnames, list(reader)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(edit(rows))
+
+
+def contents(path):
+    return gzip.open(path).read() if str(path).endswith(".gz") else Path(path).read_bytes()
+
+
+@pytest.mark.parametrize("extension", ["arrow", "csv", "csv.gz"])
+def test_incremental_matches_full_run(tmp_path, capsys, extension):
+    tables = tmp_path / "tables"
+    shutil.copytree(DUMMY_TABLES, tables)
+    output = tmp_path / f"dataset.{extension}"
+    incremental = ["generate-dataset", "cohort", "--tables", str(tables), "--output", str(output), "--incremental", str(tmp_path / "state")]
+    main(incremental)
+    assert capsys.readouterr().out.startswith("full:")
+
+    #A patient's prescriptions dropped, another's diagnoses moved 365 days earlier
+    with open(tables / "medications.csv", newline="") as f:
+        dropped = min(row["patient_id"] for row in csv.DictReader(f))
+    with open(tables / "clinical_events.csv", newline="") as f:
+        moved = max(row["patient_id"] for row in csv.DictReader(f) if row["date"])
+    edit_table(tables / "medications.csv", lambda rows: [r for r in rows if r["patient_id"] != dropped])
+    edit_table(tables / "clinical_events.csv", lambda rows: [
+        {**r, "date": str(date.fromisoformat(r["date"]) - timedelta(days=365))} if r["patient_id"] == moved and r["date"] else r
+        for r in rows
+    ])
+    main(incremental)
+    assert capsys.readouterr().out.startswith("incremental: 2 of")
+
+    fresh = tmp_path / f"fresh.{extension}"
+    main(["generate-dataset", "cohort", "--tables", str(tables), "--output", str(fresh)])
+    assert contents(output) == contents(fresh)
+
+
+def test_fingerprint_follows_codelist_content(tmp_path, monkeypatch):
+    #A hand-edited CSV whose sha in codelists.json wasn't updated still forces a full run
+    shutil.copytree(codelists.CODELIST_DIR, tmp_path / "codelists")
+    monkeypatch.setattr(codelists, "CODELIST_DIR", tmp_path / "codelists")
+    before = fingerprint(DATASETS["cohort"]())
+    with open(tmp_path / "codelists" / codelists.CODELISTS["diabetes_codelist"][0], "a") as f:
+        f.write("XaZZZ,edited by hand\n")
+    assert fingerprint(DATASETS["cohort"]()) != before
@@ -0,0 +1,142 @@
+import csv
+import json
+from math import isnan
+
+import numpy as np
+import pyarrow.feather as feather
+import pytest
+
+import match_ctc
+from engine.matching import match
+
+MATCH_VARIABLES = {"sex": "category", "age": 5}
+
+
+def synthetic(n, rng, first_id, ages=100, nan_share=0.0):
+    #Few ages and dates, so there are plenty of ties to break
+    age = rng.integers(0, ages, n).astype(float)
+    age[rng.random(n) < nan_share] = np.nan
+    return {
+        "patient_id": np.arange(first_id, first_id + n, dtype=np.int64),
+        "sex": rng.choice(np.array(["female", "male", "unknown"], dtype=object), n, p=[0.5, 0.45, 0.05]),
+        "age": age,
+        "index_date": np.datetime64("2020-01-01") + rng.integers(0, 30, n).astype("timedelta64[D]"),
+    }
+
+
+def brute_force(cases, controls, tolerance, matches_per_case):
+    #Each case in index date (then patient_id) order takes, one at a time, the unused
+    #control of its sex nearest in age within tolerance - the younger on a tie. Which of
+    #several controls of one sex and age is taken is arbitrary, so -> the ages matched
+    #per case
+    used = np.zeros(len(controls["patient_id"]), dtype=bool)
+    matched = {}
+    for c in np.lexsort((cases["patient_id"], cases["index_date"])):
+        age = cases["age"][c]
+        if isnan(age):
+            continue
+        for _ in range(matches_per_case):
+            candidates = [
+                i for i in range(len(used))
+                if not used[i] and controls["sex"][i] == cases["sex"][c] and abs(controls["age"][i] - age) <= tolerance
+            ]
+            if not candidates:
+                break
+            best = min(candidates, key=lambda i: (abs(controls["age"][i] - age), controls["age"][i]))
+            used[best] = True
+            matched.setdefault(int(c), []).append(controls["age"][best])
+    return {c: sorted(ages) for c, ages in matched.items()}
+
+
+def matched_ages(case_rows, control_rows, controls):
+    matched = {}
+    for c, i in zip(case_rows.tolist(), control_rows.tolist()):
+        matched.setdefault(c, []).append(controls["age"][i])
+    return {c: sorted(ages) for c, ages in matched.items()}
+
+
+def assert_within_rules(cases, controls, case_rows, control_rows, tolerance, matches_per_case):
+    assert len(case_rows) == len(control_rows)
+    assert len(np.unique(control_rows)) == len(control_rows)
+    assert (cases["sex"][case_rows] == controls["sex"][control_rows]).all()
+    assert (np.abs(cases["age"][case_rows] - controls["age"][control_rows]) <= tolerance).all()
+    assert np.bincount(case_rows, minlength=len(cases["patient_id"])).max(initial=0) <= matches_per_case
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("matches_per_case", [1, 3])
+def test_agrees_with_brute_force(seed, matches_per_case):
+    rng = np.random.default_rng(seed)
+    cases = synthetic(int(rng.integers(1, 40)), rng, 0, ages=30, nan_share=0.1)
+    controls = synthetic(int(rng.integers(0, 80)), rng, 1000, ages=30, nan_share=0.1)
+    case_rows, control_rows = match(cases, controls, MATCH_VARIABLES, matches_per_case, "index_date", seed=seed)
+    assert_within_rules(cases, controls, case_rows, control_rows, 5, matches_per_case)
+    assert matched_ages(case_rows, control_rows, controls) == brute_force(cases, controls, 5, matches_per_case)
+
+
+def test_rules_at_scale():
+    rng = np.random.default_rng(3)
+    cases, controls = synthetic(5000, rng, 0), synthetic(40000, rng, 10000)
+    case_rows, control_rows = match(cases, controls, MATCH_VARIABLES, 3, "index_date")
+    assert_within_rules(cases, controls, case_rows, control_rows, 5, 3)
+    #Controls are plentiful, so nearly every case gets all three
+    assert (np.bincount(case_rows, minlength=5000) == 3).mean() > 0.9
+
+
+def test_seeded():
+    rng = np.random.default_rng(4)
+    cases, controls = synthetic(200, rng, 0, ages=10), synthetic(600, rng, 1000, ages=10)
+    first = match(cases, controls, MATCH_VARIABLES, 2, "index_date", seed=7)
+    again = match(cases, controls, MATCH_VARIABLES, 2, "index_date", seed=7)
+    other = match(cases, controls, MATCH_VARIABLES, 2, "index_date", seed=8)
+    np.testing.assert_array_equal(first[1], again[1])
+    assert not np.array_equal(first[1], other[1])
+
+
+def write_csv(path, columns):
+    names = list(columns)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in zip(*(columns[name].tolist() for name in names)):
+            writer.writerow(["" if isinstance(v, float) and isnan(v) else int(v) if isinstance(v, float) else v for v in row])
+
+
+def test_match_ctc(tmp_path):
+    rng = np.random.default_rng(5)
+    cases, controls = synthetic(100, rng, 0, ages=40), synthetic(250, rng, 1000, ages=40)
+    cases["region"] = rng.choice(np.array(["North", "South"], dtype=object), 100)
+    controls["region"] = rng.choice(np.array(["North", "South"], dtype=object), 250)
+    write_csv(tmp_path / "cases.csv", cases)
+    write_csv(tmp_path / "controls.csv", controls)
+    config = {"matches_per_case": 3, "match_variables": MATCH_VARIABLES, "index_date_variable": "index_date", "min_matches_per_case": 2}
+    match_ctc.run(tmp_path / "cases.csv", tmp_path / "controls.csv", config, tmp_path / "out")
+
+    matched_cases = feather.read_table(tmp_path / "out" / "matched_cases.arrow").to_pydict()
+    matched_matches = feather.read_table(tmp_path / "out" / "matched_matches.arrow").to_pydict()
+    combined = feather.read_table(tmp_path / "out" / "matched_combined.arrow")
+    assert combined.num_rows == len(matched_cases["patient_id"]) + len(matched_matches["patient_id"])
+
+    #Cases keep their columns, each its own set, with at least min_matches_per_case controls
+    assert matched_cases["set_id"] == matched_cases["patient_id"]
+    assert set(matched_cases["case"]) == {1}
+    assert min(matched_cases["match_counts"]) >= 2 and max(matched_cases["match_counts"]) <= 3
+    assert set(matched_cases) == {*cases, "set_id", "case", "match_counts"}
+
+    #Controls are used once, each in a kept case's set and within its rules, and take its index date
+    assert len(set(matched_matches["patient_id"])) == len(matched_matches["patient_id"])
+    assert set(matched_matches["case"]) == {0}
+    case_of = {pid: i for i, pid in enumerate(matched_cases["patient_id"])}
+    sets = np.array(matched_matches["set_id"])
+    assert set(sets.tolist()) == set(case_of)
+    assert (np.bincount([case_of[s] for s in sets.tolist()]) == matched_cases["match_counts"]).all()
+    for k, set_id in enumerate(sets.tolist()):
+        case = case_of[set_id]
+        assert matched_matches["sex"][k] == matched_cases["sex"][case]
+        assert abs(matched_matches["age"][k] - matched_cases["age"][case]) <= 5
+        assert matched_matches["index_date"][k] == matched_cases["index_date"][case]
+    assert set(matched_matches) == {*controls, "set_id", "case"}
+
+    report = (tmp_path / "out" / "matching_report.txt").read_text()
+    assert f"Config: {json.dumps({**match_ctc.DEFAULT_CONFIG, **config})}" in report
+    assert f"Controls matched: {len(matched_matches['patient_id'])}" in report
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from engine.dummy import generate, referenced_codelists
+from engine.evaluate import Evaluator
+from engine.measures import Sweep, run_measures
+from engine.query import codes
+from engine.study import MEASURES
+from engine.tables import Database, Table
+
+#The sweep against what generate-measures does: every part of every measure evaluated
+#afresh, as written, for each interval
+
+
+def synthetic_db():
+    listed = referenced_codelists("abx_outcomes")
+    tables = generate("abx_outcomes", 2000, seed=3, prevalence={name: 0.3 for names in listed.values() for name in names})
+    rng = np.random.default_rng(3)
+    #Prescriptions moved to 0-35 days before some outcomes, either side of the 30/1 day windows
+    events, medications = tables["clinical_events"], tables["medications"]
+    outcome = events.compile("snomedct_code", codes(*listed["clinical_events", "snomedct_code"]).resolve())[events["snomedct_code"]]
+    antibiotic = medications.compile("dmd_code", codes(*listed["medications", "dmd_code"]).resolve())[medications["dmd_code"]]
+    outcomes = rng.choice(np.flatnonzero(outcome & ~np.isnat(events["date"])), 600, replace=False)
+    moved = rng.choice(np.flatnonzero(antibiotic), 600, replace=False)
+    patient_id, date = medications["patient_id"].copy(), medications["date"].copy()
+    patient_id[moved] = events["patient_id"][outcomes]
+    date[moved] = events["date"][outcomes] - rng.integers(0, 36, 600).astype("timedelta64[D]")
+    tables["medications"] = Table("medications", {**medications.columns, "patient_id": patient_id, "date": date}, medications.vocabularies)
+    #Some spells overlapping the patient's first, and some open ones, so runs are merged
+    registrations = tables["practice_registrations"]
+    extra = rng.choice(np.unique(registrations["patient_id"]), 300, replace=False)
+    first = {pid: start for pid, start in zip(registrations["patient_id"][::-1], registrations["start_date"][::-1])}
+    start = np.array([first[pid] for pid in extra]) + rng.integers(-400, 2000, len(extra)).astype("timedelta64[D]")
+    end = start + rng.integers(30, 3000, len(extra)).astype("timedelta64[D]")
+    end[rng.random(len(extra)) < 0.3] = np.datetime64("NaT")
+    tables["practice_registrations"] = Table("practice_registrations", {
+        "patient_id": np.r_[registrations["patient_id"], extra],
+        "start_date": np.r_[registrations["start_date"], start],
+        "end_date": np.r_[registrations["end_date"], end],
+    })
+    return Database(tables)
+
+
+@pytest.fixture(scope="module")
+def db():
+    return synthetic_db()
+
+
+def measure_parts(measures):
+    #Numerators, denominators and the dates they are anchored on, each once
+    parts = [part for m in measures for part in (m.numerator, m.denominator)]
+    parts += [part.date for part in parts if hasattr(part, "date")]
+    return list(dict.fromkeys(parts))
+
+
+def as_sparse_values(values):
+    #An ordinary query's patient-level values as the sweep keeps them: dates as days, absent as 0
+    if values.dtype.kind == "M":
+        return np.where(np.isnat(values), 0, values.astype("datetime64[D]").astype(np.int64))
+    return values.astype(np.int64)
+
+
+@pytest.mark.parametrize("name", MEASURES)
+def test_parts_per_interval(db, name):
+    measures, (starts, ends) = MEASURES[name]()
+    sweep = Sweep(db, starts, ends)
+    patients = np.arange(db.n_patients, dtype=np.int64)
+    for part in measure_parts(measures):
+        swept = sweep.value(part)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            expected = Evaluator(db, plain=True).evaluate(part.query(str(start), str(end)).node)
+            actual = swept.lookup(sweep.keys(patients, i), sweep.n_intervals)
+            np.testing.assert_array_equal(actual, as_sparse_values(expected), err_msg=f"{part} in {start}")
+
+
+@pytest.mark.parametrize("name", MEASURES)
+def test_rows_per_interval(db, name):
+    measures, (starts, ends) = MEASURES[name]()
+    rows = run_measures(db, measures, starts, ends)
+    assert len(rows) == len(measures) * len(starts)
+    by_key = {(measure, str(start)): row for measure, start, *row in rows}
+    for start, end in zip(starts, ends):
+        evaluator = Evaluator(db, plain=True)
+        for measure in measures:
+            numerator = evaluator.evaluate(measure.numerator.query(str(start), str(end)).node).astype(np.int64)
+            denominator = evaluator.evaluate(measure.denominator.query(str(start), str(end)).node).astype(np.int64)
+            included = denominator != 0
+            num, den = int(numerator[included].sum()), int(denominator[included].sum())
+            assert by_key[measure.name, str(start)] == [end, num / den if den else None, num, den]
+    #Not all trivially empty
+    assert any(num for *_, num, _ in rows) and any(den for *_, den in rows)
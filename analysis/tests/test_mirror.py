@@ -0,0 +1,250 @@
+import ast
+import datetime
+from pathlib import Path
+
+import pytest
+
+from engine.measures import (
+    CountInInterval, ExistsBeforeDate, ExistsBeforeIntervalStart, ExistsInInterval, FirstInInterval, RegisteredSpanning,
+)
+from engine.study import MEASURES
+from engine.tables import SORT_COLUMNS
+
+#engine/study.py mirrors the ehrql definitions by hand. ehrql isn't needed to check it:
+#both are read here as source, each variable spelt out as one expression - local names
+#substituted, loops unrolled, a codelist as the set of codelists.py names it is made of -
+#and the two spellings compared
+
+ANALYSIS = Path(__file__).resolve().parent.parent
+STUDY = ANALYSIS / "engine" / "study.py"
+
+#ehrql definition: engine/study.py function mirroring it
+DATASET_MIRRORS = {
+    "dataset_definition.py": "cohort_dataset",
+    "ctc_definition_tendinitis_combined.py": "ctc_tendinitis_dataset",
+}
+MEASURE_MIRRORS = {
+    "measure_definition.py": "abx_outcomes",
+}
+
+OPERATORS = {
+    ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.FloorDiv: "//", ast.BitAnd: "&", ast.BitOr: "|",
+    ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=", ast.Eq: "==", ast.NotEq: "!=",
+}
+
+
+class Expr(str):
+    #A query expression, as opposed to a plain Python string such as a date
+    pass
+
+
+class Record:
+    #What a definition defines: dataset variables (and "<population>"), or measures
+    def __init__(self):
+        self.variables = {}
+        self.measures = {}
+        self.intervals = None
+
+
+def text(value):
+    if isinstance(value, Expr):
+        return value
+    if isinstance(value, frozenset):
+        return Expr(f"codes({', '.join(sorted(value))})")
+    return Expr(repr(value))
+
+
+def is_plain(value):
+    return not isinstance(value, (Expr, frozenset, Record, dict))
+
+
+class Reader:
+    def __init__(self, env=None):
+        self.env = dict(env or {})
+        self.functions = {}
+
+    def value(self, node):
+        names = [n.id for n in ast.walk(node) if isinstance(n, ast.Name)]
+        if all(name in self.env and is_plain(self.env[name]) for name in names) and not isinstance(node, ast.Dict):
+            #Plain Python - N_days, f-string names
+            return eval(compile(ast.Expression(node), "<definition>", "eval"), {}, self.env)
+        if isinstance(node, ast.Name):
+            return self.env.get(node.id, Expr(node.id))
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Dict):
+            return {self.value(k): self.value(v) for k, v in zip(node.keys, node.values)}
+        if isinstance(node, ast.Tuple):
+            return tuple(self.value(element) for element in node.elts)
+        if isinstance(node, ast.Subscript):
+            return self.value(node.value)[self.value(node.slice)]
+        if isinstance(node, ast.Attribute):
+            base = self.value(node.value)
+            if isinstance(base, Record):
+                return base.variables[node.attr]
+            if base == "tables":
+                #engine/study.py: patients = tables.patients
+                return Expr(node.attr)
+            return Expr(f"{text(base)}.{node.attr}")
+        if isinstance(node, ast.Call):
+            return self.call(node)
+        if isinstance(node, ast.BinOp):
+            left, right = self.value(node.left), self.value(node.right)
+            if isinstance(left, frozenset) and isinstance(right, frozenset) and isinstance(node.op, ast.Add):
+                return left | right
+            return Expr(f"({text(left)} {OPERATORS[type(node.op)]} {text(right)})")
+        if isinstance(node, ast.Compare):
+            (op,), (right,) = node.ops, node.comparators
+            return Expr(f"({text(self.value(node.left))} {OPERATORS[type(op)]} {text(self.value(right))})")
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            return Expr(f"~{text(self.value(node.operand))}")
+        #Anything else as written (eg. DATASETS' lambdas)
+        return Expr(ast.unparse(node))
+
+    def call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id == "codes":
+            #engine/study.py's codelists by name
+            return frozenset(self.value(arg) for arg in node.args)
+        if isinstance(node.func, ast.Name) and node.func.id in ("create_dataset", "create_measures"):
+            return Record()
+        if isinstance(node.func, ast.Attribute) and node.func.attr in ("items", "keys", "values"):
+            base = self.value(node.func.value)
+            if isinstance(base, dict):
+                return list(getattr(base, node.func.attr)())
+        args = [text(self.value(arg)) for arg in node.args]
+        args += [f"{k.arg}={text(self.value(k.value))}" for k in node.keywords]
+        return Expr(f"{text(self.value(node.func))}({', '.join(args)})")
+
+    def assign(self, target, value):
+        if isinstance(target, ast.Name):
+            self.env[target.id] = value
+        elif isinstance(target, ast.Tuple):
+            for element, item in zip(target.elts, value):
+                self.assign(element, item)
+        elif isinstance(target, ast.Attribute):
+            self.value(target.value).variables[target.attr] = text(value)
+        elif isinstance(target, ast.Subscript):
+            self.value(target.value)[self.value(target.slice)] = value
+
+    def run(self, statements):
+        #-> True once a return is reached
+        for statement in statements:
+            if isinstance(statement, (ast.Import, ast.ImportFrom)):
+                for alias in statement.names:
+                    name = alias.asname or alias.name
+                    module = getattr(statement, "module", None)
+                    if module == "codelists":
+                        self.env[name] = frozenset([alias.name])
+                    elif module == "datetime":
+                        self.env[name] = getattr(datetime, alias.name)
+                    else:
+                        self.env[name] = Expr(name)
+            elif isinstance(statement, ast.FunctionDef):
+                self.functions[statement.name] = statement
+            elif isinstance(statement, ast.Assign):
+                value = self.value(statement.value)
+                for target in statement.targets:
+                    self.assign(target, value)
+            elif isinstance(statement, ast.For):
+                for item in self.value(statement.iter):
+                    self.assign(statement.target, item)
+                    self.run(statement.body)
+            elif isinstance(statement, ast.If):
+                if self.run(statement.body if self.value(statement.test) else statement.orelse):
+                    return True
+            elif isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call):
+                self.statement_call(statement.value)
+            elif isinstance(statement, ast.Return):
+                return True
+        return False
+
+    def statement_call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == "setattr":
+            record, name, value = (self.value(arg) for arg in node.args)
+            record.variables[name] = text(value)
+        elif isinstance(func, ast.Attribute) and isinstance(self.value(func.value), Record):
+            record = self.value(func.value)
+            keywords = {k.arg: self.value(k.value) for k in node.keywords}
+            if func.attr == "define_population":
+                record.variables["<population>"] = text(self.value(node.args[0]))
+            elif func.attr == "define_measure":
+                record.measures[keywords["name"]] = (text(keywords["numerator"]), text(keywords["denominator"]))
+            elif func.attr == "define_defaults":
+                record.intervals = text(keywords["intervals"])
+
+    def call_function(self, name):
+        #Runs a module-level function of what was read, with its defaults -> its Record
+        function = self.functions[name]
+        reader = Reader(self.env)
+        defaults = function.args.defaults
+        for arg, default in zip(function.args.args[len(function.args.args) - len(defaults):], defaults):
+            reader.env[arg.arg] = self.value(default)
+        reader.run(function.body)
+        return reader.env["dataset"]
+
+
+def read(path):
+    reader = Reader()
+    reader.run(ast.parse(Path(path).read_text()).body)
+    return reader
+
+
+def assert_mirrored(expected, mirrored):
+    missing = sorted(set(expected) - set(mirrored))
+    assert not missing, f"not in engine/study.py: {missing}"
+    differ = sorted(name for name in expected if expected[name] != mirrored[name])
+    assert not differ, "differ from engine/study.py:\n" + "\n".join(
+        f"{name}:\n  ehrql:  {expected[name]}\n  mirror: {mirrored[name]}" for name in differ
+    )
+
+
+@pytest.mark.parametrize("definition", DATASET_MIRRORS)
+def test_dataset_mirrored(definition):
+    expected = read(ANALYSIS / definition).env["dataset"].variables
+    mirrored = read(STUDY).call_function(DATASET_MIRRORS[definition]).variables
+    assert_mirrored(expected, mirrored)
+    assert set(mirrored) == set(expected)
+
+
+def ehrql_spelling(part):
+    #A measure part of engine/measures.py as measure_definition.py writes it
+    if isinstance(part, RegisteredSpanning):
+        return "practice_registrations.spanning(INTERVAL.start_date, INTERVAL.end_date).exists_for_patient()"
+    table = part.table
+    date = f"{table}.{SORT_COLUMNS[table]}"
+    coded = f"{table}.{part.code_column}.is_in({text(frozenset(part.codes.names))})"
+    if isinstance(part, CountInInterval):
+        aggregate = "exists_for_patient" if isinstance(part, ExistsInInterval) else "count_for_patient"
+        return f"{table}.where({date}.is_during(INTERVAL)).where({coded}).{aggregate}()"
+    if isinstance(part, FirstInInterval):
+        return f"{table}.where({coded}).where({date}.is_during(INTERVAL)).sort_by({date}).first_for_patient().date"
+    if isinstance(part, ExistsBeforeDate):
+        anchor = ehrql_spelling(part.date)
+    elif isinstance(part, ExistsBeforeIntervalStart):
+        anchor = "INTERVAL.start_date"
+    else:
+        raise TypeError(part)
+    window = f"({anchor} - days({part.start})), ({anchor} - days({part.end}))"
+    return f"{table}.where({coded}).where({date}.is_on_or_between({window})).exists_for_patient()"
+
+
+@pytest.mark.parametrize("definition", MEASURE_MIRRORS)
+def test_measures_mirrored(definition):
+    record = read(ANALYSIS / definition).env["measures"]
+    measures, (starts, _) = MEASURES[MEASURE_MIRRORS[definition]]()
+    mirrored = {m.name: (ehrql_spelling(m.numerator), ehrql_spelling(m.denominator)) for m in measures}
+    assert_mirrored(record.measures, mirrored)
+    assert list(mirrored) == list(record.measures)
+    assert record.intervals == f"months({len(starts)}).starting_on({str(starts[0])!r})"
+
+
+def test_reader_sees_a_change():
+    #A mirror that drifted is caught: one window edited in a copy of the definition
+    source = (ANALYSIS / "dataset_definition.py").read_text()
+    assert "first_cohort_abx_rx - days(60)" in source
+    reader = Reader()
+    reader.run(ast.parse(source.replace("first_cohort_abx_rx - days(60)", "first_cohort_abx_rx - days(90)", 1)).body)
+    mirrored = read(STUDY).call_function("cohort_dataset").variables
+    with pytest.raises(AssertionError, match="corticosteroid_60d_before_abx"):
+        assert_mirrored(reader.env["dataset"].variables, mirrored)
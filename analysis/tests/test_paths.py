@@ -0,0 +1,150 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from engine.dummy import generate
+from engine.evaluate import Evaluator, run_dataset
+from engine.lookback import find_groups
+from engine.query import Codes, Events, Filter, Value, codes, create_dataset, days, row_table, tables, walk
+from engine.registrations import TABLE as REGISTRATIONS
+from engine.study import DATASETS
+from engine.tables import Database, Table, load_tables
+
+DUMMY_TABLES = Path(__file__).resolve().parents[2] / "dummy_tables"
+#Synthetic patients per definition - enough that the population is pushed down
+POPULATION_SIZE = 50000
+
+#Each way run_dataset can take, all checked against every node evaluated as written
+PATHS = {
+    "fused": {},
+    "windows": {"fused": False},
+    "not pushed down": {"pushdown": False},
+    "windows, not pushed down": {"fused": False, "pushdown": False},
+}
+
+
+@pytest.fixture(scope="module")
+def dummy_db():
+    return load_tables(DUMMY_TABLES)
+
+
+@pytest.fixture(scope="module")
+def synthetic_dbs():
+    #Tables drawn from each definition's own codelists, built on first use
+    built = {}
+
+    def get(definition):
+        if definition not in built:
+            built[definition] = Database(generate(definition, POPULATION_SIZE, seed=7))
+        return built[definition]
+    return get
+
+
+def assert_same(expected, actual):
+    assert actual.dtype == expected.dtype
+    np.testing.assert_array_equal(actual, expected)
+
+
+def assert_same_dataset(expected, actual):
+    (expected_ids, expected_columns), (actual_ids, actual_columns) = expected, actual
+    np.testing.assert_array_equal(actual_ids, expected_ids)
+    assert list(actual_columns) == list(expected_columns)
+    for name in expected_columns:
+        assert_same(expected_columns[name], actual_columns[name])
+
+
+def patient_nodes(dataset):
+    #Every patient-level series a dataset is built from
+    return [
+        node for node in walk([dataset.population, *dataset.variables.values()])
+        if not isinstance(node, (Events, Filter, Value, Codes)) and row_table(node) is None
+    ]
+
+
+@pytest.mark.parametrize("path", PATHS)
+@pytest.mark.parametrize("definition", DATASETS)
+def test_dummy_tables(dummy_db, definition, path):
+    plain = run_dataset(dummy_db, DATASETS[definition](), plain=True, pushdown=False)
+    assert_same_dataset(plain, run_dataset(dummy_db, DATASETS[definition](), **PATHS[path]))
+
+
+@pytest.mark.parametrize("path", PATHS)
+@pytest.mark.parametrize("definition", DATASETS)
+def test_synthetic(synthetic_dbs, definition, path):
+    db = synthetic_dbs(definition)
+    plain = run_dataset(db, DATASETS[definition](), plain=True, pushdown=False)
+    assert 0 < len(plain[0]) < db.n_patients
+    assert_same_dataset(plain, run_dataset(db, DATASETS[definition](), **PATHS[path]))
+
+
+@pytest.mark.parametrize("fused", [False, True])
+@pytest.mark.parametrize("definition", DATASETS)
+def test_every_node(synthetic_dbs, definition, fused):
+    #Intermediate series too (eg. first_cohort_rx's columns), not only the variables
+    db = synthetic_dbs(definition)
+    nodes = patient_nodes(DATASETS[definition]())
+    plain = Evaluator(db, plain=True)
+    evaluator = Evaluator(db, fused=fused)
+    for node, values in zip(nodes, evaluator.evaluate_all(nodes)):
+        assert_same(plain.evaluate(node), values)
+
+
+def test_paths_are_taken(synthetic_dbs):
+    #The comparisons above mean something only if the other paths ran
+    db = synthetic_dbs("cohort_lookback")
+    nodes = patient_nodes(DATASETS["cohort_lookback"]())
+    assert find_groups(nodes, db)
+    Evaluator(db).evaluate_all(nodes)
+    kinds = {key if isinstance(key, str) else key[0] for key in db.indexes}
+    assert {REGISTRATIONS, "windows", "timeline"} <= kinds
+
+
+def with_smoking_codes(db, share=0.2, seed=5):
+    #db with a share of clinical_events recoded (ctv3) from smoking_clear_codelist
+    import codelists
+    rng = np.random.default_rng(seed)
+    events = db["clinical_events"]
+    ctv3 = events.decode("ctv3_code", events["ctv3_code"]).copy()
+    recoded = rng.random(len(ctv3)) < share
+    smoking = np.array(list(codelists.smoking_clear_codelist), dtype=object)
+    ctv3[recoded] = smoking[rng.integers(0, len(smoking), recoded.sum())]
+    vocabularies = {k: v for k, v in events.vocabularies.items() if k != "ctv3_code"}
+    tables = dict(db.tables)
+    tables["clinical_events"] = Table("clinical_events", {**events.columns, "ctv3_code": ctv3}, vocabularies)
+    return Database(tables, presorted=True)
+
+
+def smoking_dataset():
+    #The status/ever/last-date queries of engine/timeline.py's notes
+    clinical_events = tables.clinical_events
+    patients = tables.patients
+    smoking = codes("smoking_clear_codelist")
+    index_date = patients.date_of_birth + days(365 * 40)
+    dataset = create_dataset()
+    dataset.define_population(patients.exists_for_patient())
+    smoking_events = clinical_events.where(clinical_events.ctv3_code.is_in(smoking))
+    category = clinical_events.ctv3_code.to_category(smoking)
+    dated = smoking_events.where(clinical_events.date.is_on_or_before(index_date))
+    dataset.status = dated.sort_by(clinical_events.date).last_for_patient().ctv3_code.to_category(smoking)
+    dataset.status_in_2015 = smoking_events.where(
+        clinical_events.date.is_on_or_between("2015-01-01", "2015-12-31")
+    ).sort_by(clinical_events.date).last_for_patient().ctv3_code.to_category(smoking)
+    dataset.ever_e_or_s = dated.where(category.is_in(["E", "S"])).exists_for_patient()
+    dataset.n_s_10y = smoking_events.where(category == "S").where(
+        clinical_events.date.is_on_or_between(index_date - days(3650), index_date)
+    ).count_for_patient()
+    dataset.last_e = dated.where(category == "E").sort_by(clinical_events.date).last_for_patient().date
+    dataset.first_e_or_n_after = smoking_events.where((category == "E") | (category == "N")).where(
+        clinical_events.date.is_after(index_date)
+    ).sort_by(clinical_events.date).first_for_patient().date
+    return dataset
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_timeline(synthetic_dbs, path):
+    db = with_smoking_codes(synthetic_dbs("cohort"))
+    plain = run_dataset(db, smoking_dataset(), plain=True, pushdown=False)
+    assert_same_dataset(plain, run_dataset(db, smoking_dataset(), **PATHS[path]))
+    #Everyone is in the population, so nothing was pushed down and db has the timeline
+    assert any(key[0] == "timeline" for key in db.indexes if isinstance(key, tuple))
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from engine.dummy import generate, referenced_codelists
+from engine.evaluate import Evaluator, age_on, run_dataset
+from engine.riskset import row_database, run_risk_set
+from engine.study import RISK_SETS, antibiotic_codelists_dmd, ctc_tendinitis_dataset, tendinitis_periods
+from engine.tables import Database, Table
+
+CONFIG = RISK_SETS["ctc_tendinitis"]
+K = CONFIG["matches_per_case"]
+TOLERANCE = CONFIG["match_variables"]["age"]
+
+
+@pytest.fixture(scope="module")
+def db():
+    listed = referenced_codelists("ctc_tendinitis")
+    prevalence = {name: 0.3 for names in listed.values() for name in names}
+    #Enough cases that some strata run short of controls
+    prevalence["tendinitis_codes"] = 0.4
+    tables = generate("ctc_tendinitis", 3000, seed=11, prevalence=prevalence)
+    #Diagnoses on the first of the month, so cases often share an index date
+    events = tables["clinical_events"]
+    first_of_month = events["date"].astype("datetime64[M]").astype("datetime64[D]")
+    tables["clinical_events"] = Table("clinical_events", {**events.columns, "date": first_of_month}, events.vocabularies)
+    return Database(tables)
+
+
+@pytest.fixture(scope="module")
+def sampled(db):
+    return run_risk_set(db, ctc_tendinitis_dataset(), CONFIG, seed=1)
+
+
+@pytest.fixture(scope="module")
+def everyone(db):
+    #What sampling is based on, evaluated as written for every patient
+    dataset = ctc_tendinitis_dataset()
+    population, is_case, index_date = Evaluator(db, plain=True).evaluate_all(
+        [dataset.population, dataset.variables["tendinitis_case"], dataset.variables["tendinitis_case_date"]]
+    )
+    return {
+        "population": population,
+        "is_case": is_case,
+        "index_date": index_date.astype("datetime64[D]"),
+        "sex": db.patient_column("patients", "sex"),
+        "date_of_birth": db.patient_column("patients", "date_of_birth").astype("datetime64[D]"),
+    }
+
+
+def sets(patient_ids, columns):
+    #-> {set_id: rows}, rows in output order
+    found = {}
+    for row, set_id in enumerate(columns["set_id"].tolist()):
+        found.setdefault(set_id, []).append(row)
+    return found
+
+
+def risk_set(everyone, case, date):
+    #Patient indexes a case at `date` can draw controls from, by brute force
+    ages = age_on(everyone["date_of_birth"], np.full(len(everyone["sex"]), date))
+    case_age = ages[case]
+    ok = everyone["population"] & (everyone["sex"] == everyone["sex"][case])
+    ok &= ~np.isnan(ages) & (np.abs(ages - case_age) <= TOLERANCE)
+    #Not a case on or before the date - so not the case itself either
+    ok &= ~(everyone["is_case"] & (everyone["index_date"] <= date))
+    return set(np.flatnonzero(ok).tolist())
+
+
+def test_every_case_in_its_own_set(db, sampled, everyone):
+    patient_ids, columns = sampled
+    found = sets(patient_ids, columns)
+    expected = everyone["population"] & everyone["is_case"] & ~np.isnat(everyone["index_date"])
+    expected &= ~np.isnat(everyone["date_of_birth"])
+    assert set(found) == set(db.patient_ids[expected].tolist())
+    for set_id, rows in found.items():
+        #The case first, then its controls
+        assert patient_ids[rows[0]] == set_id and columns["tendinitis_case"][rows[0]]
+        assert not columns["tendinitis_case"][rows[1:]].any()
+    #Sets in the case's index date order
+    dates = [columns["tendinitis_case_date"][rows[0]] for rows in found.values()]
+    assert dates == sorted(dates)
+
+
+def test_controls_from_the_risk_set(db, sampled, everyone):
+    patient_ids, columns = sampled
+    pidx = {pid: i for i, pid in enumerate(db.patient_ids.tolist())}
+    short = 0
+    for set_id, rows in sets(patient_ids, columns).items():
+        case, date = pidx[set_id], everyone["index_date"][pidx[set_id]]
+        eligible = risk_set(everyone, case, date)
+        controls = [pidx[pid] for pid in patient_ids[rows[1:]].tolist()]
+        assert len(set(controls)) == len(controls)
+        assert set(controls) <= eligible
+        #As many as there are, up to matches_per_case
+        assert len(controls) == min(K, len(eligible))
+        short += len(eligible) < K
+        #Each control takes the case's index date
+        assert (columns["tendinitis_case_date"][rows] == date).all()
+    assert short, "no risk set ran short of controls"
+
+
+def test_variables(db, sampled, everyone):
+    patient_ids, columns = sampled
+    pidx = np.searchsorted(db.patient_ids, patient_ids)
+    dates = columns["tendinitis_case_date"].astype("datetime64[D]")
+    np.testing.assert_array_equal(columns["sex"], everyone["sex"][pidx])
+    np.testing.assert_array_equal(columns["age"], age_on(everyone["date_of_birth"][pidx], dates))
+
+    #Cases' rows are their ordinary rows
+    dataset = ctc_tendinitis_dataset()
+    ordinary_ids, ordinary = run_dataset(db, dataset, plain=True, pushdown=False)
+    cases = columns["tendinitis_case"]
+    at = np.searchsorted(ordinary_ids, patient_ids[cases])
+    for name in dataset.variables:
+        np.testing.assert_array_equal(columns[name][cases], ordinary[name][at], err_msg=name)
+
+    #Controls' exposure windows are counted back from their case's index date
+    medications = db["medications"]
+    med_pidx, med_dates = db.pidx("medications"), medications["date"]
+    for antibiotic, codelist in antibiotic_codelists_dmd.items():
+        listed = medications.compile("dmd_code", codelist.resolve())[medications["dmd_code"]]
+        for period, (start, end) in tendinitis_periods.items():
+            expected = np.array([
+                bool((listed & (med_pidx == p) & (med_dates >= d - start.n) & (med_dates <= d - end.n)).any())
+                for p, d in zip(pidx[~cases], dates[~cases])
+            ])
+            np.testing.assert_array_equal(columns[f"{antibiotic}_{period}_tendinitis"][~cases], expected)
+
+
+def test_seeded(db, sampled):
+    again = run_risk_set(db, ctc_tendinitis_dataset(), CONFIG, seed=1)
+    np.testing.assert_array_equal(again[0], sampled[0])
+    for name, values in sampled[1].items():
+        np.testing.assert_array_equal(again[1][name], values)
+    other = run_risk_set(db, ctc_tendinitis_dataset(), CONFIG, seed=2)
+    np.testing.assert_array_equal(np.unique(other[1]["set_id"]), np.unique(sampled[1]["set_id"]))
+    assert not np.array_equal(other[0], sampled[0])
+
+
+def rows_of(table, owner):
+    #A patient's rows of a table as sorted tuples, codes decoded
+    rows = np.flatnonzero(table["patient_id"] == owner)
+    columns = [
+        table.decode(name, table[name][rows]) if name in table.vocabularies else table[name][rows]
+        for name in table.columns if name != "patient_id"
+    ]
+    #None for NaN, which never equals itself
+    values = [[None if v != v else v for v in column.tolist()] for column in columns]
+    return sorted(zip(*values), key=repr)
+
+
+def test_row_database(db):
+    #A patient several times over, next to one with no events
+    with_events = np.unique(db.pidx("medications"))
+    without = np.setdiff1d(np.arange(db.n_patients), with_events)
+    pidx = np.array([with_events[5], without[0], with_events[5], with_events[0], with_events[5]])
+    rows_db = row_database(db, pidx)
+    np.testing.assert_array_equal(rows_db.patient_ids, np.arange(len(pidx)))
+    for name, table in db.tables.items():
+        for pseudo, p in enumerate(pidx.tolist()):
+            assert rows_of(rows_db[name], pseudo) == rows_of(table, db.patient_ids[p]), (name, pseudo)
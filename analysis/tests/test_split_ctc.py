@@ -0,0 +1,64 @@
+import csv
+import gzip
+
+import pytest
+
+from split_ctc import open_text, split
+
+HEADER = ["patient_id", "tendinitis_case_date", "tendinitis_case", "sex", "note"]
+ROWS = [
+    ["1", "2019-03-01", "T", "female", ""],
+    ["2", "", "F", "male", "a, quoted"],
+    ["3", "2020-11-30", "T", "male", 'with "quotes"'],
+    ["4", "", "", "unknown", ""], #no case flag: a potential control
+    ["5", "", "F", "female", "x"],
+]
+
+
+def write(path, rows):
+    with open_text(path, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+
+
+def read(path):
+    with open_text(path, "r") as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.parametrize("extension", ["csv", "csv.gz"])
+def test_split(tmp_path, extension):
+    combined, cases, controls = (tmp_path / f"{name}.{extension}" for name in ("combined", "cases", "controls"))
+    write(combined, ROWS)
+    assert split(combined, cases, controls, "tendinitis_case") == {"cases": 2, "controls": 3}
+
+    #Cases keep every column, case flag included
+    assert read(cases) == [HEADER, ROWS[0], ROWS[2]]
+    #Controls are the rest, without the case flag column
+    assert read(controls) == [
+        ["patient_id", "tendinitis_case_date", "sex", "note"],
+        *([row[0], row[1], row[3], row[4]] for row in (ROWS[1], ROWS[3], ROWS[4])),
+    ]
+
+
+def test_rows_copied_as_text(tmp_path):
+    #Rows come out as ehrql wrote them: each case line is the input line, quoting and all
+    combined = tmp_path / "combined.csv.gz"
+    write(combined, ROWS)
+    split(combined, tmp_path / "cases.csv", tmp_path / "controls.csv", "tendinitis_case")
+    lines = gzip.open(combined).read().splitlines(keepends=True)
+    assert (tmp_path / "cases.csv").read_bytes().splitlines(keepends=True) == [lines[0], lines[1], lines[3]]
+
+
+def test_case_column(tmp_path):
+    combined = tmp_path / "combined.csv"
+    write(combined, ROWS)
+    with pytest.raises(ValueError):
+        split(combined, tmp_path / "cases.csv", tmp_path / "controls.csv", "missing_case")
+    #Split on another column's "T"s
+    rows = [[*row[:4], "T" if row[0] == "5" else ""] for row in ROWS]
+    write(combined, rows)
+    assert split(combined, tmp_path / "cases.csv", tmp_path / "controls.csv", "note") == {"cases": 1, "controls": 4}
+    assert [row[0] for row in read(tmp_path / "cases.csv")[1:]] == ["5"]
+    assert read(tmp_path / "controls.csv")[0] == HEADER[:4]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from engine.top1 import top1
+
+
+def lexsorted(groups, values, last):
+    #The sort top1 replaces: stable, nulls last, ties to the earlier (last: later) row
+    order = np.lexsort((values, groups))
+    grouped = groups[order]
+    edges = np.r_[grouped[1:] != grouped[:-1], True] if last else np.r_[True, grouped[1:] != grouped[:-1]]
+    return order[np.flatnonzero(edges)] if len(groups) else groups
+
+
+def dates(rng, n):
+    #Few distinct days, so ties for first and last are common
+    values = np.datetime64("2020-01-01") + rng.integers(0, 20, n).astype("timedelta64[D]")
+    values[rng.random(n) < 0.2] = np.datetime64("NaT")
+    return values
+
+
+def floats(rng, n):
+    pool = np.array([-np.inf, -2.5, -1.0, -0.0, 0.0, 1e-300, 1.0, 2.5, np.inf, np.nan])
+    return pool[rng.integers(0, len(pool), n)]
+
+
+def ints(rng, n):
+    return rng.integers(-5, 5, n)
+
+
+def bools(rng, n):
+    return rng.random(n) < 0.5
+
+
+@pytest.mark.parametrize("make", [dates, floats, ints, bools])
+@pytest.mark.parametrize("last", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_top1_matches_lexsort(make, last, seed):
+    rng = np.random.default_rng(seed)
+    n_groups = int(rng.integers(1, 50))
+    n = int(rng.integers(0, 500))
+    groups = rng.integers(0, n_groups, n)
+    if seed % 2:
+        #Rows grouped by patient, as frames are
+        groups = np.sort(groups)
+    values = make(rng, n)
+    chosen = top1(groups, values, n_groups, last=last)
+    expected = lexsorted(groups, values, last)
+    #One row per group with any rows, in group order
+    np.testing.assert_array_equal(groups[chosen], np.unique(groups))
+    np.testing.assert_array_equal(chosen, expected)
+
+
+def test_top1_float32():
+    values = np.array([np.nan, -0.0, 0.0, -np.inf, 3.0], dtype=np.float32)
+    groups = np.zeros(len(values), dtype=np.int64)
+    assert list(top1(groups, values, 1)) == [3]
+    assert list(top1(groups, values, 1, last=True)) == [0]
+
+
+def test_top1_all_null():
+    values = np.array(["NaT", "NaT"], dtype="datetime64[D]")
+    groups = np.zeros(2, dtype=np.int64)
+    assert list(top1(groups, values, 1)) == [0]
+    assert list(top1(groups, values, 1, last=True)) == [1]
+
+
+def test_top1_codes_have_no_key():
+    values = np.array(["b", "a", None], dtype=object)
+    assert top1(np.zeros(3, dtype=np.int64), values, 1) is None